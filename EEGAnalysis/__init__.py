@@ -6,17 +6,58 @@ email: yzmiao@protonmail.com
 last update: Oct 15 2018
 """
 
-from .container import create_epoch_bymarker, create_1d_epoch_bymarker
+##### lazy loading ######
+# submodules and their attributes are imported on first access (PEP 562),
+# so that `import EEGAnalysis` does not pull in pandas, h5py or scipy, e.g.
+# in process-pool workers. the names are the ones exported before:
+#   from .container import create_epoch_bymarker, create_1d_epoch_bymarker
+#   from .decomposition import *
+#   from .io import *
+#   from .datamanager import DataManager
+#   from .electrodes import Electrodes
+#   from .behaviors import get_relative_behavior_time
+import importlib
 
-from .decomposition import *
+_ATTRIBUTES = {
+    'create_epoch_bymarker': ('.container', 'create_epoch_bymarker'),
+    'create_1d_epoch_bymarker': ('.container', 'create_1d_epoch_bymarker'),
+    'DataManager': ('.datamanager', 'DataManager'),
+    'Electrodes': ('.electrodes', 'Electrodes'),
+    'get_relative_behavior_time': ('.behaviors', 'get_relative_behavior_time'),
+    # decomposition.__all__
+    'stfft': ('.decomposition', 'stfft'),
+    'dwt': ('.decomposition.dwt', None),
+    'phase': ('.decomposition.phase', None),
+    'power': ('.decomposition.power', None),
+    'filter': ('.decomposition.filter', None),
+    'connectivity': ('.decomposition.connectivity', None),
+    'detect_cross_pnt': ('.decomposition', 'detect_cross_pnt'),
+    'detect_cross_pnts': ('.decomposition', 'detect_cross_pnts'),
+    # io.__all__
+    'compactdata': ('.io.compactdata', None),
+    'splitdata': ('.io.splitdata', None),
+}
 
-from .io import *
+_SUBMODULES = ['atlas', 'batch', 'behaviors', 'container', 'datamanager', 'decomposition', 'electrodes',
+               'ingest', 'io', 'online', 'precision', 'profiling', 'stats', 'storage']
 
-from .datamanager import DataManager
+__all__ = list(_ATTRIBUTES) + ['mktree', 'group_consecutive', 'detect_thresh']
 
-from .electrodes import Electrodes
+def __getattr__(name):
+    if name in _ATTRIBUTES:
+        _module, _attribute = _ATTRIBUTES[name]
+        _value = importlib.import_module(_module, __name__)
+        if _attribute is not None:
+            _value = getattr(_value, _attribute)
+    elif name in _SUBMODULES:
+        _value = importlib.import_module('.' + name, __name__)
+    else:
+        raise AttributeError("module %r has no attribute %r"%(__name__, name))
+    globals()[name] = _value
+    return _value
 
-from .behaviors import get_relative_behavior_time
+def __dir__():
+    return sorted(set(globals()) | set(_ATTRIBUTES) | set(_SUBMODULES))
 
 ##### os misc ######
 import os
@@ -0,0 +1,223 @@
+"""
+local atlas labeling
+
+label coordinates with a local label volume, e.g. the Talairach Daemon
+atlas distributed with FSL (`Talairach-labels-1mm.nii` and `Talairach.xml`),
+instead of the Talairach Daemon java client.
+
+the volume is memory mapped once per process, all coordinates are mapped to
+voxels by one affine transform, and labeled by one fancy index. contacts
+outside the gray matter can be labeled by the nearest gray matter voxel
+within a radius (KD-tree search).
+
+labels are "." separated levels, e.g.
+"Left Cerebrum.Temporal Lobe.Middle Temporal Gyrus.Gray Matter.Brodmann area 21",
+i.e. the "Level 1" to "Level 5" columns of `Electrodes.query`.
+"""
+
+import os, re, gzip
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+
+_NIFTI_DTYPES = {2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8', 256: 'i1', 512: 'u2', 768: 'u4'}
+
+
+def read_nifti(filename):
+    '''
+    minimal NIfTI-1 reader, memory mapped for uncompressed files.
+
+    arguments:
+    - filename: path of a .nii or .nii.gz file
+
+    return:
+    - data: (x, y, z) ndarray, a read-only memmap for .nii files
+    - affine: (4 x 4) voxel to world transform (sform, or qform)
+    '''
+
+    if filename.endswith('.gz'):
+        with gzip.open(filename, 'rb') as _f:
+            _raw = _f.read()
+        _header = _raw[:348]
+    else:
+        _raw = None
+        with open(filename, 'rb') as _f:
+            _header = _f.read(348)
+
+    _endian = '<' if np.frombuffer(_header[:4], '<i4')[0] == 348 else '>'
+    if np.frombuffer(_header[:4], _endian + 'i4')[0] != 348:
+        raise ValueError("not a NIfTI-1 file: %s"%filename)
+
+    _dim = np.frombuffer(_header[40:56], _endian + 'i2')
+    _datatype = int(np.frombuffer(_header[70:72], _endian + 'i2')[0])
+    _pixdim = np.frombuffer(_header[76:108], _endian + 'f4')
+    _offset = int(np.frombuffer(_header[108:112], _endian + 'f4')[0])
+    _qform_code, _sform_code = np.frombuffer(_header[252:256], _endian + 'i2')
+    if _datatype not in _NIFTI_DTYPES:
+        raise ValueError("unsupported NIfTI datatype: %d"%_datatype)
+
+    _shape = tuple(int(item) for item in _dim[1:4])
+    _dtype = np.dtype(_endian + _NIFTI_DTYPES[_datatype])
+    if _raw is None:
+        data = np.memmap(filename, dtype=_dtype, mode='r', offset=_offset, shape=_shape, order='F')
+    else:
+        data = np.ndarray(_shape, dtype=_dtype, buffer=_raw, offset=_offset, order='F')
+
+    if _sform_code > 0:
+        affine = np.vstack((np.frombuffer(_header[280:328], _endian + 'f4').reshape((3, 4)), [0, 0, 0, 1]))
+    else:
+        _b, _c, _d = np.frombuffer(_header[256:268], _endian + 'f4').astype('float64')
+        _a = np.sqrt(max(1.0 - (_b*_b + _c*_c + _d*_d), 0.0))
+        _rotation = np.array([[_a*_a + _b*_b - _c*_c - _d*_d, 2*(_b*_c - _a*_d), 2*(_b*_d + _a*_c)],
+                              [2*(_b*_c + _a*_d), _a*_a + _c*_c - _b*_b - _d*_d, 2*(_c*_d - _a*_b)],
+                              [2*(_b*_d - _a*_c), 2*(_c*_d + _a*_b), _a*_a + _d*_d - _c*_c - _b*_b]])
+        _qfac = -1.0 if _pixdim[0] < 0 else 1.0
+        _zoom = np.array([_pixdim[1], _pixdim[2], _pixdim[3] * _qfac])
+        affine = np.eye(4)
+        affine[:3, :3] = _rotation * _zoom
+        affine[:3, 3] = np.frombuffer(_header[268:280], _endian + 'f4')
+    return data, np.asarray(affine, dtype='float64')
+
+
+def read_labels(filename):
+    '''
+    label names of an atlas, from an FSL atlas xml file
+    (`<label index="1">name</label>`) or a text file of "index<tab>name" lines.
+
+    return:
+    - dict{index: name}
+    '''
+
+    if filename.endswith('.xml'):
+        _labels = {}
+        for item in ET.parse(filename).getroot().iter('label'):
+            # FSL atlases index the labels from 0, the volume from 1
+            _labels[int(item.get('index')) + 1] = (item.text or '').strip()
+        return _labels
+
+    _labels = {}
+    with open(filename, 'r') as _f:
+        for line in _f:
+            _match = re.match(r'\s*(\d+)\s+(.+?)\s*$', line)
+            if _match:
+                _labels[int(_match.group(1))] = _match.group(2)
+    return _labels
+
+
+class Atlas(object):
+    '''
+    label volume with its label names.
+
+    arguments:
+    - volume: path of the label volume (.nii or .nii.gz)
+    - labels: path of the label names (.xml or .txt)
+
+    keyword arguments:
+    - gray_matter: label substring of the gray matter voxels [default: "Gray Matter"]
+    '''
+
+    def __init__(self, volume, labels, gray_matter='Gray Matter'):
+        self.data, self.affine = read_nifti(volume)
+        self._inverse = np.linalg.inv(self.affine)
+
+        _labels = read_labels(labels)
+        self.names = np.array(['*'] + [''] * max(_labels.keys()) if len(_labels) > 0 else ['*'], dtype=object)
+        for index, name in _labels.items():
+            self.names[index] = name
+        self.names[self.names == ''] = '*'
+
+        self.gray_matter = gray_matter
+        self._tree = None
+
+    def voxel(self, coord):
+        '''
+        voxel indices of (n x 3) world coordinates, one batched affine transform.
+
+        return:
+        - (n x 3) int array, and the (n,) bool mask of voxels inside the volume
+        '''
+
+        coord = np.atleast_2d(np.asarray(coord, dtype='float64'))
+        _ijk = np.rint(coord.dot(self._inverse[:3, :3].T) + self._inverse[:3, 3]).astype('int')
+        _inside = np.all((_ijk >= 0) & (_ijk < np.array(self.data.shape)), axis=1)
+        return _ijk, _inside
+
+    def lookup(self, coord):
+        '''
+        label index of the voxel of every coordinate, 0 outside the volume.
+        '''
+
+        _ijk, _inside = self.voxel(coord)
+        _index = np.zeros(len(_ijk), dtype='int')
+        _index[_inside] = self.data[_ijk[_inside, 0], _ijk[_inside, 1], _ijk[_inside, 2]]
+        return _index
+
+    def _gray_matter_tree(self):
+        # built once, on the first nearest gray matter query
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+
+            _gray = np.array([self.gray_matter in item for item in self.names])
+            _ijk = np.argwhere(_gray[np.asarray(self.data)])
+            self._tree_index = np.asarray(self.data)[_ijk[:, 0], _ijk[:, 1], _ijk[:, 2]].astype('int')
+            self._tree = cKDTree(_ijk.dot(self.affine[:3, :3].T) + self.affine[:3, 3])
+        return self._tree
+
+    def label(self, coord, radius=None):
+        '''
+        labels of (n x 3) world coordinates.
+
+        keyword arguments:
+        - radius: label the coordinates outside the gray matter by the nearest
+                  gray matter voxel within `radius` mm [default: None, voxel only]
+
+        return:
+        - names: (n,) label names, "*" if not labeled
+        - distance: (n,) distance to the labeled voxel in mm, 0 for the own voxel
+        '''
+
+        coord = np.atleast_2d(np.asarray(coord, dtype='float64'))
+        _index = self.lookup(coord)
+        _distance = np.zeros(len(coord))
+
+        if radius is not None:
+            _outside = np.array([self.gray_matter not in item for item in self.names[_index]], dtype='bool')
+            if np.any(_outside):
+                _dist, _nearest = self._gray_matter_tree().query(coord[_outside], distance_upper_bound=radius)
+                _found = np.isfinite(_dist)
+                _replace = np.where(_outside)[0][_found]
+                _index[_replace] = self._tree_index[_nearest[_found]]
+                _distance[_replace] = _dist[_found]
+
+        return self.names[_index], _distance
+
+    def levels(self, coord, radius=None, nlevel=5):
+        '''
+        labels split into "Level 1" ... "Level n" columns.
+
+        return:
+        - pandas.DataFrame with columns "hit" (the distance) and the levels
+        '''
+
+        import pandas as pd
+
+        _names, _distance = self.label(coord, radius=radius)
+        _levels = [(item.split('.') + ['*'] * nlevel)[:nlevel] if item != '*' else ['*'] * nlevel for item in _names]
+        _sheet = pd.DataFrame(_levels, columns=['Level %d'%(idx + 1) for idx in range(nlevel)])
+        _sheet.insert(0, 'hit', _distance)
+        return _sheet
+
+
+_atlas_cache = {}
+
+
+def load_atlas(volume, labels, gray_matter='Gray Matter'):
+    '''
+    `Atlas` loaded once per process and cached, e.g. across the patients of a cohort.
+    '''
+
+    _key = (os.path.abspath(volume), os.path.abspath(labels), gray_matter)
+    if _key not in _atlas_cache:
+        _atlas_cache[_key] = Atlas(volume, labels, gray_matter=gray_matter)
+    return _atlas_cache[_key]
@@ -0,0 +1,229 @@
+"""
+group level batch processing
+
+schedule per-patient/per-channel jobs on a bounded process pool and
+aggregate the results as they arrive, so that the data of the whole
+cohort is never held at once.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+_worker_patient = {}
+
+
+def _get_worker_patient(data_dir, patient_id):
+    '''
+    `Patient` instance cached in the worker process, so that the config
+    and marker files of a patient are parsed only once per worker.
+    '''
+
+    from .datamanager import Patient
+
+    _key = (data_dir, patient_id)
+    if _key not in _worker_patient:
+        _worker_patient.clear()  # keep one patient per worker
+        _worker_patient[_key] = Patient(data_dir, patient_id)
+    return _worker_patient[_key]
+
+
+def _run_job(job):
+    data_dir, patient_id, chidx, func, kwargs = job
+    _patient = _get_worker_patient(data_dir, patient_id)
+    return patient_id, chidx, func(_patient, chidx, **kwargs)
+
+
+def available_memory():
+    '''
+    available physical memory of the system, in bytes.
+    '''
+
+    try:
+        with open('/proc/meminfo', 'r') as _f:
+            for line in _f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024 ** 3
+
+
+def sampling_rate(data_dir, patient_id, chidx):
+    '''
+    sampling rate of the recordings of a channel, None if it has none.
+    '''
+
+    from . import storage
+    from .datamanager import _load_json
+
+    _sgch_dir = os.path.join(data_dir, patient_id, 'EEG', 'iSplit')
+    _backend = _load_json(os.path.join(_sgch_dir, 'isplit.json')).get('backend', 'hdf5')
+    with storage.open_store(_sgch_dir, _backend).reader(chidx) as _reader:
+        _names = _reader.names()
+        return _reader.info(_names[0])['freq'] if len(_names) > 0 else None
+
+
+def load_regions(data_dir, patient_id, level='Level 3'):
+    '''
+    map channel index to the Talairach label of the contact, from the
+    layout sheet exported by `Electrodes.query`.
+
+    returns:
+    - dict{chidx: label}, empty if the layout sheet does not exist.
+    '''
+
+    _layout_path = os.path.join(data_dir, patient_id, 'Image', patient_id + '_layout.csv')
+    if not os.path.isfile(_layout_path):
+        return {}
+
+    _layout = pd.read_csv(_layout_path).drop_duplicates('chn')
+    return dict(zip(_layout.chn.values - 1, _layout[level].astype(str).values))
+
+
+class RunningAverage(object):
+    '''
+    streaming average of arrays grouped by key.
+
+    only the running sum and count of each group are kept, so results can
+    be dropped as soon as they are added. the arrays of a group must have
+    the same shape and, if given, the same sampling rate.
+    '''
+
+    def __init__(self):
+        self._sum = {}
+        self._count = {}
+        self._fs = {}
+
+    def add(self, key, value, fs=None):
+        value = np.asarray(value, dtype='float64')
+        if key in self._sum:
+            if value.shape != self._sum[key].shape:
+                raise ValueError("cannot average %r: shape %s differs from %s, e.g. recordings at different "
+                                 "sampling rates, resample them to a common `freq`."%(key, value.shape, self._sum[key].shape))
+            if fs is not None and self._fs[key] is not None and fs != self._fs[key]:
+                raise ValueError("cannot average %r: sampling rate %g Hz differs from %g Hz, "
+                                 "resample the recordings to a common `freq`."%(key, fs, self._fs[key]))
+            self._sum[key] += value
+            self._count[key] += 1
+        else:
+            self._sum[key] = value.copy()
+            self._count[key] = 1
+            self._fs[key] = fs
+
+    def count(self):
+        return dict(self._count)
+
+    def mean(self):
+        return dict([(key, self._sum[key] / self._count[key]) for key in self._sum])
+
+
+def schedule(jobs, processes=None, memory_limit=None):
+    '''
+    run jobs on a bounded process pool, with memory-aware concurrency.
+
+    a job is submitted only if the memory estimate of all running jobs stays
+    under `memory_limit`; a single job exceeding the limit still runs, alone.
+
+    arguments:
+    - jobs: iterable of (job, nbytes), where `job` is the argument of `_run_job`
+            and `nbytes` is the memory estimate of the job.
+
+    keyword arguments:
+    - processes: maximum number of worker processes [default: os.cpu_count()]
+    - memory_limit: memory budget in bytes [default: 80% of available memory]
+
+    yields:
+    - (patient_id, chidx, result), in order of completion.
+    '''
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if memory_limit is None:
+        memory_limit = 0.8 * available_memory()
+
+    _pending = list(jobs)[::-1]
+    _running = {}
+    _used = 0
+
+    with ProcessPoolExecutor(max_workers=processes) as _pool:
+        while _pending or _running:
+            while _pending and len(_running) < processes:
+                _job, _nbytes = _pending[-1]
+                if _running and _used + _nbytes > memory_limit:
+                    break
+                _pending.pop()
+                _running[_pool.submit(_run_job, _job)] = _nbytes
+                _used += _nbytes
+
+            _done, _ = wait(list(_running.keys()), return_when=FIRST_COMPLETED)
+            for _future in _done:
+                _used -= _running.pop(_future)
+                yield _future.result()
+
+
+def epoch_power(patient, chidx, roi, frange, marker='marker', paradigm=None,
+                zscore=True, baseline=None, precision=None, freq=None, **filt_param):
+    '''
+    job function: trial-averaged dwt power of one channel, epoched by markers
+    across all the recordings of the patient.
+
+    arguments:
+    - patient: `Patient` instance
+    - chidx: channel index
+    - roi: (start, stop) of the epoch, relative to the markers, in seconds
+    - frange: target frequencies
+
+    keyword arguments:
+    - marker: the name of the marker file [default: marker]
+    - paradigm: the paradigm tag to select markers [default: None, all markers]
+    - zscore, baseline: see `dwt_power`
+    - precision: see `EEGAnalysis.precision`
+    - freq: use the recordings resampled to `freq` Hz, see `Patient.resample_isplit`
+        [default: None, the original rate]
+    - **filt_param: further marker filters, see `Patient.get_marker`
+
+    returns:
+    - Pxx: (freq x time) ndarray, or None if the channel has no marker.
+    '''
+
+    from .container import create_1d_epoch_bymarker
+    from .decomposition.dwt import dwt
+    from .decomposition.power import dwt_power
+
+    _sheet = patient.get_marker(marker)
+    if paradigm is not None:
+        filt_param['paradigm'] = paradigm
+
+    _chunks = []
+    _units = []
+    _fs = None
+    for name, entry in patient.load_isplit(chidx, freq=freq).items():
+        _filter = (_sheet.file == name)
+        for filtername, filtervalue in filt_param.items():
+            _filter = _filter & (_sheet[filtername] == filtervalue)
+        _marker = _sheet.marker[_filter].values
+        if len(_marker) == 0:
+            continue
+
+        _mbias = pd.to_numeric(_sheet.mbias[_filter], errors='coerce').fillna(0).values[0]
+        _fs = int(entry['freq'])
+        _chunks.append(create_1d_epoch_bymarker(entry['value'], _marker, roi, _fs, mbias=_mbias))
+        _units.append(float(entry['unit']))
+
+    if len(_chunks) == 0:
+        return None
+
+    # int16 epochs, the physical unit is applied in the wavelet spectrum
+    if len(np.unique(_units)) == 1:
+        _dwt_result = dwt(np.vstack(_chunks), _fs, frange, reflection=True, unit=_units[0], precision=precision)
+    else:
+        _dwt_result = np.concatenate([dwt(item, _fs, frange, reflection=True, unit=_unit, precision=precision)
+                                      for item, _unit in zip(_chunks, _units)], axis=1)
+    return dwt_power(_dwt_result, _fs, zscore=zscore, baseline=baseline, precision=precision)
@@ -7,22 +7,26 @@ last update: Oct 15 2018
 """
 
 import os, re
-from scipy.io import loadmat, savemat
 import numpy as np
 import pandas as pd
 from warnings import warn
 
-def create_epoch_bymarker(data, marker, roi, fs, mbias=0):
+from .profiling import instrument
+from .precision import as_float_dtype
+
+@instrument('create_epoch_bymarker')
+def create_epoch_bymarker(data, marker, roi, fs, mbias=0, precision=None):
     gap = int(np.ceil((roi[1] - roi[0]) * fs))
-    result = np.zeros((np.size(data, 0), gap, len(marker)), dtype=data.dtype)
+    result = np.zeros((np.size(data, 0), gap, len(marker)), dtype=as_float_dtype(data.dtype, precision))
     for midx, eachm in enumerate(marker):
         start = int(np.floor((eachm + roi[0] + mbias) * fs))
         result[:, :, midx] = data[:, start:start+gap]
     return result
 
-def create_1d_epoch_bymarker(data, marker, roi, fs, mbias=0):
+@instrument('create_1d_epoch_bymarker')
+def create_1d_epoch_bymarker(data, marker, roi, fs, mbias=0, precision=None):
     gap = int(np.ceil((roi[1] - roi[0]) * fs))
-    result = np.zeros((len(marker), gap), dtype=data.dtype)
+    result = np.zeros((len(marker), gap), dtype=as_float_dtype(data.dtype, precision))
     for midx, eachm in enumerate(marker):
         start = int(np.floor((eachm + roi[0] + mbias) * fs))
         result[midx, :] = data[start:start+gap]
@@ -34,6 +38,7 @@ class iSplitContainer(object):
         warn('.mat backend isplit will not be supperted in the future, please use `data manager` to create and load isplit data.(hdf5 backend)', DeprecationWarning)
         self.chfilename = os.path.join(datadir, "sgch_channel_%03d.mat"%chidx)
 
+        from scipy.io import loadmat
         rawmat = loadmat(self.chfilename)
         self.edfnames = rawmat["edfnames"]
         self.values = dict([(self.edfnames[idx], item[0]) for idx, item in enumerate(rawmat["values"][0])])
@@ -5,15 +5,14 @@ from pprint import pprint
 import os, re, json, shutil, random
 from hashlib import sha256
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
-import matplotlib.pyplot as plt
-from IPython import display
-
-from .io import loadedf
+from . import batch, ingest, profiling, storage
+from .io import loadedf, loadraw
 from .container import create_1d_epoch_bymarker
-from .decomposition import detect_cross_pnt
-from .decomposition.dwt import dwt
-from .decomposition.power import dwt_power
+from .decomposition import detect_cross_pnts
+from .decomposition.dwt import dwt, dwt_stream
+from .decomposition.power import dwt_power, estimate_mbias
 
 
 def _load_json(filename):
@@ -23,11 +22,180 @@ def _load_json(filename):
 
 
 def _save_json(filename, var):
-    with open(filename, 'w') as _f:
-        _f.write(json.dumps(var))
+    ingest.atomic_write(filename, json.dumps(var))
     return True
 
 
+def _extract_DC_marker(filename, channels, thresh):
+    '''
+    read the DC channels of an edf file in one pass and detect the markers.
+
+    return:
+    - dict{label: (channel index, marker time array)}, with index -1 for
+      missing channels.
+    '''
+
+    _edf = loadraw(filename, 'parse marker', preload=False)
+    _chidx = _edf.channel_index(channels)
+    _found = [idx for idx in _chidx if idx != -1]
+
+    _result = dict([(label, (-1, np.array([]))) for label in channels])
+    if len(_found) == 0:
+        return _result
+
+    _trace = _edf.data[_found, :] * _edf.physical_unit[_found].reshape((-1, 1)) / 1e6  # unit as Volt
+    _marker_idx = detect_cross_pnts(_trace, thresh, gap=_edf.fs)
+    for label, idx in zip(np.array(channels)[_chidx != -1], range(len(_found))):
+        _result[label] = (_found[idx], _marker_idx[idx] / _edf.fs)
+    return _result
+
+
+def _estimate_file_mbias(store, name, channels, marker, roi, lags, smooth):
+    '''
+    read the epochs of a recording from the isplit store, only the windows
+    around the markers, and estimate the marker bias.
+
+    return:
+    - (mbias, confidence)
+    '''
+
+    _epochs = []
+    for chidx in channels:
+        with store.reader(chidx) as _reader:
+            if name not in _reader.names():
+                continue
+            _info = _reader.info(name)
+            _fs = _info['freq']
+            _gap = int(np.ceil((roi[1] - roi[0]) * _fs))
+            _start = np.floor((marker + roi[0]) * _fs).astype('int')
+            _start = _start[(_start >= 0) & (_start + _gap <= _info['length'])]
+            _epochs.append(np.array([_reader.read(name, item, item + _gap) for item in _start], dtype='float32'))
+
+    if len(_epochs) == 0 or np.size(_epochs[0]) == 0:
+        return np.nan, np.nan
+
+    _mbias, _confidence, _ = estimate_mbias(np.array(_epochs), _fs, roi, lags, smooth=smooth)
+    return _mbias, _confidence
+
+
+def _channel_erp(store, chidx, windows, nconditions, roi, baseline, bandrange, pad, freq=None):
+    '''
+    running mean and variance of the epochs of one channel, per condition,
+    reading only the windows around the markers from the isplit store.
+
+    the statistics of each (file, condition) batch are computed on the stored
+    (int16) values and scaled by the unit of the file before they are merged
+    (Chan et al. parallel variance), so samples are never scaled one by one.
+
+    arguments:
+    - windows: dict{file name: list of (condition index, marker times incl. mbias)}
+    - freq: read the recordings resampled to `freq` Hz, None for the original rate
+
+    return:
+    - (fs, count, mean, m2), with (condition x time) mean and m2, or None if
+      the channel has no isplit data.
+    '''
+
+    _fs, _count, _mean, _m2 = None, np.zeros(nconditions, dtype='int'), None, None
+    with store.reader(chidx) as _reader:
+        _names = _reader.names()
+        for name, batches in windows.items():
+            if name not in _names:
+                continue
+            _stored = storage.resampled_name(name, freq)
+            _info = _reader.info(_stored)
+            _unit = _info['unit']
+            _file_fs = _info['freq']
+            if _fs is None:
+                _fs = _file_fs
+                _gap = int(np.ceil((roi[1] - roi[0]) * _fs))
+                _pad = int(np.ceil(pad * _fs)) if bandrange is not None else 0
+                _mean = np.zeros((nconditions, _gap))
+                _m2 = np.zeros((nconditions, _gap))
+                _base = slice(max(int((baseline[0] - roi[0]) * _fs), 0), int((baseline[1] - roi[0]) * _fs)) if baseline is not None else None
+            elif _file_fs != _fs:
+                raise ValueError("sampling rate of %s differs from the other files."%name)
+
+            for condition, marker in batches:
+                _start = np.floor((marker + roi[0]) * _fs).astype('int') - _pad
+                _start = _start[(_start >= 0) & (_start + _gap + 2 * _pad <= _info['length'])]
+                if len(_start) == 0:
+                    continue
+                _epochs = np.array([_reader.read(_stored, item, item + _gap + 2 * _pad) for item in _start], dtype='float64')
+
+                if bandrange is not None:
+                    from .decomposition.filter import butter_bandpass_filter  # scipy.signal, only when filtering
+                    _epochs = butter_bandpass_filter(_epochs, bandrange, _fs)[:, _pad:_pad + _gap]
+                if _base is not None:
+                    _epochs -= np.mean(_epochs[:, _base], axis=1, keepdims=True)
+
+                _n = len(_epochs)
+                _batch_mean = np.mean(_epochs, 0) * _unit
+                _batch_m2 = np.sum((_epochs - np.mean(_epochs, 0)) ** 2, 0) * _unit ** 2
+
+                _total = _count[condition] + _n
+                _delta = _batch_mean - _mean[condition]
+                _mean[condition] += _delta * _n / _total
+                _m2[condition] += _batch_m2 + _delta ** 2 * _count[condition] * _n / _total
+                _count[condition] = _total
+
+    if _fs is None:
+        return None
+    return _fs, _count, _mean, _m2
+
+
+def _resample_channel(store, chidx, names, freq, block, overwrite, compression_level):
+    '''
+    resample the recordings of one channel to `freq` Hz into derived
+    recordings, block by block.
+
+    return:
+    - (chidx, list of the resampled names)
+    '''
+
+    from .decomposition.filter import resample_ratio, resample_stream  # scipy.signal, only when resampling
+
+    _done = []
+    with store.reader(chidx) as _reader:
+        _names = _reader.names()
+        _todo = []
+        for name in (_names if names is None else [item for item in names if item in _names]):
+            _target = storage.resampled_name(name, freq)
+            try:
+                _reader.info(_target)
+                if not overwrite:
+                    continue
+            except ValueError:
+                pass
+            _todo.append((name, _target, _reader.info(name)))
+
+    for name, _target, _info in _todo:
+        _up, _down = resample_ratio(_info['freq'], freq)
+        _length = -(-_info['length'] * _up // _down)
+        store.create(chidx, _target, _length, 'float32', _info['unit'], freq, compression_level=compression_level)
+        # source and target share the channel file, so neither stays open across blocks
+        resample_stream(lambda start, stop: store.read_window(chidx, name, start, stop), _info['length'],
+                        _info['freq'], freq,
+                        lambda start, data: store.write_chunk(chidx, _target, start, data.astype('float32')),
+                        block=int(block * _info['freq']))
+        _done.append(name)
+    return chidx, _done
+
+
+def _extract_events(filename):
+    '''
+    events of a raw file, see `EEGData.events`; none for readers without events.
+
+    return:
+    - pandas.DataFrame with columns "onset", "duration" and "text"
+    '''
+
+    _raw = loadraw(filename, 'parse events', preload=False)
+    if not hasattr(_raw, 'events'):
+        return pd.DataFrame({'onset': [], 'duration': [], 'text': []}, columns=['onset', 'duration', 'text'])
+    return _raw.events()
+
+
 class Patient(object):
     '''
     data of single patient and all kinds of manipulations on patient data.
@@ -53,6 +221,7 @@ class Patient(object):
 
         self._sgch_dir = os.path.join(self._patient_dir, 'EEG', 'iSplit')
         self._sgch_config = _load_json(os.path.join(self._sgch_dir, 'isplit.json'))
+        self._store = storage.open_store(self._sgch_dir, self._sgch_config.get('backend', 'hdf5'))
 
         self._marker_dir = os.path.join(self._patient_dir, 'EEG', 'Marker')
         self._marker_path = os.path.join(self._marker_dir, 'marker.csv')
@@ -74,13 +243,13 @@ class Patient(object):
 
     def load_raw(self, name=""):
         '''
-        load edf format file, with the `name` specified.
+        load a raw file (edf, or Nihon Kohden eeg), with the `name` specified.
 
         arguments:
-        - name: the name of the edf file
+        - name: the name of the raw file
 
         return:
-        - `edf` instance
+        - `EDFData` or `EEGData` instance
         '''
 
         _pool = [item['file'] for item in self._raw_config.values() if item['name'] == name]
@@ -89,10 +258,11 @@ class Patient(object):
         elif len(_pool) == 0:
             raise ValueError("name not found: \"%s\""%name)
         else:
-            return loadedf(_pool[0], 'load_raw')
+            return loadraw(_pool[0], 'load_raw')
 
 
-    def load_isplit(self, chidx, name=None):
+    @profiling.instrument('load_isplit')
+    def load_isplit(self, chidx, name=None, freq=None):
         '''
         load isplit format data, with channel index specified.
 
@@ -102,41 +272,321 @@ class Patient(object):
         keyword arguments:
         - name: either be string or list of strings, i.e. the names of the target edf files.
                 default as None, i.e. import all edf files.
+        - freq: sampling rate, load the recordings resampled by `resample_isplit`
+                default as None, i.e. the original rate.
 
         returns:
         - result :: dict{name: dict{unit: ndarray, value: ndarray, freq: ndarray}}
         '''
 
-        _channel_name = "Channel%03d"%(chidx + 1)
-        _hdf5_file = h5py.File(os.path.join(self._sgch_dir, '%s.h5'%_channel_name), 'r')
-
         result = {}
-        if name == None:
-            for item in _hdf5_file.values():
-                result[item.name[1:]] = {
-                    'unit': np.array(item['unit']),
-                    'value': np.array(item['value']),
-                    'freq': np.array(item['freq']),
-                }
-
-        else:
-            if isinstance(name, str):
+        with self._store.reader(chidx) as _reader:
+            if name == None:
+                _name = _reader.names()
+            elif isinstance(name, str):
                 _name = [name]
             else:
                 _name = name
 
+            _names = _reader.names()
             for item in _name:
-                if item in _hdf5_file:
-                    result[item] = {
-                        'unit': np.array(_hdf5_file[name]['unit']),
-                        'value': np.array(_hdf5_file[name]['value']),
-                        'freq': np.array(_hdf5_file[name]['freq']),
-                    }
-                else:
-                    raise ValueError("name not found: \"%s\""%name)
+                if item not in _names:
+                    raise ValueError("name not found: \"%s\""%item)
+                _stored = storage.resampled_name(item, freq)
+                _info = _reader.info(_stored)
+                result[item] = {
+                    'unit': np.array(_info['unit']),
+                    'value': _reader.read(_stored),
+                    'freq': np.array(_info['freq']),
+                }
 
         return result
 
+    def stream_dwt_power(self, chidx, name, frange, filename=None, block=60, precision='single'):
+        '''
+        continuous wavelet power of a whole recording, computed block by block
+        and written to an hdf5 file, with constant memory.
+
+        the power is identical to `dwt` of the whole recording (without
+        reflection), see `decomposition.dwt.dwt_stream`.
+
+        arguments:
+        - chidx: channel index
+        - name: the name of the edf file
+        - frange: target frequencies
+
+        keyword arguments:
+        - filename: the output hdf5 file
+            [default: EEG/Derived/ChannelNNN_<name>_dwt.h5 of the patient]
+        - block: block length, in seconds [default: 60]
+        - precision: 'single' or 'double' [default: 'single']
+
+        return:
+        - filename: path of the output file, with datasets
+            "power" (freq x time, float32), "frange" and "freq".
+        '''
+
+        if filename is None:
+            _derived_dir = os.path.join(self._patient_dir, 'EEG', 'Derived')
+            if not os.path.isdir(_derived_dir):
+                os.mkdir(_derived_dir)
+            filename = os.path.join(_derived_dir, 'Channel%03d_%s_dwt.h5'%(chidx + 1, name))
+
+        with self._store.reader(chidx) as _reader, h5py.File(filename, 'w') as _target:
+            _info = _reader.info(name)
+            _fs = int(_info['freq'])
+            _unit = _info['unit']
+            _nsample = _info['length']
+
+            _block = min(int(block * _fs), _nsample)
+            _power = _target.create_dataset('power', shape=(len(frange), _nsample), dtype='float32',
+                                            chunks=(len(frange), max(min(_block, 2 ** 20 // len(frange)), 1)))
+            _target.create_dataset('frange', data=np.array(frange))
+            _target.create_dataset('freq', data=_fs)
+
+            dwt_stream(lambda start, stop: _reader.read(name, start, stop), _nsample, _fs, frange, _power,
+                       block=_block, unit=_unit, precision=precision)
+
+        return filename
+
+    def update_pyramid(self, factors=storage.PYRAMID_FACTORS, channels=None, overwrite=False):
+        '''
+        build the min/max/RMS summary pyramid of the recordings already in
+        isplit, e.g. imported before `create_isplit` stored them. each
+        recording is read block by block.
+
+        keyword arguments:
+        - factors: decimation factors [default: (10, 100, 1000)]
+        - channels: channel indices [default: None, all channels]
+        - overwrite: rebuild existing pyramids [default: False]
+
+        return void
+        '''
+
+        channels = self._store.channels() if channels is None else channels
+        for chidx in tqdm(channels):
+            with self._store.reader(chidx) as _reader:
+                _todo = [(item, _reader.info(item)['length']) for item in _reader.names()
+                         if overwrite or len(_reader.factors(item)) == 0]
+                _summaries = [(item, storage.summarize(lambda start, stop: _reader.read(item, start, stop),
+                                                       _length, factors)) for item, _length in _todo]
+            for item, _summary in _summaries:
+                self._store.write_pyramid(chidx, item, _summary)
+
+    def browse(self, chidx, name, start=0, stop=None, width=1000):
+        '''
+        min/max/RMS envelope of a time span for plotting, read from the
+        coarsest summary level with at least `width` bins in the span, or
+        from the samples for short spans.
+
+        arguments:
+        - chidx: channel index
+        - name: the name of the edf file
+
+        keyword arguments:
+        - start, stop: time span, in seconds [default: the whole recording]
+        - width: number of points wanted, e.g. the plot width in pixels [default: 1000]
+
+        return:
+        - dict{time: bin start (s), min, max, rms: physical values, factor: samples per bin}
+        '''
+
+        with self._store.reader(chidx) as _reader:
+            _info = _reader.info(name)
+            _fs = _info['freq']
+            _start = max(int(start * _fs), 0)
+            _stop = _info['length'] if stop is None else min(int(np.ceil(stop * _fs)), _info['length'])
+
+            _factors = [item for item in _reader.factors(name) if (_stop - _start) // item >= width]
+            if len(_factors) == 0:
+                _value = _reader.read(name, _start, _stop).astype('float64')
+                _factor, _summary = 1, np.vstack((_value, _value, np.abs(_value))).T
+                _first = _start
+            else:
+                _factor = max(_factors)
+                _first = _start // _factor
+                _summary = _reader.read_pyramid(name, _factor, _first, -(-_stop // _factor))
+                _first *= _factor
+
+        _low, _high = _summary[:, 0] * _info['unit'], _summary[:, 1] * _info['unit']
+        return {'time': (_first + np.arange(len(_summary)) * _factor) / _fs,
+                'min': np.minimum(_low, _high), 'max': np.maximum(_low, _high),
+                'rms': _summary[:, 2] * abs(_info['unit']), 'factor': _factor}
+
+    def resample_isplit(self, freq, channels=None, name=None, block=60, overwrite=False,
+                        compression_level=4, processes=None):
+        '''
+        resample the isplit recordings to `freq` Hz with an anti-aliased
+        polyphase filter, block by block, and store them as derived
+        recordings of the same channels. `load_isplit`, `erp` and
+        `batch.epoch_power` read them with `freq=freq`.
+
+        arguments:
+        - freq: target sampling rate
+
+        keyword arguments:
+        - channels: list of channel indices [default: None, all channels]
+        - name: either be string or list of strings, the names of the edf files
+            [default: None, all files]
+        - block: block length, in seconds [default: 60]
+        - overwrite: resample again existing derived recordings [default: False]
+        - compression_level: the level of compression of the hdf5 backend [default: 4]
+        - processes: number of worker processes, one channel each [default: os.cpu_count()]
+
+        return void
+        '''
+
+        if isinstance(name, str):
+            name = [name]
+        channels = self._store.channels() if channels is None else channels
+
+        with ProcessPoolExecutor(max_workers=processes) as _pool:
+            _futures = [_pool.submit(_resample_channel, self._store, chidx, name, freq, block, overwrite,
+                                     compression_level) for chidx in channels]
+            for _future in tqdm(as_completed(_futures), total=len(_futures)):
+                _future.result()
+
+    def export_edf(self, filename, name, channels=None, start=0, stop=None, freq=None, block=60,
+                   record_duration=1):
+        '''
+        export isplit recordings of a file into an edf file, block by block.
+
+        the physical range of every channel is read from the summary pyramid
+        (see `create_isplit`), or found by a first pass over the data. the
+        second pass streams blocks of all channels into the edf records, so
+        the memory is bounded by one block.
+
+        arguments:
+        - filename: the edf file
+        - name: the name of the edf file in isplit
+
+        keyword arguments:
+        - channels: list of channel indices [default: None, all channels of the file]
+        - start, stop: time range, in seconds [default: the whole recording]
+        - freq: export the recordings resampled by `resample_isplit` [default: None]
+        - block: block length, in seconds [default: 60]
+        - record_duration: edf record duration, in seconds [default: 1]
+
+        return:
+        - number of records written
+        '''
+
+        from contextlib import ExitStack
+        from .io.edfwriter import write_edf
+
+        if channels is None:
+            channels = [chidx for chidx in self._store.channels() if name in self._store.names(chidx)]
+        _labels = dict([(chidx, label) for label, chidx in self._sgch_config.get('chidx', {}).items()])
+        _stored = storage.resampled_name(name, freq)
+
+        with ExitStack() as _stack:
+            _readers = [_stack.enter_context(self._store.reader(chidx)) for chidx in channels]
+            _info = [_reader.info(_stored) for _reader in _readers]
+            _fs = _info[0]['freq']
+            if any([item['freq'] != _fs for item in _info]):
+                raise ValueError("channels with different sampling rates.")
+            _units = np.array([item['unit'] for item in _info]).reshape((-1, 1))
+            _start = max(int(start * _fs), 0)
+            _stop = min([item['length'] for item in _info] + ([] if stop is None else [int(np.ceil(stop * _fs))]))
+            _block = max(int(block * _fs), 1)
+
+            def _blocks():
+                for t0 in range(_start, _stop, _block):
+                    t1 = min(t0 + _block, _stop)
+                    yield np.array([_reader.read(_stored, t0, t1) for _reader in _readers], dtype='float64') * _units
+
+            # the coarsest summary of every channel bounds its range in [start, stop)
+            _physical_min, _physical_max = None, None
+            _factors = [_reader.factors(_stored) for _reader in _readers]
+            if all([len(item) > 0 for item in _factors]):
+                _summary = [_reader.read_pyramid(_stored, max(item), _start // max(item), -(-_stop // max(item)))
+                            for _reader, item in zip(_readers, _factors)]
+                _low = np.array([np.min(item[:, 0]) for item in _summary]) * _units[:, 0]
+                _high = np.array([np.max(item[:, 1]) for item in _summary]) * _units[:, 0]
+                _physical_min, _physical_max = np.minimum(_low, _high), np.maximum(_low, _high)
+
+            return write_edf(filename, _blocks, [_labels.get(chidx, 'Channel%03d'%(chidx + 1)) for chidx in channels],
+                             _fs, physical_min=_physical_min, physical_max=_physical_max,
+                             record_duration=record_duration, record_info=name)
+
+    def erp(self, conditions, roi=(-0.5, 1), baseline=(-0.2, 0), channels=None, marker='marker',
+            bandrange=None, pad=1, freq=None, processes=None):
+        '''
+        evoked responses of all channels for a set of conditions.
+
+        only the windows around the markers are read from the isplit files,
+        and the mean and variance of every condition are accumulated in one
+        pass per channel, so the memory does not grow with the recordings.
+        channels are processed in parallel.
+
+        arguments:
+        - conditions: paradigm or list of paradigms, or
+            dict{condition name: dict{column: value}} of marker filters,
+            e.g. {'hit': {'paradigm': 'task', 'note': 'hit'}}
+
+        keyword arguments:
+        - roi: epoch range relative to the markers, in seconds [default: (-0.5, 1)]
+        - baseline: baseline range, in seconds, subtracted from every epoch,
+            None for no baseline correction [default: (-0.2, 0)]
+        - channels: list of channel indices [default: None, all channels]
+        - marker: the name of the marker file [default: marker]
+        - bandrange: (low, high) band-pass filter of the epochs, in Hz [default: None]
+        - pad: padding of the epochs for the filter, in seconds [default: 1]
+        - freq: use the recordings resampled to `freq` Hz, see `resample_isplit`
+            [default: None, the original rate]
+        - processes: number of worker processes [default: os.cpu_count()]
+
+        return:
+        - dict with
+            "mean", "std": (channel x condition x time) ndarrays, in physical unit
+            "count": (channel x condition) number of epochs
+            "time": time of the samples relative to the markers, in seconds
+            "channels", "conditions": the channel indices and condition names
+        '''
+
+        if isinstance(conditions, str):
+            conditions = [conditions]
+        if not isinstance(conditions, dict):
+            conditions = dict([(item, {'paradigm': item}) for item in conditions])
+        _names = list(conditions.keys())
+
+        if channels is None:
+            channels = sorted([int(item[7:]) - 1 for item in self._sgch_config.keys() if re.match(r'Channel\d{3}$', item)])
+
+        _sheet = self.get_marker(marker)
+        _mbias = pd.to_numeric(_sheet.mbias, errors='coerce').fillna(0).values
+        _windows = {}
+        for _condition, name in enumerate(_names):
+            _filter = np.ones(len(_sheet), dtype='bool')
+            for filtername, filtervalue in conditions[name].items():
+                _filter = _filter & (_sheet[filtername] == filtervalue).values
+            for _file in np.unique(_sheet.file[_filter]):
+                _select = _filter & (_sheet.file == _file).values
+                _windows.setdefault(_file, []).append((_condition, _sheet.marker.values[_select] + _mbias[_select]))
+
+        _result = {}
+        with ProcessPoolExecutor(max_workers=processes) as _pool:
+            _futures = dict([(_pool.submit(_channel_erp, self._store, chidx, _windows, len(_names),
+                                           roi, baseline, bandrange, pad, freq), chidx) for chidx in channels])
+            for _future in tqdm(as_completed(_futures), total=len(_futures)):
+                _result[_futures[_future]] = _future.result()
+
+        channels = [chidx for chidx in channels if _result[chidx] is not None]
+        if len(channels) == 0:
+            raise ValueError("no isplit data for the channels.")
+        _fs = _result[channels[0]][0]
+
+        _count = np.array([_result[chidx][1] for chidx in channels])
+        _mean = np.array([_result[chidx][2] for chidx in channels])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            _std = np.sqrt(np.array([_result[chidx][3] for chidx in channels]) / (_count[:, :, np.newaxis] - 1))
+        _mean[_count == 0] = np.nan
+
+        return {'mean': _mean, 'std': _std, 'count': _count,
+                'time': roi[0] + np.arange(np.size(_mean, -1)) / _fs,
+                'channels': channels, 'conditions': _names}
+
+
     def check_marker(self):
         '''
         check if the specific name of the edf file has a list of markers.
@@ -212,6 +662,8 @@ class Patient(object):
             shutil.copy(os.path.join(source_dir, item), os.path.join(target_dir, item))
 
     def _mbias_preview(self, chidx, name, paradigm):
+        import matplotlib.pyplot as plt  # plotting only, not needed by headless workers
+
         _marker = self._marker.marker[(self._marker.file == name)&(self._marker.paradigm == paradigm)].values
         _entry = self.load_isplit(chidx, name)
         _freq = int(_entry[name]['freq'])
@@ -233,6 +685,7 @@ class Patient(object):
         plt.show()
 
 
+    @profiling.instrument('marker_csv')
     def _update_marker(self):
         self._marker.to_csv(self._marker_path, float_format="%.3f", index=False)
         self._marker = pd.read_csv(self._marker_path)
@@ -241,12 +694,92 @@ class Patient(object):
         self._behavior = pd.read_csv(self._behavior_path)
 
 
-    def update_mbias(self, name=None, mbias=None, paradigm=None, overwrite=False, n=3):
+    def estimate_mbias(self, name=None, paradigm=None, n_channels=32, lags=(-0.5, 0.5),
+                       lag_step=0.005, roi=(-1, 2), smooth=0.05, processes=None):
+        '''
+        estimate the time stamp bias automatically, without user input.
+
+        for every (file, paradigm), the event-locked broadband power of
+        `n_channels` channels is computed in one vectorized pass, and
+        correlated with a step response at every candidate lag, see
+        `decomposition.power.estimate_mbias`. files are processed in parallel.
+
+        keyword arguments:
+        - name: file name or list of file names [default: None, all files]
+        - paradigm: paradigm or list of paradigms [default: None, all paradigms]
+        - n_channels: number of channels, evenly spread over the channel indices
+        - lags: (min, max) of the candidate biases, in seconds [default: (-0.5, 0.5)]
+        - lag_step: step of the candidate biases, in seconds [default: 0.005]
+        - roi: epoch range relative to the markers, in seconds [default: (-1, 2)]
+        - smooth: width of the power smoothing, in seconds [default: 0.05]
+        - processes: number of worker processes [default: os.cpu_count()]
+
+        return:
+        - pandas.DataFrame with columns "file", "paradigm", "mbias", "confidence".
+          confidence is the correlation coefficient of the best lag.
+        '''
+
+        _sheet = self._marker.copy()
+        _sheet['paradigm'] = _sheet.paradigm.fillna('')
+
+        _names = np.unique(_sheet.file) if name is None else ([name] if isinstance(name, str) else name)
+        _paradigms = np.unique(_sheet.paradigm) if paradigm is None else ([paradigm] if isinstance(paradigm, str) else paradigm)
+
+        _all_channels = sorted([int(item[7:]) - 1 for item in self._sgch_config.keys() if re.match(r'Channel\d{3}$', item)])
+        _pick = np.unique(np.linspace(0, len(_all_channels) - 1, min(n_channels, len(_all_channels))).astype('int'))
+        _channels = [_all_channels[idx] for idx in _pick]
+        _lags = np.arange(lags[0], lags[1] + lag_step / 2, lag_step)
+
+        _jobs = {}
+        for each in _names:
+            for _each_paradigm in _paradigms:
+                _marker = _sheet.marker[(_sheet.file == each) & (_sheet.paradigm == _each_paradigm)].values
+                if len(_marker) > 0:
+                    _jobs[(each, _each_paradigm)] = (self._store, each, _channels, _marker, roi, _lags, smooth)
+
+        _result = []
+        with ProcessPoolExecutor(max_workers=processes) as _pool:
+            _futures = dict([(_pool.submit(_estimate_file_mbias, *args), key) for key, args in _jobs.items()])
+            for _future in tqdm(as_completed(_futures), total=len(_futures)):
+                _mbias, _confidence = _future.result()
+                _result.append({'file': _futures[_future][0], 'paradigm': _futures[_future][1],
+                                'mbias': _mbias, 'confidence': _confidence})
+
+        return pd.DataFrame(_result, columns=['file', 'paradigm', 'mbias', 'confidence']).sort_values(['file', 'paradigm']).reset_index(drop=True)
+
+
+    def update_mbias(self, name=None, mbias=None, paradigm=None, overwrite=False, n=3,
+                     auto=False, min_confidence=0.5, review=True, **estimate_param):
         '''
         calibrate the time stamp bias manually.
         use this function after you have import the time stamp mannully.
+
+        with `auto`, the bias is estimated by `Patient.estimate_mbias` and only
+        the (file, paradigm) with a confidence below `min_confidence` are left
+        for manual review, or skipped if `review` is False.
         '''
 
+        if auto:
+            _estimate = self.estimate_mbias(name=name, paradigm=paradigm, **estimate_param)
+            _paradigm_sheet = self._marker.paradigm.fillna('')
+            _review = []
+            for item in _estimate.itertuples():
+                _target = (self._marker.file == item.file) & (_paradigm_sheet == item.paradigm)
+                if not overwrite and pd.to_numeric(self._marker.mbias[_target], errors='coerce').notna().any():
+                    print("mbias alread in record: %s; use `overwrite` flag to overwrite."%item.file)
+                elif item.confidence >= min_confidence:
+                    print("%s-%s: mbias %.3f (confidence %.2f)"%(item.file, item.paradigm, item.mbias, item.confidence))
+                    self._marker.loc[_target, 'mbias'] = item.mbias
+                else:
+                    print("%s-%s: low confidence %.2f"%(item.file, item.paradigm, item.confidence))
+                    _review.append(item)
+            self._update_marker()
+
+            if review:
+                for item in _review:
+                    self.update_mbias(name=item.file, paradigm=item.paradigm, overwrite=overwrite, n=n)
+            return
+
         if name == None:
             _candidates = np.unique(self._marker.file[self._marker.mbias != None])
         elif isinstance(name, str):
@@ -265,6 +798,9 @@ class Patient(object):
         else:
             raise ValueError('bad `paradigm`.')
 
+        import matplotlib.pyplot as plt
+        from IPython import display
+
         for each in _candidates:
             for _each_paradigm in _paradigm:
                 if each in list(self._marker.file[~np.isnan(self._marker.mbias)&(self._marker.paradigm == _each_paradigm)]) and not overwrite:
@@ -308,13 +844,13 @@ class Patient(object):
 
         if channel_label not in self._sgch_config['chidx'].keys():
             self._sgch_config['chidx'][channel_label] = len(self._sgch_config['chidx'])
-            self._update_config()
 
         return self._sgch_config['chidx'][channel_label]
 
     def _update_config(self):
         '''
         update and overwrite the config file of isplit and rawdata directories.
+        both files are replaced atomically.
         '''
 
         _save_json(os.path.join(self._sgch_dir, 'isplit.json'), self._sgch_config)
@@ -322,27 +858,48 @@ class Patient(object):
         return
 
 
-    def create_isplit(self, compression_level=4, overwrite=False):
+    @profiling.instrument('create_isplit')
+    def create_isplit(self, compression_level=4, overwrite=False, pyramid=storage.PYRAMID_FACTORS):
         '''
         create and update isplit files from edf raw data
 
+        every finished (file, channel) pair and every finished file is recorded
+        in the ingestion journal `isplit.journal`, and the config files are
+        replaced atomically after each file. an interrupted import resumes where
+        it stopped: finished files are not decoded again, and a channel written
+        but not recorded before the crash is written again. a raw file whose
+        digest changed since it was recorded is imported again.
+
         keyword arguments:
         - compression_level: the level of compression, default as 4.
             0 as no compression and 10 as the highest compression level.
         - overwrite: the overwrite flag
+        - pyramid: decimation factors of the min/max/RMS summary stored with
+            every recording, see `browse`; None to skip. [default: (10, 100, 1000)]
 
         return void
         '''
 
+        _journal = ingest.IngestJournal(os.path.join(self._sgch_dir, 'isplit.journal'))
+        self._replay_journal(_journal)
+
         pbar = tqdm(total=len(self._raw_config.keys()))
 
         for raw_file, raw_item in self._raw_config.items():
-            _edf_data = loadedf(raw_item['file'], 'create_isplit')
+            _name = raw_item['name']
+            if not overwrite and _journal.has_file(_name, raw_item.get('sha256')):
+                pbar.update(1)
+                continue
+            if overwrite or _journal.known_file(_name):
+                # a modified raw file: its old channel records must not skip the new data
+                _journal.discard_file(_name)
 
-            for _idx in range(_edf_data.nchannel):
+            _edf_data = loadraw(raw_item['file'], 'create_isplit')
 
-                chidx = self._get_chidx(_edf_data.channelLabels[_idx])
-                if chidx == -1:
+            for _idx in range(_edf_data.nchannel):
+                _label = _edf_data.channelLabels[_idx]
+                chidx = self._get_chidx(_label)
+                if chidx == -1 or _journal.has_channel(_name, _label):
                     continue
 
                 _channel_name = 'Channel%03d'%(chidx+1)
@@ -350,80 +907,297 @@ class Patient(object):
                 if not _channel_name in self._sgch_config.keys():
                     self._sgch_config[_channel_name] = []
 
-                _sha = sha256(_edf_data.data[chidx]).hexdigest()
+                with profiling.stage('create_isplit.hash'):
+                    _sha = sha256(_edf_data.data[_idx]).hexdigest()
                 if _sha in self._sgch_config[_channel_name] and not overwrite:
+                    _journal.record_channel(_name, _label, chidx, _sha)
                     continue
 
-                _hdf5_file = h5py.File(os.path.join(self._sgch_dir, '%s.h5'%_channel_name), 'a')
-                if raw_item['name'] not in _hdf5_file:
-                    _hdf5_file.create_group(raw_item['name'])
+                with profiling.stage('create_isplit.write'):
+                    # replaces a recording left over by an interrupted import, or overwritten
+                    _written = self._store.write(chidx, _name, _edf_data.data[_idx], _edf_data.physical_unit[_idx],
+                                                 _edf_data.fs, compression_level=compression_level)
+                    profiling.record(written=_written)
+
+                if pyramid:
+                    with profiling.stage('create_isplit.pyramid'):
+                        _value = _edf_data.data[_idx]
+                        _summary = storage.summarize(lambda start, stop: _value[start:stop], len(_value), pyramid)
+                        profiling.record(written=self._store.write_pyramid(chidx, _name, _summary))
+
+                if _sha not in self._sgch_config[_channel_name]:
+                    self._sgch_config[_channel_name].append(_sha)
+                _journal.record_channel(_name, _label, chidx, _sha)
+
+            with profiling.stage('create_isplit.config'):
+                self._update_config()
+                _journal.record_file(_name, raw_item.get('sha256'))
+            pbar.update(1)
 
-                _hdf5_file.create_dataset(name='%s/unit'%raw_item['name'], data=_edf_data.physical_unit[chidx])
-                _hdf5_file.create_dataset(name='%s/value'%raw_item['name'], data=_edf_data.data[chidx], compression="gzip", compression_opts=compression_level)
-                _hdf5_file.create_dataset(name="%s/freq"%raw_item['name'], data=_edf_data.fs)
+        pbar.close()
+        return
 
-                _hdf5_file.close()
-                self._sgch_config[_channel_name].append(_sha)
-            pbar.update(1)
+
+    def _replay_journal(self, journal):
+        '''
+        restore the channel indices and digests recorded in the ingestion
+        journal but missing in the isplit config, i.e. lost by a crash
+        between the journal record and the config update.
+        '''
+
+        if 'chidx' not in self._sgch_config.keys():
+            self._sgch_config['chidx'] = {}
+
+        _changed = False
+        for item in journal.channels():
+            _channel_name = 'Channel%03d'%(item['chidx']+1)
+            if item['label'] not in self._sgch_config['chidx']:
+                self._sgch_config['chidx'][item['label']] = item['chidx']
+                _changed = True
+            if item['sha256'] not in self._sgch_config.setdefault(_channel_name, []):
+                self._sgch_config[_channel_name].append(item['sha256'])
+                _changed = True
+
+        if _changed:
+            self._update_config()
+
+
+    def import_legacy_isplit(self, legacy_dir, processes=None, overwrite=False, compression_level=4):
+        '''
+        migrate a legacy .mat SgCh directory (`io.splitdata`, `EDFData.splitinto`
+        or `container.iSplitContainer` layouts) into the isplit store of the
+        patient, channels in parallel.
+
+        the legacy channel folders/files are numbered from 0, i.e. `ch000`
+        becomes `Channel001`. the legacy files carry no channel labels, so the
+        label to channel index mapping of the config is left untouched.
+
+        arguments:
+        - legacy_dir: the legacy SgCh directory
+
+        keyword arguments:
+        - processes: number of worker processes [default: os.cpu_count()]
+        - overwrite: replace the recordings already in the store [default: False]
+        - compression_level: the level of compression of the hdf5 backend [default: 4]
+
+        return void
+        '''
+
+        for chidx, converted in storage.convert_legacy(legacy_dir, self._store, processes=processes,
+                                                       overwrite=overwrite, compression_level=compression_level):
+            _channel_name = 'Channel%03d'%(chidx+1)
+            for _name, _sha in converted:
+                if _sha not in self._sgch_config.setdefault(_channel_name, []):
+                    self._sgch_config[_channel_name].append(_sha)
 
         _save_json(os.path.join(self._sgch_dir, 'isplit.json'), self._sgch_config)
-        pbar.close()
         return
 
 
-    def update_DC_marker(self, overwrite=False, mapping={'POL DC10': 'marker'}, thresh=3):
+    def import_spike2(self, spike2_dir=None, fs=2000, dtype='float32', overwrite=False, processes=None,
+                      match_pattern=r"\d{6}-.*?\.mat", compression_level=4, export='marker',
+                      pyramid=storage.PYRAMID_FACTORS):
+        '''
+        import Spike2 exported mat (v7.3) files straight into isplit, without
+        the compact .mat step of `io.compactdata.createcompact`, files in
+        parallel. the grating and entrain cues of every file are written to
+        the marker file, with paradigms "grating" and "entrain". every
+        recording gets its summary pyramid, and the import is recorded in the
+        ingestion journal as in `create_isplit`, so an interrupted import
+        resumes with the unfinished files.
+
+        keyword arguments:
+        - spike2_dir: directory of the Spike2 files [default: EEG/Spike2 of the patient]
+        - fs: sampling rate [default: 2000]
+        - dtype: stored dtype, "float32" or "int16" [default: "float32"]
+        - overwrite: import again the files already in isplit [default: False]
+        - processes: number of worker processes [default: os.cpu_count()]
+        - match_pattern: regular expression of the file names
+        - compression_level: the level of compression of the hdf5 backend [default: 4]
+        - export: the marker file name [default: marker]
+        - pyramid: decimation factors of the summary pyramid, see `browse`;
+            None to skip. [default: (10, 100, 1000)]
+
+        return void
+        '''
+
+        from .io import compactdata
+
+        if spike2_dir is None:
+            spike2_dir = os.path.join(self._patient_dir, 'EEG', 'Spike2')
+
+        _journal = ingest.IngestJournal(os.path.join(self._sgch_dir, 'isplit.journal'))
+        self._replay_journal(_journal)
+
+        # finished files, and files imported before the journal
+        _imported = set([name for chidx in self._store.channels() for name in self._store.names(chidx)])
+        _journaled = set([item['file'] for item in _journal.channels()])
+        _done = lambda name: _journal.has_file(name) or (name in _imported and name not in _journaled)
+
+        _files = [os.path.join(spike2_dir, item) for item in sorted(os.listdir(spike2_dir))
+                  if re.match(match_pattern, item) and (overwrite or not _done(os.path.splitext(item)[0]))]
+        for item in _files:
+            _name = os.path.splitext(os.path.basename(item))[0]
+            if _journal.known_file(_name) or _name in _journaled:
+                _journal.discard_file(_name)
+
+        if 'chidx' not in self._sgch_config.keys():
+            self._sgch_config['chidx'] = {}
+
+        _updates, _names = [], set()
+        for name, channels, grating, entrain in compactdata.spike2isplit(_files, self._store, fs, dtype=dtype,
+                                                                         processes=processes,
+                                                                         compression_level=compression_level,
+                                                                         pyramid=pyramid):
+            for chidx, _label, _sha in channels:
+                self._sgch_config['chidx'].setdefault(_label, chidx)
+                if _sha not in self._sgch_config.setdefault('Channel%03d'%(chidx+1), []):
+                    self._sgch_config['Channel%03d'%(chidx+1)].append(_sha)
+                _journal.record_channel(name, _label, chidx, _sha)
+            self._update_config()
+            _journal.record_file(name)
+            _names.add(name)
+            for _paradigm, _marker_time in (('grating', grating), ('entrain', entrain)):
+                _updates.append(pd.DataFrame({'file': name, 'paradigm': _paradigm, 'marker': _marker_time,
+                                              'mbias': '0', 'note': ''}))
+            if len(entrain) == 0:
+                print(name, ": has no valid entrain window!")
+
+        if len(_names) > 0:
+            _export_path = os.path.join(self._marker_dir, '%s.csv'%export)
+            try:
+                _marker_file = pd.read_csv(_export_path)
+            except FileNotFoundError:
+                _marker_file = pd.DataFrame(columns=['file','paradigm','marker','mbias','note'])
+            _marker_file = pd.concat([_marker_file[~_marker_file.file.isin(_names)]] + _updates, ignore_index=True)
+            _marker_file.to_csv(_export_path, float_format="%.3f", index=False)
+            print('please reload Patient class to use updated marker.')
+        return
+
+
+    def update_DC_marker(self, overwrite=False, mapping={'POL DC10': 'marker'}, thresh=3, processes=None):
         '''
         automatic updating marker list.
 
+        all the mapped DC channels of a recording are read in a single
+        channel-selective pass and their rising edges are detected at once.
+        recordings are processed in parallel, and each marker file is written
+        once at the end.
+
         keyword arguments:
         - overwrite: overwrite flag
-        - mapping: mapping of the marker channels [future]
+        - mapping: mapping of the marker channels, i.e. {channel label: marker file name}
+        - thresh: threshold of the DC channels, in Volt [default: 3]
+        - processes: number of worker processes [default: os.cpu_count()]
 
         return void
         '''
 
-        for _target_ch, _marker_name in mapping.items():
+        _marker_files = {}
+        for _marker_name in set(mapping.values()):
             _marker_path = os.path.join(self._marker_dir, '%s.csv'%_marker_name)
             try:
-                _marker_file = pd.read_csv(_marker_path)
+                _marker_files[_marker_name] = pd.read_csv(_marker_path)
             except FileNotFoundError:
-                _marker_file = pd.DataFrame(columns=['file','paradigm','marker','mbias','note'])
+                _marker_files[_marker_name] = pd.DataFrame(columns=['file','paradigm','marker','mbias','note'])
 
-            for item in self._raw_config.values():
-                if item['name'] in list(_marker_file.file) and not overwrite:
+        _jobs = {}
+        for item in self._raw_config.values():
+            _targets = {}
+            for _target_ch, _marker_name in mapping.items():
+                if item['name'] in list(_marker_files[_marker_name].file) and not overwrite:
                     print('alreday exist the markers of %s, skip.'%(item['name']))
                     continue
-                elif item['name'] in list(_marker_file.file) and overwrite:
+                elif item['name'] in list(_marker_files[_marker_name].file) and overwrite:
                     print('overwrite the markers of %s'%(item['name']))
-                else:
-                    pass
+                _targets[_target_ch] = _marker_name
+            if len(_targets) > 0:
+                _jobs[item['name']] = (item['file'], _targets)
+
+        _updates = dict([(_marker_name, []) for _marker_name in _marker_files])
+        _overwritten = dict([(_marker_name, set()) for _marker_name in _marker_files])
+        with ProcessPoolExecutor(max_workers=processes) as _pool:
+            _futures = dict([(_pool.submit(_extract_DC_marker, _file, list(_targets.keys()), thresh), _name)
+                             for _name, (_file, _targets) in _jobs.items()])
+            for _future in tqdm(as_completed(_futures), total=len(_futures)):
+                _name = _futures[_future]
+                _targets = _jobs[_name][1]
+                for _target_ch, (_marker_ch, _marker_time) in _future.result().items():
+                    _marker_name = _targets[_target_ch]
+                    if _marker_ch == -1:
+                        print('file %s has no target DC channels: %s'%(_name, _target_ch))
+                        continue
+                    elif len(_marker_time) == 0:
+                        print('%s marker of file %s not detected!'%(_marker_name, _name))
+                        continue
+
+                    _overwritten[_marker_name].add(_name)
+                    _updates[_marker_name].append(pd.DataFrame({'file': _name, 'paradigm': '', 'marker': _marker_time,
+                                                                'mbias': '0', 'note': ''}))
+                    print("%s for %s marker of %s: %d"%(_target_ch, _marker_name, _name, _marker_ch))
+
+        for _marker_name, _marker_file in _marker_files.items():
+            if len(_updates[_marker_name]) == 0:
+                continue
+            _marker_file = _marker_file[~_marker_file.file.isin(_overwritten[_marker_name])]
+            _marker_file = pd.concat([_marker_file] + _updates[_marker_name], ignore_index=True)
+            _marker_file.to_csv(os.path.join(self._marker_dir, '%s.csv'%_marker_name), float_format="%.3f", index=False)
 
-                _edf = loadedf(item['file'], 'parse marker')
+        print('please reload Patient class to use updated marker.')
 
-                try:
-                    _marker_ch = np.where([True if _item == _target_ch else False for _item in _edf.channelLabels])[0][0]
-                except IndexError:
-                    print('file %s has no target DC channels: %s'%(item['name'], _target_ch))
-                    continue
 
-                try:
-                    _marker_trace = _edf.data[_marker_ch] * _edf.physical_unit[_marker_ch] / 1e6  # unit as Volt
-                    _marker_time = np.array(detect_cross_pnt(_marker_trace, thresh, gap=_edf.fs)) / _edf.fs
-                except IndexError:
-                    print('%s marker of file %s not detected!'%(_marker_name, item['name']))
-                    continue
+    def update_event_marker(self, overwrite=False, export='marker', paradigm='', processes=None):
+        '''
+        update the marker list from the events stored in the raw files, i.e.
+        the EDF+ annotations of edf files, or the .LOG event log of Nihon
+        Kohden recordings, instead of thresholding DC channels. recordings are processed in parallel, and
+        the marker file is written once at the end.
+
+        keyword arguments:
+        - overwrite: overwrite flag
+        - export: the marker file name [default: marker]
+        - paradigm: the paradigm tag of the markers; the event texts are
+            stored as "note", and the durations as "duration" [default: ""]
+        - processes: number of worker processes [default: os.cpu_count()]
 
+        return void
+        '''
 
-                _marker_data = [{'file':item['name'], 'paradigm':'', 'marker':_item, 'mbias':'0','note':''}
-                               for _item in _marker_time]
-                _marker_file = _marker_file.append(_marker_data) if len(_marker_data) > 0 else _marker_file
+        _export_path = os.path.join(self._marker_dir, '%s.csv'%export)
+        try:
+            _marker_file = pd.read_csv(_export_path)
+        except FileNotFoundError:
+            _marker_file = pd.DataFrame(columns=['file','paradigm','marker','mbias','note'])
 
-                _marker_file.to_csv(_marker_path, float_format="%.3f", index=False)
-                print("%s for %s marker of %s: %d"%(_target_ch, _marker_name, item['name'], _marker_ch))
+        _jobs = {}
+        for item in self._raw_config.values():
+            if item['name'] in list(_marker_file.file) and not overwrite:
+                print('alreday exist the markers of %s, skip.'%(item['name']))
+                continue
+            _jobs[item['name']] = item['file']
+
+        _updates = []
+        with ProcessPoolExecutor(max_workers=processes) as _pool:
+            _futures = dict([(_pool.submit(_extract_events, _file), _name) for _name, _file in _jobs.items()])
+            for _future in tqdm(as_completed(_futures), total=len(_futures)):
+                _name = _futures[_future]
+                _events = _future.result()
+                if len(_events) == 0:
+                    print('no events in file %s.'%_name)
+                    continue
+                _updates.append(pd.DataFrame({'file': _name, 'paradigm': paradigm, 'marker': _events.onset.values,
+                                              'mbias': '0', 'note': _events.text.values,
+                                              'duration': _events.duration.values}))
+                print("events of %s: %d"%(_name, len(_events)))
 
-        print('please reload Patient class to use updated marker.')
+        if len(_updates) > 0:
+            _marker_file = _marker_file[~_marker_file.file.isin([item.file.values[0] for item in _updates])]
+            _marker_file = pd.concat([_marker_file] + _updates, ignore_index=True)
+            _marker_file.to_csv(_export_path, float_format="%.3f", index=False)
+            print('please reload Patient class to use updated marker.')
 
 
+    @profiling.instrument('marker_csv')
     def get_marker(self, marker='marker', dtype=None, **filt_param):
         '''
         get the marker array for specific name and paradigm.
@@ -469,10 +1243,14 @@ class DataManager(object):
         return self.current_patient
 
 
-    def create_patient(self, patient_id):
+    def create_patient(self, patient_id, backend='hdf5'):
         '''
         create all the subfolders and config files for a new patient.
         if the patient exists, create all the file that were missing.
+
+        keyword arguments:
+        - backend: the isplit storage of a new patient, 'hdf5' or 'directory',
+            see `EEGAnalysis.storage` [default: 'hdf5']
         '''
 
         _patient_dir = os.path.join(self._data_dir, patient_id)
@@ -498,6 +1276,15 @@ class DataManager(object):
                 with open(item, 'w') as _f:
                     _f.write("{}")
 
+        _sgch_config_path = os.path.join(_patient_dir, 'EEG', 'iSplit', 'isplit.json')
+        _sgch_config = _load_json(_sgch_config_path)
+        if backend != _sgch_config.get('backend', 'hdf5'):
+            if any([re.match(r'Channel\d{3}$', item) for item in _sgch_config.keys()]):
+                raise ValueError("patient %s has isplit data in another backend."%patient_id)
+            storage.open_store(os.path.dirname(_sgch_config_path), backend)  # check the backend name
+            _sgch_config['backend'] = backend
+            _save_json(_sgch_config_path, _sgch_config)
+
         self.current_patient = Patient(self._data_dir, patient_id)
         return self.current_patient
 
@@ -507,34 +1294,187 @@ class DataManager(object):
         return os.path.isdir(_patient_dir)
 
 
-    def update_raw_to_patient(self, patient_id, raw_dir, copy=True, ext='.edf', overwrite=False):
+    def list_patients(self):
+        '''
+        discover the patients under the data directory, i.e. the subfolders
+        with an isplit config file.
+
+        return:
+        - list of patient ids
+        '''
+
+        return sorted([item for item in os.listdir(self._data_dir)
+                       if os.path.isfile(os.path.join(self._data_dir, item, 'EEG', 'iSplit', 'isplit.json'))])
+
+
+    def batch(self, func, patient_ids=None, channels=None, processes=None,
+              memory_limit=None, mem_factor=8, **kwargs):
+        '''
+        run `func(patient, chidx, **kwargs)` for every channel of every patient
+        on a bounded process pool.
+
+        jobs are ordered by patient, so each worker builds a `Patient` only once
+        per patient. the memory of a job is estimated as `mem_factor` times the
+        size of the channel data, and jobs are held back while the estimates of
+        the running jobs exceed `memory_limit`.
+
+        arguments:
+        - func: job function, must be picklable (i.e. defined at module level)
+
+        keyword arguments:
+        - patient_ids: list of patient ids [default: None, i.e. `list_patients()`]
+        - channels: list of channel indices [default: None, i.e. all channels]
+        - processes: number of worker processes [default: os.cpu_count()]
+        - memory_limit: memory budget in bytes [default: 80% of available memory]
+        - mem_factor: memory of a job relative to its channel data [default: 8]
+        - **kwargs: passed to `func`
+
+        yields:
+        - (patient_id, chidx, result), in order of completion.
+        '''
+
+        if patient_ids is None:
+            patient_ids = self.list_patients()
+        elif isinstance(patient_ids, str):
+            patient_ids = [patient_ids]
+
+        _jobs = []
+        for patient_id in patient_ids:
+            _sgch_dir = os.path.join(self._data_dir, patient_id, 'EEG', 'iSplit')
+            _sgch_config = _load_json(os.path.join(_sgch_dir, 'isplit.json'))
+            _store = storage.open_store(_sgch_dir, _sgch_config.get('backend', 'hdf5'))
+            _chidx = sorted([int(item[7:]) - 1 for item in _sgch_config.keys() if re.match(r'Channel\d{3}$', item)])
+            if channels is not None:
+                _chidx = [item for item in _chidx if item in channels]
+
+            for chidx in _chidx:
+                _nbytes = mem_factor * _store.nbytes(chidx)
+                _jobs.append(((self._data_dir, patient_id, chidx, func, kwargs), _nbytes))
+
+        return batch.schedule(_jobs, processes=processes, memory_limit=memory_limit)
+
+
+    def grand_average(self, func, level='Level 3', **kwargs):
+        '''
+        grand average of the job results by Talairach region, aggregated
+        in a streaming fashion.
+
+        the region of each channel is read from the layout sheet exported by
+        `Electrodes.query`; channels without a label and jobs returning None
+        are skipped. results of a region must share their shape and sampling
+        rate, pass `freq` to `func` (e.g. `epoch_power`) to average patients
+        recorded at different rates.
+
+        arguments:
+        - func: job function, see `DataManager.batch`,
+                e.g. `EEGAnalysis.batch.epoch_power`
+
+        keyword arguments:
+        - level: the Talairach level column of the layout sheet [default: Level 3]
+        - **kwargs: passed to `DataManager.batch`
+
+        return:
+        - average: dict{region: ndarray}
+        - count: dict{region: number of channels}
+        '''
+
+        _regions = {}
+        _average = batch.RunningAverage()
+        for patient_id, chidx, result in self.batch(func, **kwargs):
+            if result is None:
+                continue
+            if patient_id not in _regions:
+                _regions[patient_id] = batch.load_regions(self._data_dir, patient_id, level=level)
+            if chidx not in _regions[patient_id]:
+                continue
+            _fs = kwargs['freq'] if kwargs.get('freq') is not None else \
+                batch.sampling_rate(self._data_dir, patient_id, chidx)
+            _average.add(_regions[patient_id][chidx], result, fs=_fs)
+
+        return _average.mean(), _average.count()
+
+
+    def update_raw_to_patient(self, patient_id, raw_dir, copy=True, ext='.edf', overwrite=False,
+                              link=None, workers=4):
+        '''
+        import raw files into the patient directory.
+
+        files are copied and hashed in the same pass on a pool of `workers`
+        threads. files with the same size and mtime as their previous import
+        are skipped without being read, and files whose content is unchanged
+        are not copied again.
+
+        arguments:
+        - patient_id: patient name or id
+        - raw_dir: path of the source directory
+
+        keyword arguments:
+        - copy: copy the files into the patient directory, otherwise keep them in place
+        - ext: extension of the raw files, e.g. .edf or .EEG; the .21E, .PNT and
+               .LOG companions of Nihon Kohden .EEG files are imported with them,
+               each skipped or copied on its own [default: .edf]
+        - overwrite: overwrite flag
+        - link: None, 'hard', 'reflink' or 'auto'. link instead of copying when the
+                source and the patient directory share a filesystem [default: None]
+        - workers: number of import threads [default: 4]
+
+        return:
+        - `Patient` instance
+        '''
+
         if not self.has_patient(patient_id):
             self.create_patient(patient_id)
 
         _patient_dir = os.path.join(self._data_dir, patient_id)
         _raw_dir = os.path.join(_patient_dir, 'EEG', 'Raw')
-        # _sgch_dir = os.path.join(_patient_dir, 'EEG', 'iSplit')
+        _store_dir = _raw_dir if copy else None
 
         _raw_config = _load_json(os.path.join(_raw_dir, 'rawdata.json'))
 
-        for item in tqdm(os.listdir(raw_dir)):
-            if (not re.match(r'.*?'+ext, item)) or (item in _raw_config.keys() and not overwrite):
+        _items = []
+        for item in os.listdir(raw_dir):
+            if not re.match(r'.*?'+ext, item):
                 continue
-
-            if copy:
-                shutil.copy(os.path.join(raw_dir, item), os.path.join(_raw_dir, item))
-                _store_dir = _raw_dir
-            else:
-                _store_dir = raw_dir
-
-            # _temp = open(os.path.abspath(os.path.join(_store_dir, item)), 'r')
-            _temp = loadedf(os.path.abspath(os.path.join(_store_dir, item)), 'test')
-            _raw_config[item] = {'file':os.path.abspath(os.path.join(_store_dir, item)),
-                                 'name':os.path.splitext(item)[0],
-                                 'ext': ext,
-                                 'sha256': sha256(_temp.data).hexdigest()
-                                }
-            # _temp.close()
+            if item in _raw_config.keys() and 'size' not in _raw_config[item] and not overwrite:
+                continue  # imported before size/mtime were recorded
+            _items.append(item)
+
+        # (item, companion file or None), the companions are imported like
+        # their raw file and recorded in its entry
+        _tasks = [(item, None) for item in _items]
+        if _store_dir is not None and ext.lower() == '.eeg':
+            _names = dict([(os.path.splitext(item)[0], item) for item in _items])
+            for _companion in os.listdir(raw_dir):
+                _base, _ext = os.path.splitext(_companion)
+                if _base in _names and _ext.lower() in ('.21e', '.pnt', '.log'):
+                    _tasks.append((_names[_base], _companion))
+
+        _companions = {}
+        with ThreadPoolExecutor(max_workers=workers) as _pool:
+            _futures = {}
+            for item, _companion in _tasks:
+                _record = _raw_config.get(item)
+                if _companion is not None:
+                    _record = (_record or {}).get('companions', {}).get(_companion)
+                _futures[_pool.submit(ingest.import_raw_file, os.path.join(raw_dir, _companion or item),
+                                      store_dir=_store_dir, record=_record,
+                                      link=link, overwrite=overwrite)] = (item, _companion)
+            for _future in tqdm(as_completed(_futures), total=len(_futures)):
+                _entry = _future.result()
+                if _entry is None:
+                    continue
+                item, _companion = _futures[_future]
+                if _companion is not None:
+                    _companions.setdefault(item, {})[_companion] = _entry
+                    continue
+                _entry['name'] = os.path.splitext(item)[0]
+                _entry['ext'] = ext
+                _entry['companions'] = _raw_config.get(item, {}).get('companions', {})
+                _raw_config[item] = _entry
+
+        for item, _entries in _companions.items():
+            if item in _raw_config:
+                _raw_config[item].setdefault('companions', {}).update(_entries)
 
         _save_json(os.path.join(_raw_dir, 'rawdata.json'), _raw_config)
         self.current_patient = Patient(self._data_dir, patient_id)
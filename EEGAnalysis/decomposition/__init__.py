@@ -1,16 +1,26 @@
 __all__ = [
-        "stfft", "dwt", "phase", "power", "filter", "detect_cross_pnt"
+        "stfft", "dwt", "phase", "power", "filter", "connectivity", "detect_cross_pnt",
+        "detect_cross_pnts"
 ]
 
 from .stfft import stfft
 # from .dwt import dwt
-from .phase import dwt_itpc
+from .phase import dwt_itpc, itpc_pvalue
 from .power import dwt_power
 # import hilbert  #TODO: hilbert transform
-from .filter import gaussianwind
 
+import importlib
 import numpy as np
 
+def __getattr__(name):
+    # scipy.signal (filter) is slow to import, load submodules on first use
+    if name == 'gaussianwind':
+        from .filter import gaussianwind
+        return gaussianwind
+    if name in ('dwt', 'filter', 'connectivity', 'hilbert'):
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r"%(__name__, name))
+
 def detect_cross_pnt(arr, thr, way='up', gap=1):
     """
     detect the data rise/down point, returns the index of the 
@@ -50,4 +60,43 @@ def detect_cross_pnt(arr, thr, way='up', gap=1):
         except IndexError:
             pass
     
-    return _result
\ No newline at end of file
+    return _result
+
+def detect_cross_pnts(arr, thr, gap=1):
+    """
+    vectorized `detect_cross_pnt(..., way='up')` over the rows of a 2d array,
+    i.e. detect the data rise points of many channels at once.
+    
+    arguments:
+    - arr: data array (2d), channels as rows
+    - thr: threshold (scale), or one threshold per row
+    
+    key arguments:
+    - gap: the least points between two valid markers.
+    
+    returns:
+    - list of index arrays (1d), one per row
+    """
+    
+    arr = np.atleast_2d(arr)
+    thr = np.reshape(thr, (-1, 1))
+    
+    _above = arr > thr
+    _rise = np.zeros(arr.shape, dtype='bool')
+    _rise[:, 1:] = _above[:, 1:] & (arr[:, :-1] < thr)
+    _rise[:, 0] = _above[:, 0] & (arr[:, -1] < thr[:, 0])  # same wrap-around as `detect_cross_pnt`
+    
+    _result = []
+    for _row in _rise:
+        _idx, = np.where(_row)
+        if len(_idx) > 1 and np.min(np.diff(_idx)) <= gap:
+            _keep = []
+            _previous = -9999
+            for idx in _idx:
+                if idx - _previous > gap:
+                    _keep.append(idx)
+                    _previous = idx
+            _idx = np.array(_keep, dtype=_idx.dtype)
+        _result.append(_idx)
+    
+    return _result
@@ -0,0 +1,135 @@
+"""
+cross-channel connectivity
+
+coherence, phase locking value (PLV) and weighted phase lag index (wPLI)
+across trials, for all channel pairs of the dwt results. the cross spectra
+of two channel blocks are one batched complex matrix product over trials.
+"""
+
+import numpy as np
+
+from ..profiling import instrument
+from ..precision import as_complex
+
+
+METHODS = ('coh', 'plv', 'wpli')
+
+
+def select_pairs(nchannel, shanks=None, mode='all'):
+    """channel pairs (i < j)
+
+    Syntax: pairs = select_pairs(nchannel, shanks, mode)
+
+    Keyword arguments:
+    nchannel -- (int) number of channels
+    shanks   -- (list) shank of every channel, e.g. `Electrodes.channel_shanks()`
+                [default: None]
+    mode     -- (str) 'all' pairs, pairs 'within' a shank or 'between' shanks
+                [default: 'all']
+
+    Return:
+    pairs    -- (numpy.ndarray) (npairs x 2) channel indices
+    """
+
+    _i, _j = np.triu_indices(nchannel, k=1)
+    if mode == 'all':
+        return np.vstack((_i, _j)).T
+    if shanks is None:
+        raise ValueError("`shanks` is required for mode %s."%mode)
+
+    _, _shank = np.unique(np.asarray(shanks), return_inverse=True)
+    if mode == 'within':
+        _keep = _shank[_i] == _shank[_j]
+    elif mode == 'between':
+        _keep = _shank[_i] != _shank[_j]
+    else:
+        raise ValueError("unknown `mode` value.")
+    return np.vstack((_i[_keep], _j[_keep])).T
+
+
+@instrument('connectivity')
+def connectivity(dwtresults, method=METHODS, pairs=None, block=16, tblock=1000, out=None, precision=None):
+    """connectivity of channel pairs across trials
+
+    Syntax: pairs, result = connectivity(dwtresults, method, pairs, block, tblock, out, precision)
+
+    Keyword arguments:
+    dwtresults -- (array-like, dtype="complex") (channels x freq x trials x time)
+                  dwt results of all channels, e.g. stacked `dwt` results or an
+                  h5py dataset; read by blocks of channels and time
+    method     -- (str or tuple) 'coh', 'plv' and/or 'wpli' [default: all]
+    pairs      -- (numpy.ndarray) (npairs x 2) channel pairs, see `select_pairs`
+                  [default: None, all pairs]
+    block      -- (int) channels per block, the memory bound is
+                  block x freq x trials x tblock complex values per block
+                  [default: 16]
+    tblock     -- (int) time samples per block [default: 1000]
+    out        -- (dict) {method: (npairs x freq x time) array-like} output,
+                  e.g. h5py datasets [default: None, new arrays]
+    precision  -- (str) 'single' or 'double', see `EEGAnalysis.precision`
+                  [default: None, the precision of `dwtresults`]
+
+    Return:
+    pairs      -- (numpy.ndarray) (npairs x 2) channel pairs
+    result     -- (dict) {method: (npairs x freq x time) connectivity}
+    """
+
+    method = (method,) if isinstance(method, str) else tuple(method)
+    for item in method:
+        if item not in METHODS:
+            raise ValueError("unknown `method` value: %s"%item)
+
+    nchannel, nfreq, _, ntime = np.shape(dwtresults)
+    pairs = select_pairs(nchannel) if pairs is None else np.asarray(pairs)
+    _dtype = as_complex(np.zeros(1, dtype=np.asarray(dwtresults[:1, :1, :1, :1]).dtype), precision).real.dtype
+    if out is None:
+        out = dict([(item, np.zeros((len(pairs), nfreq, ntime), dtype=_dtype)) for item in method])
+
+    # group the pairs by channel block, so every block pair is read once
+    _blocks = pairs // block
+    _order = np.lexsort((_blocks[:, 1], _blocks[:, 0]))
+    _keys, _start = np.unique(_blocks[_order], axis=0, return_index=True)
+    _groups = np.split(_order, _start[1:])
+
+    for t0 in range(0, ntime, tblock):
+        t1 = min(t0 + tblock, ntime)
+        _cache = {}
+
+        def _read(b):
+            # (freq x time x channels x trials), the unit phase vectors and the power
+            if b not in _cache:
+                _x = as_complex(dwtresults[b*block:(b+1)*block, :, :, t0:t1], precision)
+                _x = np.ascontiguousarray(np.transpose(_x, (1, 3, 0, 2)))
+                _abs = np.abs(_x)
+                _cache[b] = (_x, _x / _abs, np.mean(_abs ** 2, -1))
+            return _cache[b]
+
+        for (bi, bj), _index in zip(_keys, _groups):
+            for key in [item for item in _cache if item not in (bi, bj)]:
+                del _cache[key]  # keep at most two channel blocks in memory
+            (_xi, _ui, _pi), (_xj, _uj, _pj) = _read(bi), _read(bj)
+            _i = pairs[_index, 0] - bi * block
+            _j = pairs[_index, 1] - bj * block
+            _ntrial = np.size(_xi, -1)
+
+            # (freq x time x block_i x block_j) cross spectra
+            if 'coh' in method or 'wpli' in method:
+                _cross = np.matmul(_xi, np.conj(np.swapaxes(_xj, -1, -2))) / _ntrial
+            if 'coh' in method:
+                _coh = np.abs(_cross[:, :, _i, _j]) / np.sqrt(_pi[:, :, _i] * _pj[:, :, _j])
+                out['coh'][_index, :, t0:t1] = np.transpose(_coh, (2, 0, 1))
+            if 'plv' in method:
+                _plv = np.abs(np.matmul(_ui, np.conj(np.swapaxes(_uj, -1, -2))) / _ntrial)
+                out['plv'][_index, :, t0:t1] = np.transpose(_plv[:, :, _i, _j], (2, 0, 1))
+            if 'wpli' in method:
+                # mean |Im(xi xj*)| is not bilinear, the products of `block` pairs
+                # at a time are broadcast, within the memory bound of a channel block
+                _abs_imag = np.zeros((nfreq, t1 - t0, len(_index)), dtype=_dtype)
+                for k in range(0, len(_index), block):
+                    _k = slice(k, k + block)
+                    _abs_imag[:, :, _k] = np.mean(np.abs(np.imag(_xi[:, :, _i[_k]] * np.conj(_xj[:, :, _j[_k]]))), -1)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    _wpli = np.abs(np.imag(_cross[:, :, _i, _j])) / _abs_imag
+                out['wpli'][_index, :, t0:t1] = np.transpose(np.nan_to_num(_wpli), (2, 0, 1))
+
+    return pairs, out
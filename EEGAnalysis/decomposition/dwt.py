@@ -7,6 +7,10 @@ last update: Oct 3 2018
 """
 
 import numpy as np
+from scipy import fft as sp_fft
+
+from ..profiling import instrument
+from ..precision import float_dtype, complex_dtype
 
 ## wavelet
 def morlet(F, fs):
@@ -18,10 +22,11 @@ def morlet(F, fs):
 
 
 ## wavelet tranform
-def dwt(data, fs, frange, wavelet=morlet, reflection=False):
+@instrument('dwt')
+def dwt(data, fs, frange, wavelet=morlet, reflection=False, unit=1, precision=None):
     """wavelet tranform decomposition.
 
-    Syntax: Dwt = dwt(data, fs, frange, wavelet, reflection)
+    Syntax: Dwt = dwt(data, fs, frange, wavelet, reflection, unit, precision)
 
     Keyword arguments:
     data       -- (numpy.ndarray) 1D or 2D array. for 2D array, columns as
@@ -31,14 +36,25 @@ def dwt(data, fs, frange, wavelet=morlet, reflection=False):
     wavelet    -- (function) wavelet function [default: morlet]
     reflection -- (bool) perform data reflection, to compensate the edge effect
                   [default: False]
+    unit       -- (float) physical unit of the data, e.g. the `unit` of isplit
+                  int16 data. applied to the wavelet spectrum, so the data is
+                  never scaled [default: 1]
+    precision  -- (str) 'single' or 'double', see `EEGAnalysis.precision`
+                  [default: None, the global precision]
 
     Return:
-    Dwt        -- (numpy.ndarray, dtype="complex") wavelet decomposition result
+    Dwt        -- (numpy.ndarray, dtype="complex") wavelet decomposition result,
+                  complex64 in single precision
 
     """
 
+    _float, _complex = float_dtype(precision), complex_dtype(precision)
+    _fft = np.fft if _complex == np.complex128 else sp_fft  # numpy fft always computes in double
+
     if np.ndim(data) == 1:
         data = np.reshape(data, (1, len(data)))
+    if _float == np.float32:
+        data = np.asarray(data, dtype=_float)
 
     if reflection:
         data_flip = np.fliplr(data)
@@ -47,13 +63,15 @@ def dwt(data, fs, frange, wavelet=morlet, reflection=False):
         data_fft = data
 
     nConv = np.size(data_fft, -1) + int(2*fs)
-    fft_data = np.fft.fft(data_fft, nConv)
+    fft_data = _fft.fft(data_fft, nConv)
 
-    Dwt = np.zeros((np.size(frange), np.size(data, 0), np.size(data, 1)), dtype="complex")
+    Dwt = np.zeros((np.size(frange), np.size(data, 0), np.size(data, 1)), dtype=_complex)
 
     for idx, F in enumerate(frange):
-        fft_wavelet = np.fft.fft(wavelet(F, fs), nConv)
-        conv_wave = np.fft.ifft(fft_wavelet * fft_data, nConv)
+        fft_wavelet = _fft.fft(wavelet(F, fs).astype(_complex), nConv)
+        if unit != 1:
+            fft_wavelet *= unit
+        conv_wave = _fft.ifft(fft_wavelet * fft_data, nConv)
         conv_wave = conv_wave[:, fs:-fs]
 
         if reflection:
@@ -62,3 +80,50 @@ def dwt(data, fs, frange, wavelet=morlet, reflection=False):
             Dwt[idx, :, :] = conv_wave
 
     return Dwt
+
+
+## out-of-core wavelet transform
+@instrument('dwt_stream')
+def dwt_stream(read, nsample, fs, frange, out, block=None, wavelet=morlet, unit=1, precision='single'):
+    """block-streaming wavelet power of a long 1D signal.
+
+    the signal is read in blocks with margins of half the longest wavelet on
+    both sides, each block is transformed by `dwt` and the margins are cut,
+    so the stitched power is identical to `dwt` (without reflection) of the
+    whole signal, at the memory cost of one block.
+
+    Syntax: dwt_stream(read, nsample, fs, frange, out, block, wavelet, unit, precision)
+
+    Keyword arguments:
+    read      -- (function) read(start, stop) returns the samples [start, stop)
+    nsample   -- (int) length of the signal
+    fs        -- (int) sampling rate
+    frange    -- (numpy.ndarray) target frequencies
+    out       -- (array-like) (nfreq, nsample) output, e.g. an h5py dataset or
+                 a numpy.memmap, written block by block
+    block     -- (int) samples per block [default: None, 60 seconds]
+    wavelet   -- (function) wavelet function [default: morlet]
+    unit      -- (float) physical unit of the samples [default: 1]
+    precision -- (str) 'single' or 'double' [default: 'single']
+
+    Return:
+    out       -- the output array
+    """
+
+    fs = int(fs)
+    block = int(60 * fs) if block is None else int(block)
+    margin = max([int(np.ceil(len(wavelet(F, fs)) / 2)) for F in frange])
+
+    for start in range(0, nsample, block):
+        stop = min(start + block, nsample)
+        _start, _stop = max(start - margin, 0), min(stop + margin, nsample)
+
+        # zeros beyond the edges, as the zero padding of the whole signal fft
+        _segment = np.zeros(stop - start + 2 * margin, dtype=float_dtype(precision))
+        _offset = _start - (start - margin)
+        _segment[_offset:_offset + _stop - _start] = read(_start, _stop)
+
+        _dwt = dwt(_segment, fs, frange, wavelet=wavelet, unit=unit, precision=precision)[:, 0, margin:margin + stop - start]
+        out[:, start:stop] = (_dwt.real ** 2 + _dwt.imag ** 2).astype(out.dtype, copy=False)
+
+    return out
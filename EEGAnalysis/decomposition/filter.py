@@ -38,4 +38,54 @@ def gaussian_kernel(fs, sigma):
 def gaussianwind(data, fs, sigma):
     k = gaussian_kernel(fs, sigma)
     totalpwr_filter = np.convolve(data, k)
-    return totalpwr_filter[fs:-fs+1]
\ No newline at end of file
+    return totalpwr_filter[fs:-fs+1]
+
+
+def resample_ratio(fs, freq, limit=1000):
+    """up/down factors of the polyphase resampling from `fs` to `freq`"""
+    from fractions import Fraction
+    _ratio = Fraction(float(freq) / float(fs)).limit_denominator(limit)
+    return _ratio.numerator, _ratio.denominator
+
+def resample_stream(read, nsample, fs, freq, write, block=None, window=('kaiser', 5.0)):
+    """block-streaming anti-aliased polyphase resampling of a long 1D signal.
+
+    the signal is read in blocks with margins of the half filter length on
+    both sides, aligned to the decimation factor, each block is resampled by
+    `scipy.signal.resample_poly` and the margins are cut, so the stitched
+    result is identical to `resample_poly` of the whole signal, at the
+    memory cost of one block.
+
+    Syntax: nout = resample_stream(read, nsample, fs, freq, write, block, window)
+
+    Keyword arguments:
+    read    -- (function) read(start, stop) returns the samples [start, stop)
+    nsample -- (int) length of the signal
+    fs      -- (float) sampling rate of the signal
+    freq    -- (float) target sampling rate
+    write   -- (function) write(start, data), the resampled samples from `start`
+    block   -- (int) input samples per block [default: None, 60 seconds]
+    window  -- anti-aliasing FIR window, see `scipy.signal.resample_poly`
+               [default: ('kaiser', 5.0)]
+
+    Return:
+    nout    -- (int) length of the resampled signal, ceil(nsample * up / down)
+    """
+    up, down = resample_ratio(fs, freq)
+    nout = -(-nsample * up // down)
+    block = int(60 * fs) if block is None else int(block)
+    block = max(block // down, 1) * down
+    # half filter length of resample_poly, in input samples, aligned to `down`
+    margin = -(-(10 * max(up, down) // up + 2) // down) * down
+
+    for start in range(0, nsample, block):
+        stop = min(start + block, nsample)
+        _start, _stop = max(start - margin, 0), min(stop + margin, nsample)
+        _resampled = signal.resample_poly(np.asarray(read(_start, _stop), dtype='float64'), up, down, window=window)
+
+        _first = start * up // down
+        _last = min(-(-stop * up // down), nout)
+        _offset = (start - _start) * up // down
+        write(_first, _resampled[_offset:_offset + _last - _first])
+
+    return nout
@@ -6,28 +6,148 @@ email: yzmiao@protonmail.com
 last update: Oct 1 2018
 """
 
+from functools import lru_cache
+
 import numpy as np
 
+from ..profiling import instrument
+from ..precision import as_complex
+
 
-def dwt_itpc(dwtresult, itpcz=False, weights=None):
+@instrument('dwt_itpc')
+def dwt_itpc(dwtresult, itpcz=False, weights=None, precision=None, n_perm=1000, batch=50, seed=None):
     """Calculate the inter-trial phase clustering from the dwt result
 
-    Syntax: ITPC = dwt_itpc(dwtresult, zscore, weights)
+    with `weights`, the weighted ITPC (wITPC) |mean(w * exp(i*phase))| is
+    computed, e.g. weighted by the reaction time of every trial. wITPCz is
+    the wITPC z-scored against the wITPC of `n_perm` shuffles of the
+    weights over trials, computed in batches of `batch` shuffles.
+
+    Syntax: ITPC = dwt_itpc(dwtresult, itpcz, weights, precision, n_perm, batch, seed)
 
     Keyword arguments:
     dwtresult -- (numpy.ndarray, dtype="complex") 3D complex array from dwt function
-    itpcz     -- (bool) flag for ITPCz analysis [default: False]
-    weights   -- (numpy.ndarray) weights for wITPCz analysis [default: None] #TODO
+    itpcz     -- (bool) flag for ITPCz analysis, or wITPCz with `weights`
+                 [default: False]
+    weights   -- (numpy.ndarray) (trials,) or (freq x trials) weights for
+                 wITPC/wITPCz analysis [default: None]
+    precision -- (str) 'single' or 'double', see `EEGAnalysis.precision`
+                 [default: None, the precision of `dwtresult`]
+    n_perm    -- (int) weight shuffles of wITPCz [default: 1000]
+    batch     -- (int) weight shuffles per pass [default: 50]
+    seed      -- (int) random seed of the shuffles [default: None]
 
     Return:
     ITPC -- (numpy.ndarray) iter-trial pahse clustering result
     """
+    dwtresult = as_complex(dwtresult, precision)
     unit = dwtresult / np.abs(dwtresult)
-    ITPC = np.abs(np.sum(unit, 1) / np.size(dwtresult, 1))
+    ntrial = np.size(dwtresult, 1)
+
+    if weights is not None:
+        weights = np.reshape(weights, (-1, ntrial)).astype(unit.real.dtype)
+        wITPC = np.abs(np.einsum('fn,fnt->ft', np.broadcast_to(weights, unit.shape[:2]), unit)) / ntrial
+        if itpcz != True:
+            return wITPC
+
+        # running mean/variance of the shuffled wITPC, one einsum per batch
+        rng = np.random.default_rng(seed)
+        _mean = np.zeros(wITPC.shape)
+        _m2 = np.zeros(wITPC.shape)
+        _count = 0
+        for start in range(0, n_perm, batch):
+            _n = min(batch, n_perm - start)
+            _perm = np.argsort(rng.random((_n, ntrial)), axis=1)
+            _weights = np.broadcast_to(weights[:, _perm], (np.size(unit, 0), _n, ntrial))
+            _null = np.abs(np.einsum('fbn,fnt->bft', _weights, unit)) / ntrial
+            _count += _n
+            _delta = _null - _mean
+            _mean += np.sum(_delta, 0) / _count
+            _m2 += np.sum(_delta * (_null - _mean), 0)
+        return ((wITPC - _mean) / np.sqrt(_m2 / _count)).astype(wITPC.dtype)
+
+    ITPC = np.abs(np.sum(unit, 1) / ntrial)
     
     if itpcz == True:
-        result = ITPC**2 * np.size(dwtresult, 1)
+        result = ITPC**2 * ntrial
     else:
         result = ITPC
     
     return result
+
+
+def rayleigh_pvalue(itpc, ntrial):
+    """analytic p-value of ITPC under uniformly distributed phases
+
+    Rayleigh test, with the approximation of Zar (Biostatistical Analysis):
+    p = exp(sqrt(1 + 4n + 4(n^2 - R^2)) - (1 + 2n)), R = n * ITPC.
+
+    Syntax: p = rayleigh_pvalue(itpc, ntrial)
+
+    Keyword arguments:
+    itpc   -- (numpy.ndarray) ITPC result of dwt_itpc
+    ntrial -- (int) number of trials
+
+    Return:
+    p      -- (numpy.ndarray) p-values
+    """
+    _R = ntrial * np.asarray(itpc, dtype='float64')
+    _p = np.exp(np.sqrt(1 + 4*ntrial + 4*(ntrial**2 - _R**2)) - (1 + 2*ntrial))
+    return np.clip(_p, 0, 1)
+
+
+@lru_cache(maxsize=256)
+def _itpc_null(ntrial, nsim, seed):
+    rng = np.random.default_rng(seed)
+    _chunk = max(1, 2**22 // ntrial)  # bound the random phases to ~64 MB
+    _null = []
+    for start in range(0, nsim, _chunk):
+        _phase = rng.random((min(_chunk, nsim - start), ntrial)) * 2 * np.pi
+        _null.append(np.abs(np.mean(np.exp(1j * _phase), 1)))
+    _null = np.sort(np.hstack(_null))
+    _null.flags.writeable = False
+    return _null
+
+
+def itpc_null(ntrial, nsim=10000, seed=0):
+    """empirical null distribution of ITPC under uniformly distributed phases
+
+    simulated once per (ntrial, nsim, seed), in vectorized chunks, and
+    cached for the process.
+
+    Syntax: null = itpc_null(ntrial, nsim, seed)
+
+    Keyword arguments:
+    ntrial -- (int) number of trials
+    nsim   -- (int) number of simulated ITPC values [default: 10000]
+    seed   -- (int) random seed [default: 0]
+
+    Return:
+    null   -- (numpy.ndarray) sorted (nsim,) ITPC values, read-only
+    """
+    return _itpc_null(int(ntrial), int(nsim), seed)
+
+
+def itpc_pvalue(itpc, ntrial, method='rayleigh', nsim=10000):
+    """p-value of ITPC under uniformly distributed phases
+
+    Syntax: p = itpc_pvalue(itpc, ntrial, method, nsim)
+
+    Keyword arguments:
+    itpc   -- (numpy.ndarray) ITPC result of dwt_itpc
+    ntrial -- (int) number of trials
+    method -- (str) 'rayleigh' for the analytic p-value, 'empirical' for the
+              cached null table of `itpc_null` [default: 'rayleigh']
+    nsim   -- (int) size of the empirical null table [default: 10000]
+
+    Return:
+    p      -- (numpy.ndarray) p-values
+    """
+    if method == 'rayleigh':
+        return rayleigh_pvalue(itpc, ntrial)
+    elif method == 'empirical':
+        _null = itpc_null(ntrial, nsim)
+        _count = nsim - np.searchsorted(_null, itpc, side='left')
+        return (_count + 1) / (nsim + 1)
+    else:
+        raise ValueError("unknown `method` value.")
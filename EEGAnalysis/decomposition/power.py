@@ -8,7 +8,11 @@ last update: Oct 1 2018
 
 import numpy as np
 
-def dwt_power(dwtresult, fs,  zscore=True, baseline=None):
+from ..profiling import instrument
+from ..precision import as_complex
+
+@instrument('dwt_power')
+def dwt_power(dwtresult, fs,  zscore=True, baseline=None, precision=None):
     """calcuate the total power from the result of dwt
 
     Syntax: Pxx = dwt_power(dwtresult, zscore, dbcalibration)
@@ -21,11 +25,15 @@ def dwt_power(dwtresult, fs,  zscore=True, baseline=None):
     baseline  -- (tuple(float, float)) normalize the db result
                  by baseline normalization
                  [default: None]
+    precision -- (str) 'single' or 'double', see `EEGAnalysis.precision`
+                 [default: None, the precision of `dwtresult`]
 
     Return:
-    Pxx       -- (numpy.ndarray) total power
+    Pxx       -- (numpy.ndarray) total power, float32 in single precision
     """
 
+    dwtresult = as_complex(dwtresult, precision)
+
     # generate power and averaged across trials (axis 1)
     raw_pxx = np.mean(np.abs(dwtresult) ** 2.0, 1)
     
@@ -48,3 +56,77 @@ def dwt_power(dwtresult, fs,  zscore=True, baseline=None):
         Pxx = np.log10(raw_pxx)
 
     return Pxx
+
+
+def broadband_power(epochs, fs, smooth=0.05):
+    """event-locked broadband power of epoched data
+
+    the power of the first difference of the signal, i.e. whitened broadband
+    power, smoothed by a boxcar and averaged across trials.
+
+    Syntax: Pbb = broadband_power(epochs, fs, smooth)
+
+    Keyword arguments:
+    epochs -- (numpy.ndarray) (..., trials, time) epoched data
+    fs     -- (int) sampling rate
+    smooth -- (float) width of the boxcar, in seconds [default: 0.05]
+
+    Return:
+    Pbb    -- (numpy.ndarray) (..., time) trial averaged power
+    """
+
+    _pwr = np.mean(np.diff(epochs, axis=-1) ** 2, axis=-2)
+    _pwr = np.concatenate((_pwr[..., :1], _pwr), axis=-1)
+
+    # centered boxcar by cumulative sum, edges padded with the edge values
+    _width = max(int(smooth * fs), 1)
+    _pad = ((0, 0),) * (np.ndim(_pwr) - 1) + ((_width // 2 + 1, _width - 1 - _width // 2),)
+    _csum = np.cumsum(np.pad(_pwr, _pad, mode='edge'), axis=-1)
+    return (_csum[..., _width:] - _csum[..., :-_width]) / _width
+
+
+def estimate_mbias(epochs, fs, roi, lags, smooth=0.05, window=0.2):
+    """estimate the marker bias from the onset of the broadband response
+
+    the broadband power of each channel is z-scored and averaged across
+    channels, then correlated, within `window` seconds around every candidate
+    lag, with a step function at that lag. the lag with the highest
+    correlation is the marker bias, i.e. the response starts at
+    `marker + mbias`.
+
+    Syntax: (mbias, confidence, r) = estimate_mbias(epochs, fs, roi, lags, smooth, window)
+
+    Keyword arguments:
+    epochs -- (numpy.ndarray) (channels, trials, time) epoched data
+    fs     -- (int) sampling rate
+    roi    -- (tuple(float, float)) time range of the epochs, relative to the markers
+    lags   -- (numpy.ndarray) candidate marker biases, in seconds, inside `roi`
+    smooth -- (float) width of the power smoothing boxcar, in seconds [default: 0.05]
+    window -- (float) half width of the step template, in seconds [default: 0.2]
+
+    Return:
+    mbias      -- (float) the estimated marker bias
+    confidence -- (float) correlation coefficient at `mbias`, in [-1, 1]
+    r          -- (numpy.ndarray) correlation coefficient of every lag
+    """
+
+    _pwr = broadband_power(epochs, fs, smooth=smooth)
+    _pwr = (_pwr - np.mean(_pwr, -1, keepdims=True)) / (np.std(_pwr, -1, keepdims=True) + 1e-12)
+    _trace = np.mean(_pwr, 0).astype('float64')
+
+    # the step and the window masks of all lags, as (lags, time) matrices
+    _tspec = roi[0] + np.arange(np.size(_trace)) / fs
+    _delta = _tspec[np.newaxis, :] - np.reshape(lags, (-1, 1))
+    _mask = (np.abs(_delta) < window).astype('float64')
+    _step = _mask * (_delta >= 0)
+
+    # pearson correlation of the trace and the step, inside the window
+    _n = np.sum(_mask, 1)
+    _sx = np.dot(_mask, _trace)
+    _sxx = np.dot(_mask, _trace ** 2)
+    _sy = np.sum(_step, 1)
+    _sxy = np.dot(_step, _trace)
+    r = (_n * _sxy - _sx * _sy) / (np.sqrt(np.abs((_n * _sxx - _sx ** 2) * (_n * _sy - _sy ** 2))) + 1e-12)
+
+    _best = int(np.argmax(r))
+    return float(lags[_best]), float(r[_best]), r
@@ -9,6 +9,8 @@ last update: Oct 1 2018
 import numpy as np
 # from numpy import jit  #TODO: numba acceleration
 
+from ..profiling import instrument
+
 ## Taper
 def han(timepoints):
     """Han Taper function. i.e. shifted half cosine."""
@@ -16,6 +18,7 @@ def han(timepoints):
 
 
 ## stfft
+@instrument('stfft')
 def stfft(data, nwindow, noverlap, fs, taper=han, rho=2):
     """Perform short time fast fourier transformation
 
@@ -42,12 +45,12 @@ def stfft(data, nwindow, noverlap, fs, taper=han, rho=2):
     nstep = (np.size(data, -1) - nwindow) // step
 
     Tspec = np.linspace(start, step * nstep, nstep) / fs
-    Stfft = np.zeros((np.size(data, 0), rho * 500, nstep))
+    Stfft = np.zeros((np.size(data, 0), int(rho * fs), nstep), dtype="complex")
 
     taperl = taper(nwindow)
     for idx in range(nstep):
         temp = data[(slice(None), slice(idx*step, idx*step+nwindow))] * taperl
-        entry = np.fft.fft(temp, n=rho*fs)
+        entry = np.fft.fft(temp, n=int(rho*fs))
         Stfft[(slice(None), slice(None), idx)] = entry
 
     return Stfft, Tspec
@@ -3,6 +3,9 @@ import numpy as np
 import os
 import h5py
 
+from scipy import sparse
+from scipy.spatial import cKDTree
+
 
 def _mni2tal(mni):
     
@@ -28,6 +31,182 @@ def _mni2tal(mni):
     return inpoints[:3, :].T
 
 
+class ContactTable(object):
+    '''
+    all contacts of a patient in one contiguous (n x 3) coordinate array,
+    with a KD-tree index, the shank of every contact and the iSplit channel
+    index (`Channel%03d` - 1) of every contact.
+
+    rows follow the channel order of `Electrodes.export_csv`, i.e. row i is
+    `chn` i + 1. re-referencing matrices are (n x n) sparse matrices, applied
+    to (n x time) blocks of the same row order as one sparse matrix product.
+
+    arguments:
+    - coord: (n x 3) contact coordinates (mm)
+    - shanks: (n,) shank name of every contact
+
+    keyword arguments:
+    - chidx: (n,) iSplit channel index of every contact [default: 0 ... n-1]
+    - white_matter: (n,) bool, contacts in the white matter [default: None]
+    '''
+
+    def __init__(self, coord, shanks, chidx=None, white_matter=None):
+        self.coord = np.ascontiguousarray(coord, dtype='float64').reshape((-1, 3))
+        self.shank = np.asarray(shanks)
+        self.chidx = np.arange(len(self.coord)) if chidx is None else np.asarray(chidx, dtype='int')
+        self.white_matter = None if white_matter is None else np.asarray(white_matter, dtype='bool')
+        if len(self.shank) != len(self.coord) or len(self.chidx) != len(self.coord):
+            raise ValueError("`shanks` and `chidx` must have one entry per contact.")
+
+        self.tree = cKDTree(self.coord)
+        self._row = dict(zip(self.chidx.tolist(), range(len(self.chidx))))
+
+    def __len__(self):
+        return len(self.coord)
+
+    def rows(self, chidx):
+        '''
+        rows of the contacts of iSplit channel indices.
+        '''
+        return np.array([self._row[item] for item in np.atleast_1d(chidx)], dtype='int')
+
+    def within(self, points, radius):
+        '''
+        contacts within `radius` mm of every point.
+
+        arguments:
+        - points: (m x 3) coordinates, or (m,) int contact rows
+
+        return:
+        - list of m arrays of contact rows
+        '''
+        return [np.asarray(item, dtype='int') for item in self.tree.query_ball_point(self._points(points), radius)]
+
+    def nearest(self, points, k=1, mask=None, exclude_self=False):
+        '''
+        k nearest contacts of every point.
+
+        arguments:
+        - points: (m x 3) coordinates, or (m,) int contact rows
+
+        keyword arguments:
+        - k: number of neighbors [default: 1]
+        - mask: (n,) bool, search only these contacts [default: None, all]
+        - exclude_self: skip the contact itself when `points` are rows [default: False]
+
+        return:
+        - distance, rows: (m x k) arrays, inf / n where there are fewer than k contacts
+        '''
+        _points = self._points(points)
+        _rows = np.arange(len(self)) if mask is None else np.where(mask)[0]
+        _tree = self.tree if mask is None else cKDTree(self.coord[_rows])
+
+        _self = exclude_self and np.asarray(points).ndim == 1
+        _k = min(k + int(_self), len(_rows))
+        _dist, _index = _tree.query(_points, k=max(_k, 1))
+        _dist, _index = _dist.reshape((len(_points), -1)), _index.reshape((len(_points), -1))
+        _found = _index < len(_rows)
+        _found_rows = np.full(_index.shape, len(self))
+        _found_rows[_found] = _rows[_index[_found]]
+
+        if _self:
+            # move the query contact to the end, as not found
+            _drop = _found_rows == np.asarray(points).reshape((-1, 1))
+            _order = np.argsort(_drop, axis=1, kind='stable')
+            _dist = np.where(_drop, np.inf, _dist)
+            _found_rows = np.where(_drop, len(self), _found_rows)
+            _dist = np.take_along_axis(_dist, _order, axis=1)
+            _found_rows = np.take_along_axis(_found_rows, _order, axis=1)
+
+        distance = np.full((len(_points), k), np.inf)
+        rows = np.full((len(_points), k), len(self))
+        distance[:, :np.size(_dist, 1)] = _dist[:, :k]
+        rows[:, :np.size(_found_rows, 1)] = _found_rows[:, :k]
+        return distance, rows
+
+    def laplacian(self, radius=None, k=None, within_shank=True):
+        '''
+        local Laplacian re-reference, every contact minus the mean of its
+        neighbors within `radius` mm or its `k` nearest neighbors.
+
+        keyword arguments:
+        - within_shank: neighbors on the same shank only [default: True]
+
+        return:
+        - (n x n) scipy.sparse.csr_matrix; contacts without neighbors are kept as is
+        '''
+        _n = len(self)
+        if radius is not None:
+            _pairs = self.tree.query_pairs(radius, output_type='ndarray')
+            _i = np.concatenate((_pairs[:, 0], _pairs[:, 1]))
+            _j = np.concatenate((_pairs[:, 1], _pairs[:, 0]))
+        elif k is not None:
+            _i, _j = [], []
+            for _shank in (np.unique(self.shank) if within_shank else [None]):
+                _mask = None if _shank is None else self.shank == _shank
+                _query = np.arange(_n) if _mask is None else np.where(_mask)[0]
+                _, _rows = self.nearest(_query, k=k, mask=_mask, exclude_self=True)
+                _found = _rows < _n
+                _i.append(np.repeat(_query, k).reshape((-1, k))[_found])
+                _j.append(_rows[_found])
+            _i, _j = np.concatenate(_i), np.concatenate(_j)
+        else:
+            raise ValueError("one of `radius` and `k` is required.")
+
+        if within_shank:
+            _keep = self.shank[_i] == self.shank[_j]
+            _i, _j = _i[_keep], _j[_keep]
+
+        _count = np.bincount(_i, minlength=_n)
+        _weight = -1.0 / _count[_i]
+        _neighbors = sparse.csr_matrix((_weight, (_i, _j)), shape=(_n, _n))
+        return (sparse.identity(_n, format='csr') + _neighbors).tocsr()
+
+    def white_matter_reference(self, white_matter=None, within_shank=True):
+        '''
+        re-reference every contact to its nearest white matter contact
+        (other than itself).
+
+        keyword arguments:
+        - white_matter: (n,) bool, white matter contacts [default: `self.white_matter`]
+        - within_shank: reference contacts on the same shank only [default: True]
+
+        return:
+        - (n x n) scipy.sparse.csr_matrix; contacts without a reference are kept as is
+        '''
+        white_matter = self.white_matter if white_matter is None else np.asarray(white_matter, dtype='bool')
+        if white_matter is None:
+            raise ValueError("`white_matter` is required, e.g. from `Electrodes.contact_table(labels=...)`.")
+
+        _n = len(self)
+        _reference = np.full(_n, _n)
+        for _shank in (np.unique(self.shank) if within_shank else [None]):
+            _on_shank = np.ones(_n, dtype='bool') if _shank is None else self.shank == _shank
+            _query = np.where(_on_shank)[0]
+            if not np.any(white_matter & _on_shank):
+                continue
+            _, _rows = self.nearest(_query, k=1, mask=white_matter & _on_shank, exclude_self=True)
+            _reference[_query] = _rows[:, 0]
+
+        _i = np.where(_reference < _n)[0]
+        _reference_matrix = sparse.csr_matrix((-np.ones(len(_i)), (_i, _reference[_i])), shape=(_n, _n))
+        return (sparse.identity(_n, format='csr') + _reference_matrix).tocsr()
+
+    @staticmethod
+    def apply(matrix, block):
+        '''
+        re-reference a (n x ...) block, rows in the contact order.
+        '''
+        _block = np.asarray(block)
+        return matrix.dot(_block.reshape((len(_block), -1))).reshape(_block.shape)
+
+    def _points(self, points):
+        points = np.asarray(points)
+        if points.ndim == 1 and np.issubdtype(points.dtype, np.integer):
+            return self.coord[points]
+        return np.atleast_2d(points).astype('float64')
+
+
 class Electrodes(object):
     
     def __init__(self, datadir, patient_id, contact_width=2, gap_width=1.5):
@@ -74,7 +253,7 @@ class Electrodes(object):
             _shank_channel_n = int(input('enter total number of channels in shank %s: '%_shank))
             
             _L = np.sqrt(np.sum((_shank_tail_ct - _shank_tip_ct)**2))  # physical length, L
-            _rho = np.array([ ((self._contact_width/2) + (self._contact_width+self._gap_width)*item)/_L for item in range(_shank_channel_n) ]).reshape((-1, 1))
+            _rho = (((self._contact_width/2) + (self._contact_width+self._gap_width)*np.arange(_shank_channel_n))/_L).reshape((-1, 1))
             _MNI =  _rho * (_shank_tail_mni - _shank_tip_mni) + _shank_tip_mni
             
             self.coord[_shank] = _MNI
@@ -131,8 +310,6 @@ class Electrodes(object):
                 _tmp['MNI'] = {'tip':np.array(_f[_shank]['MNI']['tip']), 
                                'tail':np.array(_f[_shank]['MNI']['tail'])}
                 
-                _L = np.sqrt(np.sum((_tmp['CT']['tail'] - _tmp['CT']['tip'])**2))  # physical length, L
-                _rho = np.array([ ((self._contact_width/2) + (self._contact_width+self._gap_width)*item)/_L for item in range(_tmp['n']) ]).reshape((-1, 1))
                 _MNI =  _tmp['rho'] * (_tmp['MNI']['tail'] - _tmp['MNI']['tip']) + _tmp['MNI']['tip']
                 
                 self._shank[_shank] = _tmp
@@ -140,7 +317,38 @@ class Electrodes(object):
     
     def append_new_shank(self):
         pass
+
+    def channel_shanks(self):
+        '''
+        shank name of every channel, in the channel order of `export_csv`,
+        e.g. for `decomposition.connectivity.select_pairs`.
+        '''
+        return [_shank for _shank, _coord in self.coord.items() for _ in range(len(_coord))]
         
+    def contact_table(self, chidx=None, labels=None, white_matter='White Matter', level='Level 4'):
+        '''
+        `ContactTable` of all contacts, in the channel order of `export_csv`.
+
+        keyword arguments:
+        - chidx: dict{shank: (n,) iSplit channel indices} [default: None, chn - 1]
+        - labels: layout sheet of `query` / `label`, or True for `self.tal_labels`,
+                  marks the white matter contacts [default: None]
+        - white_matter, level: white matter label and its column
+                               [default: 'White Matter', 'Level 4']
+        '''
+        _shanks = list(self.coord.keys())
+        _coord = np.concatenate([np.reshape(self.coord[_shank], (-1, 3)) for _shank in _shanks]) if _shanks else np.zeros((0, 3))
+        _shank_names = np.repeat(np.array(_shanks, dtype=object), [len(self.coord[_shank]) for _shank in _shanks])
+        _chidx = None if chidx is None else np.concatenate([np.asarray(chidx[_shank], dtype='int') for _shank in _shanks])
+
+        _white_matter = None
+        if labels is not None:
+            _labels = self.tal_labels if labels is True else labels
+            _labels = _labels.drop_duplicates('chn').set_index('chn')[level]
+            _white_matter = (_labels.reindex(np.arange(1, len(_coord) + 1)) == white_matter).values
+
+        return ContactTable(_coord, _shank_names, chidx=_chidx, white_matter=_white_matter)
+
     def export_csv(self, to=None, filename=None):
         if filename == None:
             filename = self.patient_id + '.csv'
@@ -171,28 +379,7 @@ class Electrodes(object):
             to = self._image_dir
         _tal_path = os.path.join(to, filename)    
             
-        mni = self._sheet[['X', 'Y', 'Z']].values
-    
-        rotn = np.array([[1,0,0,0],
-                         [0,0.9988,0.05,0],
-                         [0,-0.05,0.9988,0],
-                         [0,0,0,1]])
-        upz = np.array([[0.99,0,0,0],
-                        [0,0.97,0,0],
-                        [0,0,0.92,0],
-                        [0,0,0,1]])
-        downz = np.array([[0.99,0,0,0],
-                          [0,0.97,0,0],
-                          [0,0,0.84,0],
-                          [0,0,0,1]])
-
-        inpoints = np.hstack((mni, np.ones((np.size(mni,0), 1)))).T
-        _post = inpoints[2, :] < 0
-
-        inpoints[:,  _post] = np.matmul(np.matmul(rotn, downz),inpoints[:,  _post])
-        inpoints[:, ~_post] = np.matmul(np.matmul(rotn, upz),  inpoints[:, ~_post])
-
-        _tal_coord = inpoints[:3, :].T
+        _tal_coord = _mni2tal(self._sheet[['X', 'Y', 'Z']].values)
         chn = self._sheet['chn'].values
         self._tal = pd.DataFrame(data= {'x':_tal_coord[:, 0], 'y':_tal_coord[:, 1], 'z':_tal_coord[:, 2]}, columns=['x','y','z'])
         
@@ -212,21 +399,59 @@ class Electrodes(object):
 
         os.system('java -cp %s org.talairach.ExcelToTD 3:3,%s'%(taljar, _tal_path))
 
-        self.tal_labels = pd.read_csv(_tal_labels_path, header=-1, sep='\t')    
+        self.tal_labels = pd.read_csv(_tal_labels_path, header=None, sep='\t')    
         self.tal_labels.columns = ['x','y','z','hit','Level 1','Level 2','Level 3','Level 4','Level 5']
 
-        _chn = np.zeros(self.tal_labels.x.values.shape, dtype='int')
-        _chi = 0
-        _previous = [0,0,0]
-
-        for i in range(len(self.tal_labels)):
-            if _previous != list(self.tal_labels.loc[i][['x', 'y', 'z']].values):
-                _chi += 1
-                _previous = list(self.tal_labels.loc[i][['x', 'y', 'z']].values)
-            _chn[i] = _chi
+        # a new channel wherever the coordinate changes from the previous row
+        _xyz = self.tal_labels[['x', 'y', 'z']].values
+        _changed = np.any(np.diff(np.vstack(([[0, 0, 0]], _xyz)), axis=0) != 0, axis=1)
+        _chn = np.cumsum(_changed)
 
         _export_filename = self.patient_id + '_layout.csv'
         self.tal_labels = pd.DataFrame(_chn, columns=['chn']).join(self.tal_labels)
         self.tal_labels.to_csv(os.path.join(_from,_export_filename), index=False)
 
         return self.tal_labels
+
+    def label(self, volume, labels, radius=None, space='tal', to=None):
+        '''
+        label the contacts in-process with a local atlas, see `EEGAnalysis.atlas`,
+        instead of the Talairach Daemon java client of `query`.
+
+        arguments:
+        - volume: path of the atlas label volume (.nii or .nii.gz)
+        - labels: path of the atlas label names (.xml or .txt)
+
+        keyword arguments:
+        - radius: label contacts outside the gray matter by the nearest gray
+                  matter voxel within `radius` mm [default: None, voxel only]
+        - space: 'tal' for Talairach atlases, the contacts are converted by
+                 `_mni2tal`, or 'mni' for MNI atlases [default: 'tal']
+        - to: directory of `<patient_id>_layout.csv` [default: Image directory]
+
+        return:
+        - pandas.DataFrame, the columns of `query`; "hit" is the distance (mm)
+          to the labeled voxel
+        '''
+        from .atlas import load_atlas
+
+        if isinstance(self._sheet, type(None)):
+            self.export_csv()
+
+        if to == None:
+            to = self._image_dir
+
+        _coord = self._sheet[['X', 'Y', 'Z']].values.astype('float64')
+        if space == 'tal':
+            _coord = _mni2tal(_coord)
+        elif space != 'mni':
+            raise ValueError("unknown `space` value.")
+
+        _levels = load_atlas(volume, labels).levels(_coord, radius=radius)
+        self.tal_labels = pd.DataFrame({'chn':self._sheet['chn'].values,
+                                        'x':_coord[:, 0], 'y':_coord[:, 1], 'z':_coord[:, 2]}).join(_levels)
+
+        _export_filename = self.patient_id + '_layout.csv'
+        self.tal_labels.to_csv(os.path.join(to, _export_filename), index=False)
+
+        return self.tal_labels
@@ -0,0 +1,242 @@
+"""
+ingestion bookkeeping
+
+crash-safe records of the import of raw data into isplit files, and the
+single-pass copy/hash of raw files.
+"""
+
+import os
+import json
+import shutil
+from hashlib import sha256
+
+
+def atomic_write(filename, content):
+    '''
+    write text to a file atomically, i.e. write to a temporary file in the
+    same directory, flush it to disk, and rename it over the target.
+    a crash leaves either the old or the new file, never a partial one.
+    '''
+
+    _tmp = '%s.%d.tmp'%(filename, os.getpid())
+    with open(_tmp, 'w') as _f:
+        _f.write(content)
+        _f.flush()
+        os.fsync(_f.fileno())
+    os.replace(_tmp, filename)
+
+
+class IngestJournal(object):
+    '''
+    append-only journal of the isplit ingestion.
+
+    each line is a json record of either a finished (file, channel) pair,
+    `{"file": name, "label": channel_label, "chidx": chidx, "sha256": digest}`,
+    or a finished file, `{"file": name, "done": true, "sha256": raw_digest}`.
+    records are flushed to disk one by one, so the journal always lists the
+    work that was completed before a crash. a truncated last line is ignored.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._channels = {}
+        self._files = {}
+
+        if os.path.isfile(filename):
+            _clean = True
+            with open(filename, 'r') as _f:
+                for line in _f:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        _clean = False  # partially written record
+            if not _clean:
+                self._rewrite()
+
+    def _apply(self, record):
+        if record.get('done', False):
+            self._files[record['file']] = record.get('sha256')
+        else:
+            self._channels[(record['file'], record['label'])] = record
+
+    def _append(self, record):
+        with open(self.filename, 'a') as _f:
+            _f.write(json.dumps(record) + '\n')
+            _f.flush()
+            os.fsync(_f.fileno())
+        self._apply(record)
+
+    def record_channel(self, name, label, chidx, digest):
+        self._append({'file': name, 'label': label, 'chidx': chidx, 'sha256': digest})
+
+    def record_file(self, name, digest=None):
+        self._append({'file': name, 'done': True, 'sha256': digest})
+
+    def has_channel(self, name, label):
+        return (name, label) in self._channels
+
+    def has_file(self, name, digest=None):
+        return name in self._files and self._files[name] == digest
+
+    def known_file(self, name):
+        return name in self._files
+
+    def discard_file(self, name):
+        '''
+        forget the records of a file, e.g. before it is imported again.
+        '''
+
+        self._files.pop(name, None)
+        for key in [key for key in self._channels if key[0] == name]:
+            self._channels.pop(key)
+        self._rewrite()
+
+    def _rewrite(self):
+        _lines = [json.dumps(item) for item in self._channels.values()]
+        _lines += [json.dumps({'file': name, 'done': True, 'sha256': digest})
+                   for name, digest in self._files.items()]
+        atomic_write(self.filename, ''.join([line + '\n' for line in _lines]))
+
+    def channels(self):
+        '''
+        finished (file, channel) records, as a list of dicts.
+        '''
+
+        return list(self._channels.values())
+
+
+_FICLONE = 0x40049409  # linux ioctl, see ioctl_ficlone(2)
+
+
+def _reflink(source, target):
+    import fcntl
+    with open(source, 'rb') as _src, open(target, 'wb') as _dst:
+        fcntl.ioctl(_dst.fileno(), _FICLONE, _src.fileno())
+
+
+def hash_file(filename, bufsize=4*1024*1024):
+    '''
+    sha256 digest of the file content.
+    '''
+
+    _hash = sha256()
+    _buffer = bytearray(bufsize)
+    _view = memoryview(_buffer)
+    with open(filename, 'rb', buffering=0) as _f:
+        while True:
+            _n = _f.readinto(_buffer)
+            if not _n:
+                break
+            _hash.update(_view[:_n])
+    return _hash.hexdigest()
+
+
+def copy_and_hash(source, target, link=None, bufsize=4*1024*1024):
+    '''
+    copy a file and compute the sha256 digest of its content in the same
+    pass, i.e. every byte is read only once.
+
+    arguments:
+    - source: path of the source file
+    - target: path of the target file
+
+    keyword arguments:
+    - link: None, 'hard', 'reflink' or 'auto'. link the target to the source
+            instead of copying when both are on the same filesystem; 'auto'
+            tries reflink, then hard link. falls back to copying if linking
+            fails. [default: None, always copy]
+    - bufsize: size of the read buffer, in bytes
+
+    return:
+    - digest: sha256 hex digest of the content
+    '''
+
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return hash_file(source, bufsize=bufsize)  # e.g. linked by a previous import
+    if os.path.lexists(target):
+        os.remove(target)  # never write through an old link to another file
+
+    if link is not None:
+        for _method in (['reflink', 'hard'] if link == 'auto' else [link]):
+            try:
+                if _method == 'reflink':
+                    _reflink(source, target)
+                elif _method == 'hard':
+                    os.link(source, target)
+                else:
+                    raise ValueError("unknown `link` value.")
+                shutil.copystat(source, target)
+                return hash_file(source, bufsize=bufsize)
+            except OSError:
+                if os.path.lexists(target):
+                    os.remove(target)
+
+    _hash = sha256()
+    _buffer = bytearray(bufsize)
+    _view = memoryview(_buffer)
+    with open(source, 'rb', buffering=0) as _src, open(target, 'wb', buffering=0) as _dst:
+        while True:
+            _n = _src.readinto(_buffer)
+            if not _n:
+                break
+            _hash.update(_view[:_n])
+            _dst.write(_view[:_n])
+    shutil.copystat(source, target)
+    return _hash.hexdigest()
+
+
+def import_raw_file(source, store_dir=None, record=None, link=None, overwrite=False):
+    '''
+    import one raw file, skipping the work that is not needed.
+
+    a file with the same size and mtime as in `record` is skipped without
+    being read; a file with a different mtime is copied to a temporary file
+    and hashed in the same pass, and the copy replaces the target only if
+    the digest differs. every file is read once.
+
+    arguments:
+    - source: path of the source file
+
+    keyword arguments:
+    - store_dir: target directory, None to keep the file in place [default: None]
+    - record: the previous rawdata.json entry of the file [default: None]
+    - link: see `copy_and_hash`
+    - overwrite: import the file regardless of the previous record
+
+    return:
+    - the rawdata.json entry of the file, or None if the file was unchanged.
+    '''
+
+    _stat = os.stat(source)
+    _target = source if store_dir is None else os.path.join(store_dir, os.path.basename(source))
+
+    _unchanged = (record is not None and not overwrite
+                  and record.get('size') == _stat.st_size
+                  and os.path.isfile(record.get('file', '')))
+    if _unchanged and record.get('mtime') == _stat.st_mtime:
+        return None
+
+    if _target == source:
+        _digest = hash_file(source)
+    elif _unchanged:
+        # copied and hashed in one pass, the copy is kept only if the content changed
+        _tmp = '%s.%d.tmp'%(_target, os.getpid())
+        try:
+            _digest = copy_and_hash(source, _tmp, link=link)
+            if record.get('sha256') != _digest:
+                os.replace(_tmp, _target)
+        finally:
+            if os.path.lexists(_tmp):
+                os.remove(_tmp)  # unchanged, or a partial copy
+    else:
+        _digest = copy_and_hash(source, _target, link=link)
+
+    if _unchanged and record.get('sha256') == _digest:
+        _entry = dict(record)
+        _entry['mtime'] = _stat.st_mtime
+        return _entry
+
+    return {'file': os.path.abspath(_target),
+            'size': _stat.st_size,
+            'mtime': _stat.st_mtime,
+            'sha256': _digest}
@@ -2,7 +2,26 @@ __all__ = [
     "compactdata", "splitdata"
 ]
 
+import os
+
 from .edfdata import EDFData
+from ..profiling import instrument
+
+@instrument('loadedf')
+def loadedf(filename, expname, preload=True):
+    return EDFData(filename, expname, preload=preload)
+
+@instrument('loadeeg')
+def loadeeg(filename, expname, preload=True):
+    from .eegdata import EEGData
+    return EEGData(filename, expname, preload=preload)
+
+# raw file readers by extension, all with the interface of `EDFData`
+READERS = {'.edf': loadedf, '.eeg': loadeeg}
 
-def loadedf(filename, expname):
-    return EDFData(filename, expname)
+def loadraw(filename, expname, preload=True):
+    """load a raw recording with the reader of its extension, see `READERS`."""
+    _ext = os.path.splitext(filename)[1].lower()
+    if _ext not in READERS:
+        raise ValueError("no reader for %s files: %s"%(_ext, filename))
+    return READERS[_ext](filename, expname, preload=preload)
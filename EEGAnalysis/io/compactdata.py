@@ -7,6 +7,8 @@ last update: Oct 1 2018
 """
 
 import os, re
+from hashlib import sha256
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from scipy.io import loadmat, savemat
 import h5py
 import numpy as np
@@ -17,6 +19,37 @@ def checkcompact(datadir, filename):
     """Check if compact data file exists, return bool."""
     return os.path.isfile(os.path.join(datadir, filename))
 
+def _spike2_title(dataset):
+    """channel title of a Spike2 channel, MATLAB chars as integers."""
+    return np.array(dataset, dtype="uint8").ravel().tobytes().decode("ascii", "ignore").strip("\x00 ")
+
+def _spike2_channels(f):
+    """(channel index, dataset name) of the waveform channels of a Spike2 file."""
+    return [(int(_spike2_title(f[key]["title"])[4:]) - 1, key) for key in f.keys()
+            if key not in ("Memory", "file")]
+
+def derive_markers(cueonset, length):
+    """grating and entrain cue times of a recording.
+
+    Syntax: grating, entrain = derive_markers(cueonset, length)
+
+    Keyword arguments:
+    cueonset -- (np.array) grating cue onsets, in seconds
+    length   -- (float) length of the recording, in seconds
+
+    Return:
+    grating  -- (np.array) the grating cues
+    entrain  -- (np.array) up to two cues after the last grating cue, one
+                inter-trial interval apart, that fit in the recording
+    """
+    cueonset = np.asarray(cueonset, dtype="float64")
+    if len(cueonset) < 2:
+        return cueonset, np.zeros(0)
+    residual = length - cueonset[-1]
+    iti = cueonset[-1] - cueonset[-2]
+    entrain = np.array([cueonset[-1] + i*iti + iti for i in range(max(min(2, int(residual//iti - 1)), 0))])
+    return cueonset, entrain
+
 def createcompact(datadir, patientname, fs, overwrite=False,
                   match_pattern=r"\d{6}-.*?\.mat"):
     """Create compact data from Spike2 exported mat file.
@@ -34,6 +67,8 @@ def createcompact(datadir, patientname, fs, overwrite=False,
     >>> createcompact("../../Data", "subject1", 2000)
 
     >>> createcompact("../../Data", "subject2", 2000, overwrite=True)
+
+    See also: spike2isplit, the headless converter into the isplit store.
     """
 
     _spike2_dir = os.path.join(datadir, patientname, "EEG", "Spike2")
@@ -46,31 +81,109 @@ def createcompact(datadir, patientname, fs, overwrite=False,
             rawfiles.append(item)
 
     print("create compact mat from:\n", rawfiles)
-    input("press enter to start ...")
-    for idx, item in tqdm(enumerate(rawfiles)):
+    for item in tqdm(rawfiles):
         with h5py.File(os.path.join(_spike2_dir, item), "r") as f:
-            times = list(f["Chan__1"]["times"])[0]
-            cueonset = list(f["Memory"]["times"])[0]
-            channels = np.zeros((len(f)-2, len(times)))
-
-            for i in f.keys():
-                if i == "Memory" or i == "file":
-                    continue
+            times = f["Chan__1"]["times"][0, :]
+            cueonset = f["Memory"]["times"][0, :]
+            _channels = _spike2_channels(f)
+            channels = np.zeros((len(_channels), len(times)))
 
-                idx = int(np.array(f[i]["title"], dtype="uint8")[4:].tostring())
-                channels[idx-1, :] = np.array(f[i]["values"])[0,:]
+            for chidx, key in _channels:
+                channels[chidx, :] = f[key]["values"][0, :]
 
-        length = np.size(channels, 1) / fs
-        residual = length - cueonset[-1]
-        iti = cueonset[-1] - cueonset[-2]
-        entrain_cue = [cueonset[-1] + i*iti+iti for i in range(min(2, int(residual//iti-1)))]
+        grating, entrain_cue = derive_markers(cueonset, np.size(channels, 1) / fs)
         savemat(os.path.join(_compact_dir, item), {
             "times": times,
             "channels": channels,
             "markers": {
-                "grating": cueonset,
+                "grating": grating,
                 "entrain": entrain_cue}
             })
 
         if len(entrain_cue) == 0:
             print(item, ": has no valid entrain window!")
+
+def _compact_value(value, dtype):
+    """(value, unit) stored as `dtype`, int16 scaled to the full range."""
+    if np.dtype(dtype).kind != "i":
+        return value.astype(dtype), 1.0
+    _unit = float(np.max(np.abs(value))) / np.iinfo(dtype).max if len(value) > 0 else 0.0
+    _unit = _unit if _unit > 0 else 1.0
+    return np.round(value / _unit).astype(dtype), _unit
+
+def _writeSpike2Channel(f, key, chidx, name, store, fs, dtype, compression_level, pyramid):
+    """read, compact and write one channel of an open Spike2 file, with its
+    summary pyramid. returns (chidx, channel title, sha256 of the stored values)."""
+    from ..storage import summarize
+
+    value, unit = _compact_value(f[key]["values"][0, :], dtype)
+    _sha = sha256(value).hexdigest()
+    store.write(chidx, name, value, unit, fs, compression_level=compression_level)
+    if pyramid:
+        store.write_pyramid(chidx, name, summarize(lambda start, stop: value[start:stop], len(value), pyramid))
+    return chidx, _spike2_title(f[key]["title"]), _sha
+
+def _stepSpike2Isplit(_input):
+    """convert one Spike2 file, channel by channel.
+
+    the channels are written to the store directly when the store allows
+    concurrent writers. otherwise only the channel list and the markers are
+    returned, and the caller reads and writes the channels, one at a time.
+    """
+    sourcefile, store, fs, dtype, compression_level, pyramid = _input
+    name = os.path.splitext(os.path.basename(sourcefile))[0]
+
+    channels = []
+    with h5py.File(sourcefile, "r") as f:
+        cueonset = f["Memory"]["times"][0, :]
+        length = max([f[key]["values"].shape[1] for _, key in _spike2_channels(f)] + [0])
+        for chidx, key in _spike2_channels(f):
+            if store.concurrent:
+                channels.append(_writeSpike2Channel(f, key, chidx, name, store, fs, dtype,
+                                                    compression_level, pyramid))
+            else:
+                channels.append((chidx, key))
+
+    grating, entrain = derive_markers(cueonset, length / fs)
+    return name, channels, grating, entrain
+
+def spike2isplit(sourcefiles, store, fs, dtype="float32", processes=None, compression_level=4,
+                 pyramid=(10, 100, 1000)):
+    """Convert Spike2 exported mat (v7.3) files into an isplit store.
+
+    every channel is read by slicing its hdf5 dataset and written in a
+    compact dtype, with its min/max/RMS summary pyramid. no dense
+    (channels x time) matrix is built and no compact .mat is written.
+    files are converted in parallel if the store allows concurrent writers;
+    otherwise the workers only read the markers, and the channels are
+    written here, one at a time, so every channel file has a single writer.
+
+    Syntax: for name, channels, grating, entrain in spike2isplit(sourcefiles, store, fs): ...
+
+    Keyword arguments:
+    sourcefiles       -- (list) Spike2 exported mat files
+    store             -- (EEGAnalysis.storage.Store) the target store
+    fs                -- (int) sampling rate
+    dtype             -- (str) stored dtype, "float32", or "int16" scaled per
+                         channel and recording [default: "float32"]
+    processes         -- (int) number of worker processes [default: os.cpu_count()]
+    compression_level -- (int) gzip level of the hdf5 store [default: 4]
+    pyramid           -- (tuple) decimation factors of the summary pyramid,
+                         see `storage.summarize`; None to skip [default: (10, 100, 1000)]
+
+    Yields:
+    name     -- (str) the recording name, the file name without extension
+    channels -- (list) (chidx, channel title, sha256 of the stored values)
+    grating  -- (np.array) grating cue times, see `derive_markers`
+    entrain  -- (np.array) entrain cue times
+    """
+    _jobs = dict([(item, (item, store, fs, dtype, compression_level, pyramid)) for item in sourcefiles])
+    with ProcessPoolExecutor(max_workers=processes) as _pool:
+        _futures = dict([(_pool.submit(_stepSpike2Isplit, job), item) for item, job in _jobs.items()])
+        for _future in tqdm(as_completed(_futures), total=len(_futures)):
+            name, channels, grating, entrain = _future.result()
+            if not store.concurrent:
+                with h5py.File(_futures[_future], "r") as f:
+                    channels = [_writeSpike2Channel(f, key, chidx, name, store, fs, dtype, compression_level, pyramid)
+                                for chidx, key in channels]
+            yield name, channels, grating, entrain
@@ -10,7 +10,11 @@ last update: Oct 13 2018
 
 import numpy as np
 import re, os
-from scipy.io import savemat
+
+from ..profiling import record
+
+# bound of the temporary arrays of a read, in bytes
+BLOCK_BYTES = 2 ** 24
 
 def chunk(bdata, size=8, dtype=float):
     if dtype == str:
@@ -19,21 +23,123 @@ def chunk(bdata, size=8, dtype=float):
         return [dtype(bdata[size*idx:size*(idx+1)]) for idx in range(len(bdata)//size)]
 
 
+# one Time-stamped Annotation List: +onset[\x15duration]\x14text\x14[text\x14...]\x00
+_TAL = re.compile(br'([+-]\d+(?:\.\d*)?)(?:\x15(\d+(?:\.\d*)?))?\x14((?:[^\x00]*?\x14)*?)\x00')
+
+
+def parse_tal(buffer):
+    """parse the EDF+ Time-stamped Annotation Lists of the annotation bytes.
+
+    Syntax: onset, duration, text = parse_tal(buffer)
+
+    Keyword arguments:
+    buffer   -- (bytes) the annotation signal bytes of all the records,
+                concatenated
+
+    Return:
+    onset    -- (np.array) onsets, in seconds from the start of the file
+    duration -- (np.array) durations, in seconds, 0 if not given
+    text     -- (list) annotation texts; the empty time-keeping
+                annotations of the records are skipped
+    """
+    onset, duration, text = [], [], []
+    for _match in _TAL.finditer(buffer):
+        for _text in _match.group(3).split(b'\x14'):
+            if len(_text) == 0:
+                continue
+            onset.append(_match.group(1))
+            duration.append(_match.group(2) or b'0')
+            text.append(_text.decode('utf-8', 'replace'))
+    return np.array(onset, dtype='float64'), np.array(duration, dtype='float64'), text
+
+
+class EDFSignals(object):
+    """
+        lazy view of the signals of an edf file, indexed as `data[ch, t0:t1]`.
+
+        records are memory-mapped, and only the requested channels and time
+        range are read. `ch` can be an int, a list of ints or a slice; all
+        the selected channels must share the same number of samples per record.
+    """
+
+    def __init__(self, filename, header_length, recordnum, samples):
+        self.filename = filename
+        self.samples = np.array(samples)
+        self.offsets = np.hstack((0, np.cumsum(self.samples)[:-1]))
+        self._records = np.memmap(filename, dtype='<i2', mode='r', offset=header_length,
+                                  shape=(recordnum, int(np.sum(self.samples))))
+        self.shape = (len(self.samples), recordnum * int(self.samples[0]))
+
+    def read(self, chidx, start=0, stop=None, out=None):
+        """read channels `chidx` (list) from sample `start` to `stop`, returns (n, t) int16.
+
+        `out` is an (n, t) array or a list of n rows to fill instead, e.g.
+        the rows of a preallocated array.
+        """
+        _spr = np.unique(self.samples[chidx])
+        if len(_spr) != 1:
+            raise ValueError("channels with different sampling rates can not be read together.")
+        _spr = int(_spr[0])
+
+        _total = self._records.shape[0] * _spr
+        stop = _total if stop is None else min(stop, _total)
+        start = max(start, 0)
+        _result = np.empty((len(chidx), max(stop - start, 0)), dtype='int16') if out is None else out
+        if stop <= start:
+            return _result
+
+        # records are read in blocks of BLOCK_BYTES, and every channel is
+        # copied from its columns into its row, without full-size temporaries
+        _step = max(1, BLOCK_BYTES // (self._records.shape[1] * 2))
+        _last = -(-stop // _spr)
+        for _r0 in range(start // _spr, _last, _step):
+            _r1 = min(_r0 + _step, _last)
+            _rows = self._records[_r0:_r1]
+            record(read=_rows.nbytes)
+            _lo, _hi = max(start, _r0 * _spr), min(stop, _r1 * _spr)
+            for k, ch in enumerate(chidx):
+                _value = _rows[:, self.offsets[ch]:self.offsets[ch] + _spr].reshape(-1)
+                _result[k][_lo - start:_hi - start] = _value[_lo - _r0*_spr:_hi - _r0*_spr]
+        return _result
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        _ch, _t = key
+
+        if isinstance(_ch, slice):
+            _chidx = list(range(len(self.samples)))[_ch]
+        else:
+            _chidx = np.atleast_1d(_ch).tolist()
+
+        if isinstance(_t, slice) and _t.step in (None, 1):
+            _result = self.read(_chidx, _t.start or 0, _t.stop)
+        else:
+            _result = self.read(_chidx)[:, _t]
+
+        return _result[0] if np.ndim(_ch) == 0 and not isinstance(_ch, slice) else _result
+
+
 class EDFData(object):
     """
         EDF Data manipulation
         
         load edf data by:
             `EDFData(filename, expname)`
+
+        read the header only, with lazy channel-selective data access by:
+            `EDFData(filename, expname, preload=False)`
+            `EDFData.data[chidx, start:stop]`
             
         create splitdata from edf file by:
             `EDFData.splitinto(self, sgchdir, markers=None)`
             markers should be list of lists
     """
 
-    def __init__(self, filename, expname):
+    def __init__(self, filename, expname, preload=True):
         
         self.expname = expname
+        self.filename = filename
         
         with open(filename, 'rb') as f:
             
@@ -68,25 +174,67 @@ class EDFData(object):
                 self.reserved_samples = chunk(f.read(32*self.nchannel).decode('ascii'), size=8, dtype=int)
             except ValueError:
                 self.reserved_samples = [0 for _ in range(self.nchannel)]
-            
-            ## data
-            self.data = np.zeros((self.nchannel, self.recordnum * self.samples[0]), dtype='int16')
-            #self.reserved_data = np.zeros((self.nchannel, self.recordnum * self.reserved_samples[0]), dtype='int16')
-            
-            step = np.sum(self.samples)
-            for ri in range(self.recordnum):
-                record_data = f.read(step * 2)
-                self.data[:, self.samples[0]*(ri):self.samples[0]*(ri+1)] = np.ndarray((self.nchannel, self.samples[0]), buffer=record_data, dtype='int16')
-                
+
+        step = int(np.sum(self.samples))
+        _complete = (os.path.getsize(filename) - self.header_length) // (step * 2)
+        if self.recordnum < 0 or self.recordnum > _complete:
+            self.recordnum = _complete  # unknown (-1) or still being recorded
+
+        with open(filename, 'rb') as f:
+            f.seek(self.header_length + self.recordnum * step * 2)
             self.residual = f.read()  # residual should be empty
-            
-            ## 
-            self.fs = self.samples[0] / self.sampleduration
-            self.tspec = np.linspace(0, np.size(self.data, 1) / self.fs, np.size(self.data, 1))  # timeline
-            self.physical_unit = (np.array(self.physical_max) - np.array(self.physical_min))/(np.array(self.digital_max) - np.array(self.digital_min))
+
+        ## data
+        self.signals = EDFSignals(filename, self.header_length, self.recordnum, self.samples)
+        if preload:
+            self.data = np.zeros((self.nchannel, self.recordnum * self.samples[0]), dtype='int16')
+            _uniform = [idx for idx in range(self.nchannel) if self.samples[idx] == self.samples[0]]
+            self.signals.read(_uniform, out=[self.data[idx] for idx in _uniform])  # filled in place
+        else:
+            self.data = self.signals
+
+        ## 
+        self.fs = self.samples[0] / self.sampleduration
+        self.tspec = np.linspace(0, self.recordnum * self.samples[0] / self.fs, self.recordnum * self.samples[0]) if preload else None  # timeline
+        self.physical_unit = (np.array(self.physical_max) - np.array(self.physical_min))/(np.array(self.digital_max) - np.array(self.digital_min))
+
+    def channel_index(self, labels):
+        """indices of the channels by labels, -1 for missing labels."""
+        _lookup = dict([(item, idx) for idx, item in enumerate(self.channelLabels)])
+        return np.array([_lookup.get(item, -1) for item in labels], dtype='int')
+
+    def events(self):
+        """
+        EDF+ annotations of the "EDF Annotations" signals.
+
+        only the annotation bytes of the records are read, as one
+        memory-mapped column slice, and parsed by one byte-level search.
+
+        return:
+        - pandas.DataFrame with columns "onset" (s), "duration" (s) and "text"
+        """
+        import pandas as pd
+
+        _chidx = [idx for idx, item in enumerate(self.channelLabels) if item == 'EDF Annotations']
+        _buffer = b''
+        if len(_chidx) > 0 and self.recordnum > 0:
+            _step = 2 * int(np.sum(self.samples))
+            _records = np.memmap(self.filename, dtype='uint8', mode='r', offset=self.header_length,
+                                 shape=(self.recordnum, _step))
+            _columns = np.concatenate([np.arange(2 * self.signals.offsets[idx],
+                                                 2 * (self.signals.offsets[idx] + self.samples[idx]))
+                                       for idx in _chidx])
+            _buffer = np.ascontiguousarray(_records[:, _columns]).tobytes()
+            record(read=len(_buffer))
+
+        _onset, _duration, _text = parse_tal(_buffer)
+        return pd.DataFrame({'onset': _onset, 'duration': _duration, 'text': _text},
+                            columns=['onset', 'duration', 'text'])
     
     
     def splitinto(self, sgchdir, markers=None):
+        from scipy.io import savemat
+
         if markers == None:  #no marker???!!!
             markers = [[0] for _ in range(self.nchannel)]
             print("without markers ??")
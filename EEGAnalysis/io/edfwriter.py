@@ -0,0 +1,167 @@
+"""
+*.edf file writing
+
+stream (channel x time) blocks of physical values into an edf file that
+`EDFData` reads back, record by record, with bounded memory.
+"""
+
+import numpy as np
+
+
+def _field(value, size):
+    """ascii header field of `size` bytes."""
+    _text = str(value)
+    if len(_text) > size:
+        raise ValueError("edf header field too long: %r"%_text)
+    return _text.ljust(size).encode('ascii')
+
+
+def _number(value, size=8):
+    """shortest representation of a number that fits in `size` characters."""
+    if float(value) == int(value) and len(str(int(value))) <= size:
+        return str(int(value))
+    for precision in range(size, 0, -1):
+        _text = '%.*g'%(precision, value)
+        if len(_text) <= size:
+            return _text
+    raise ValueError("number does not fit in %d characters: %r"%(size, value))
+
+
+class EDFWriter(object):
+    """
+        streaming EDF writer
+
+        write an edf file block by block:
+            `with EDFWriter(filename, labels, fs, physical_min, physical_max) as w:`
+            `    w.write(block)  # (channel x time) physical values`
+
+        every channel is scaled from its physical range to the int16 range,
+        samples outside the physical range are clipped. the number of
+        records is written in the header when the file is closed; an
+        incomplete last record is padded with zeros.
+    """
+
+    def __init__(self, filename, labels, fs, physical_min, physical_max, physical_dim='uV',
+                 record_duration=1, patient_info='', record_info='', start_date='01.01.85',
+                 start_time='00.00.00', digital_min=-32768, digital_max=32767):
+
+        self.filename = filename
+        self.labels = list(labels)
+        self.nchannel = len(self.labels)
+        self.fs = fs
+        self.record_duration = record_duration
+        self.spr = int(round(fs * record_duration))  # samples per record
+        if not np.isclose(self.spr, fs * record_duration) or self.spr == 0:
+            raise ValueError("fs x record_duration must be a positive integer.")
+
+        # physical ranges as written in the header, i.e. as read back
+        self.physical_min = [float(_number(item)) for item in np.broadcast_to(physical_min, (self.nchannel,))]
+        self.physical_max = [float(_number(item)) for item in np.broadcast_to(physical_max, (self.nchannel,))]
+        self.physical_max = [high if high > low else float(_number(low + 1))
+                             for low, high in zip(self.physical_min, self.physical_max)]
+        self.digital_min, self.digital_max = digital_min, digital_max
+        _dims = np.broadcast_to(np.array(physical_dim, dtype=object), (self.nchannel,))
+
+        self._scale = ((digital_max - digital_min) / (np.array(self.physical_max) - np.array(self.physical_min))).reshape((-1, 1))
+        self._offset = (digital_min - np.array(self.physical_min).reshape((-1, 1)) * self._scale)
+        self._pending = np.zeros((self.nchannel, 0), dtype='int16')
+        self.recordnum = 0
+
+        ns = self.nchannel
+        self.header_length = 256 * (ns + 1)
+        _header = _field(0, 8) + _field(patient_info, 80) + _field(record_info, 80)
+        _header += _field(start_date, 8) + _field(start_time, 8) + _field(self.header_length, 8)
+        _header += _field('', 44) + _field(-1, 8) + _field(_number(record_duration), 8) + _field(ns, 4)
+        _header += b''.join([_field(item, 16) for item in self.labels])
+        _header += b''.join([_field('', 80) for _ in range(ns)])
+        _header += b''.join([_field(item, 8) for item in _dims])
+        _header += b''.join([_field(_number(item), 8) for item in self.physical_min])
+        _header += b''.join([_field(_number(item), 8) for item in self.physical_max])
+        _header += b''.join([_field(digital_min, 8) for _ in range(ns)])
+        _header += b''.join([_field(digital_max, 8) for _ in range(ns)])
+        _header += b''.join([_field('', 80) for _ in range(ns)])
+        _header += b''.join([_field(self.spr, 8) for _ in range(ns)])
+        _header += b''.join([_field('', 32) for _ in range(ns)])
+
+        self._file = open(filename, 'wb')
+        self._file.write(_header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def digitize(self, block):
+        """int16 digital values of a (channel x time) block of physical values."""
+        _digital = np.rint(np.asarray(block, dtype='float64') * self._scale + self._offset)
+        return np.clip(_digital, self.digital_min, self.digital_max).astype('<i2')
+
+    def write(self, block):
+        """append a (channel x time) block of physical values."""
+        _data = np.hstack((self._pending, self.digitize(np.reshape(block, (self.nchannel, -1)))))
+        _nrecord = np.size(_data, 1) // self.spr
+        _full = _nrecord * self.spr
+        # (channel, record, sample) -> records of consecutive channels
+        self._file.write(np.ascontiguousarray(
+            _data[:, :_full].reshape((self.nchannel, _nrecord, self.spr)).transpose((1, 0, 2))).tobytes())
+        self._pending = _data[:, _full:]
+        self.recordnum += _nrecord
+
+    def close(self):
+        if self._file is None:
+            return
+        if np.size(self._pending, 1) > 0:
+            _zeros = np.zeros((self.nchannel, self.spr - np.size(self._pending, 1)))
+            self._pending = np.hstack((self._pending, self.digitize(_zeros)))
+            self.write(np.zeros((self.nchannel, 0)))
+        self._file.seek(236)
+        self._file.write(_field(self.recordnum, 8))
+        self._file.close()
+        self._file = None
+
+
+def physical_range(blocks):
+    """per channel (min, max) of an iterable of (channel x time) blocks."""
+    _min, _max = None, None
+    for block in blocks:
+        block = np.asarray(block)
+        if np.size(block, 1) == 0:
+            continue
+        _min = np.min(block, 1) if _min is None else np.minimum(_min, np.min(block, 1))
+        _max = np.max(block, 1) if _max is None else np.maximum(_max, np.max(block, 1))
+    return _min, _max
+
+
+def write_edf(filename, blocks, labels, fs, physical_min=None, physical_max=None, **kwargs):
+    """write (channel x time) blocks of physical values into an edf file.
+
+    Syntax: recordnum = write_edf(filename, blocks, labels, fs, physical_min, physical_max, **kwargs)
+
+    Keyword arguments:
+    filename     -- (str) the edf file
+    blocks       -- (function) blocks() returns an iterable of (channel x time)
+                    blocks, read twice if the physical range is not given;
+                    or an iterable of blocks
+    labels       -- (list) channel labels
+    fs           -- (number) sampling rate
+    physical_min -- (array-like) per channel minimum [default: None, first pass]
+    physical_max -- (array-like) per channel maximum [default: None, first pass]
+    **kwargs     -- further arguments of `EDFWriter`
+
+    Return:
+    recordnum    -- (int) number of records written
+    """
+
+    if physical_min is None or physical_max is None:
+        if not callable(blocks):
+            raise ValueError("`blocks` must be a function to compute the physical range.")
+        physical_min, physical_max = physical_range(blocks())
+        if physical_min is None:
+            physical_min, physical_max = np.zeros(len(labels)), np.ones(len(labels))
+
+    with EDFWriter(filename, labels, fs, physical_min, physical_max, **kwargs) as _writer:
+        for block in (blocks() if callable(blocks) else blocks):
+            _writer.write(block)
+    return _writer.recordnum
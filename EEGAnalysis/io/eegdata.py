@@ -1,5 +1,259 @@
 """
 *.eeg file manipulation
 
-#TODO
+Nihon Kohden recordings, i.e. the .EEG waveform file with its .21E (channel
+names), .PNT (patient and start time) and .LOG (event log) companions, read
+without converting them to edf first. the waveform blocks are memory-mapped
+and exposed as `EEGData.data[ch, t0:t1]`, as `EDFData`.
+
+layout of the .EEG file (as documented by MNE-Python, `mne.io.nihon`):
+- 0x0091: number of control blocks, addresses at 0x0092 + 20 * i
+- control block + 17: number of data blocks, addresses at + 18 + 20 * j
+- data block + 0x1A: sampling rate (uint16 & 0x3FFF)
+- data block + 0x1C: record duration, in 0.1 s
+- data block + 0x26: number of channels, channel codes at + 0x27 + 10 * k
+- data block + 0x27 + 10 * n_channels: samples, uint16, interleaved as
+  (n_samples, n_channels + 1), the last column is the mark channel.
+  the digital value is the uint16 value - 32768.
 """
+
+import os, re
+from datetime import datetime
+
+import numpy as np
+
+from .edfdata import EDFSignals, BLOCK_BYTES
+from ..profiling import record
+
+
+_VALID_HEADERS = ['EEG-1100A V01.00', 'EEG-1100B V01.00', 'EEG-1100C V01.00',
+                  'QI-403A   V01.00', 'QI-403A   V02.00', 'EEG-2100  V01.00',
+                  'EEG-2100  V02.00', 'DAE-2100D V01.30', 'DAE-2100D V02.00']
+
+# channel names of the channel codes, overridden by the .21E file
+_DEFAULT_LABELS = ['FP1', 'FP2', 'F3', 'F4', 'C3', 'C4', 'P3', 'P4', 'O1', 'O2', 'F7', 'F8',
+                   'T3', 'T4', 'T5', 'T6', 'FZ', 'CZ', 'PZ', 'E', 'PG1', 'PG2', 'A1', 'A2',
+                   'T1', 'T2']
+_DEFAULT_LABELS += ['X%d'%idx for idx in range(1, 12)]
+_DEFAULT_LABELS += ['NA%d'%idx for idx in range(1, 6)]
+_DEFAULT_LABELS += ['DC%02d'%idx for idx in range(1, 33)]
+_DEFAULT_LABELS += ['BN1', 'BN2', 'Mark1', 'Mark2']
+_DEFAULT_LABELS += ['NA%d'%idx for idx in range(6, 28)]
+_DEFAULT_LABELS += ['X12/BP1', 'X13/BP2', 'X14/BP3', 'X15/BP4']
+_DEFAULT_LABELS += ['X%d'%idx for idx in range(16, 166)]
+_DEFAULT_LABELS += ['NA28', 'Z']
+
+# physical range of the digital range (-32768, 32767), in uV
+_EEG_RANGE = 3200.0
+_DC_RANGE = 12002.56 * 1000
+
+
+def _companion(filename, ext):
+    """the companion file of `filename` with extension `ext`, any case, or None."""
+    _base = os.path.splitext(filename)[0]
+    for item in (ext.upper(), ext.lower()):
+        if os.path.isfile(_base + item):
+            return _base + item
+    return None
+
+
+def _read_uint(f, offset, dtype):
+    f.seek(offset)
+    return int(np.frombuffer(f.read(np.dtype(dtype).itemsize), dtype)[0])
+
+
+def read_21e(filename):
+    """channel names of a .21E file, as dict{channel code: name}."""
+    _labels = {}
+    _section = None
+    with open(filename, 'rb') as f:
+        for line in f.read().decode('latin-1').splitlines():
+            line = line.strip()
+            if line.startswith('['):
+                _section = line
+            elif _section == '[ELECTRODE]' and '=' in line:
+                _code, _name = line.split('=', 1)
+                if _code.strip().isdigit():
+                    _labels[int(_code)] = _name.strip()
+    return _labels
+
+
+def read_pnt(filename):
+    """start time of the recording from a .PNT file, as datetime, or None."""
+    with open(filename, 'rb') as f:
+        f.seek(0x40)
+        _stamp = f.read(14).decode('ascii', 'ignore')
+    try:
+        return datetime.strptime(_stamp, '%Y%m%d%H%M%S')
+    except ValueError:
+        return None
+
+
+def read_log(filename):
+    """
+    events of a .LOG file.
+
+    return:
+    - list of (clock time in seconds since midnight, text)
+    """
+    _events = []
+    with open(filename, 'rb') as f:
+        _nblock = _read_uint(f, 0x91, 'u1')
+        for idx in range(_nblock):
+            _address = _read_uint(f, 0x92 + idx * 20, '<u4')
+            _nlog = _read_uint(f, _address + 0x12, 'u1')
+            f.seek(_address + 0x14)
+            _raw = f.read(45 * _nlog)
+            for each in range(len(_raw) // 45):
+                _log = _raw[45 * each:45 * (each + 1)]
+                _text = _log[:20].strip(b'\x00 ').decode('latin-1')
+                _clock = _log[20:26].decode('ascii', 'ignore')
+                if not re.match(r'\d{6}$', _clock):
+                    continue
+                _events.append((int(_clock[:2]) * 3600 + int(_clock[2:4]) * 60 + int(_clock[4:]), _text))
+    return _events
+
+
+class EEGSignals(EDFSignals):
+    """
+        lazy view of the signals of a Nihon Kohden .EEG file, indexed as
+        `data[ch, t0:t1]`, see `EDFSignals`.
+
+        every data block is memory-mapped as a (n_samples, n_channels + 1)
+        uint16 array, the blocks are contiguous in time.
+    """
+
+    def __init__(self, filename, blocks, nchannel):
+        self.filename = filename
+        self.samples = np.ones(nchannel, dtype='int')
+        self._blocks = [np.memmap(filename, dtype='<u2', mode='r', offset=offset, shape=(length, nchannel + 1))
+                        for offset, length in blocks]
+        self._starts = np.cumsum([0] + [length for _, length in blocks])
+        self.shape = (nchannel, int(self._starts[-1]))
+
+    def read(self, chidx, start=0, stop=None, out=None):
+        """read channels `chidx` (list) from sample `start` to `stop`, returns (n, t) int16.
+
+        `out` is an (n, t) array or a list of n rows to fill instead.
+        """
+        stop = self.shape[1] if stop is None else min(stop, self.shape[1])
+        start = max(start, 0)
+        _result = np.zeros((len(chidx), max(stop - start, 0)), dtype='int16') if out is None else out
+
+        for _block, _first in zip(self._blocks, self._starts[:-1]):
+            _lo, _hi = max(start, _first), min(stop, _first + len(_block))
+            # rows are read in blocks of BLOCK_BYTES, every channel is copied into its row
+            _step = max(1, BLOCK_BYTES // (_block.shape[1] * 2))
+            for _row in range(_lo, _hi, _step):
+                _rows = _block[_row - _first:min(_row + _step, _hi) - _first]
+                record(read=_rows.nbytes)
+                for k, ch in enumerate(chidx):
+                    # uint16 - 32768 is the int16 with the sign bit flipped
+                    _result[k][_row - start:_row - start + len(_rows)] = (_rows[:, ch] ^ 0x8000).view('int16')
+        return _result
+
+
+class EEGData(object):
+    """
+        Nihon Kohden EEG Data manipulation, with the interface of `EDFData`
+
+        load eeg data by:
+            `EEGData(filename, expname)`
+
+        read the header only, with lazy channel-selective data access by:
+            `EEGData(filename, expname, preload=False)`
+            `EEGData.data[chidx, start:stop]`
+
+        the channel labels are "POL <name>", as in the edf files exported by
+        the Nihon Kohden software, e.g. "POL A1" or "POL DC10".
+        the events of the .LOG file are in `EEGData.events()`.
+    """
+
+    def __init__(self, filename, expname, preload=True):
+
+        self.expname = expname
+        self.filename = filename
+
+        with open(filename, 'rb') as f:
+            self.version = f.read(16).decode('ascii', 'ignore')
+            if self.version not in _VALID_HEADERS:
+                raise ValueError("not a supported Nihon Kohden file: %s (%s)"%(filename, self.version))
+
+            _codes, _fs, _blocks = None, None, []
+            for idx in range(_read_uint(f, 0x91, 'u1')):
+                _control = _read_uint(f, 0x92 + idx * 20, '<u4')
+                for each in range(_read_uint(f, _control + 17, 'u1')):
+                    _address = _read_uint(f, _control + 18 + each * 20, '<u4')
+                    _nchannel = _read_uint(f, _address + 0x26, 'u1')
+                    _block_codes = [_read_uint(f, _address + 0x27 + k * 10, 'u1') for k in range(_nchannel)]
+                    _block_fs = _read_uint(f, _address + 0x1A, '<u2') & 0x3FFF
+                    _duration = _read_uint(f, _address + 0x1C, '<u4')  # in 0.1 s
+
+                    if _codes is None:
+                        _codes, _fs = _block_codes, _block_fs
+                    elif _block_codes != _codes or _block_fs != _fs:
+                        raise ValueError("data blocks with different channels or sampling rates: %s"%filename)
+                    _blocks.append((_address + 0x27 + _nchannel * 10, _duration * _block_fs // 10))
+
+        if _codes is None:
+            raise ValueError("no data block in %s"%filename)
+
+        # a block still being recorded, or truncated
+        _size = os.path.getsize(filename)
+        _bytes = 2 * (len(_codes) + 1)
+        _blocks = [(offset, max(min(length, (_size - offset) // _bytes), 0)) for offset, length in _blocks]
+
+        _names = dict(enumerate(_DEFAULT_LABELS))
+        _21e = _companion(filename, '.21E')
+        if _21e is not None:
+            _names.update(read_21e(_21e))
+        _pnt = _companion(filename, '.PNT')
+        self.start_datetime = read_pnt(_pnt) if _pnt is not None else None
+        self.start_date = self.start_datetime.strftime('%d.%m.%y') if self.start_datetime else ''
+        self.start_time = self.start_datetime.strftime('%H.%M.%S') if self.start_datetime else ''
+
+        self.nchannel = len(_codes)
+        self.channelLabels = ['POL %s'%_names.get(code, 'CH%d'%code) for code in _codes]
+        _dc = np.array([bool(re.match(r'DC\d+$', _names.get(code, ''))) for code in _codes])
+        self.physical_dim = ['uV'] * self.nchannel
+        self.physical_max = np.where(_dc, _DC_RANGE, _EEG_RANGE)
+        self.physical_min = -self.physical_max
+        self.digital_min = [-32768] * self.nchannel
+        self.digital_max = [32767] * self.nchannel
+        self.physical_unit = (np.array(self.physical_max) - np.array(self.physical_min))/(np.array(self.digital_max) - np.array(self.digital_min))
+
+        self.fs = float(_fs)
+        self.samples = [1] * self.nchannel
+        self.sampleduration = 1 / self.fs
+        self.recordnum = int(np.sum([length for _, length in _blocks]))
+
+        ## data
+        self.signals = EEGSignals(filename, _blocks, self.nchannel)
+        if preload:
+            self.data = self.signals.read(list(range(self.nchannel)))
+        else:
+            self.data = self.signals
+        self.tspec = np.arange(self.recordnum) / self.fs if preload else None  # timeline
+
+    def channel_index(self, labels):
+        """indices of the channels by labels, -1 for missing labels."""
+        _lookup = dict([(item, idx) for idx, item in enumerate(self.channelLabels)])
+        return np.array([_lookup.get(item, -1) for item in labels], dtype='int')
+
+    def events(self):
+        """
+        events of the .LOG file, relative to the start of the recording.
+
+        return:
+        - pandas.DataFrame with columns "onset" (s), "duration" (s, 0) and "text"
+        """
+        import pandas as pd
+
+        _log = _companion(self.filename, '.LOG')
+        _events = read_log(_log) if _log is not None else []
+        _start = 0 if self.start_datetime is None else \
+            self.start_datetime.hour * 3600 + self.start_datetime.minute * 60 + self.start_datetime.second
+        # clock times, a recording may pass midnight
+        _onset = np.array([(clock - _start) % 86400 for clock, _ in _events], dtype='float64')
+        return pd.DataFrame({'onset': _onset, 'duration': np.zeros(len(_events)),
+                             'text': [text for _, text in _events]}, columns=['onset', 'duration', 'text'])
@@ -11,21 +11,90 @@ from scipy.io import loadmat, savemat
 import numpy as np
 from tqdm import tqdm
 from multiprocessing import Pool
-# import h5py
+import h5py
+
+
+class _CompactSource(object):
+    """one compact .mat file, loaded once.
+
+    v7.3 files are hdf5 files: they are opened with h5py, and the channels
+    are read in time blocks of whole rows, so every compressed chunk is
+    decompressed once for all the channels. older files are read by
+    `loadmat` once. MATLAB stores v7.3 arrays transposed, i.e. the
+    (channels x time) matrix is a (time x channels) hdf5 dataset, and a
+    struct is an hdf5 group with one dataset per field.
+    """
+
+    def __init__(self, sourcemat):
+        self._h5 = h5py.File(sourcemat, 'r') if h5py.is_hdf5(sourcemat) else None
+        if self._h5 is None:
+            self._mat = loadmat(sourcemat)
+            _times = self._mat["times"][0]
+            self.markers = self._mat["markers"]
+        else:
+            # only the first two and the last time stamps are read
+            _t = self._h5["times"]
+            _slice = (lambda a, b: _t[a:b, 0]) if _t.shape[0] > 1 else (lambda a, b: _t[0, a:b])
+            _times = np.concatenate((_slice(0, 2), _slice(-1, None)))
+            _markers = self._h5["markers"]
+            if isinstance(_markers, h5py.Group):
+                self.markers = dict([(key, _markers[key][()].T) for key in _markers])
+            else:
+                self.markers = _markers[()].T
+        self.times = (_times[0], _times[-1])
+        self.fs = 1 / (_times[1] - _times[0])
+
+    def channels(self, chidx, blocksize=64*1024*1024):
+        """(len(chidx) x time) array of the channels `chidx`.
+
+        v7.3 datasets are read in blocks of about `blocksize` bytes, aligned
+        to the hdf5 chunks; a column read would decompress every chunk for
+        every channel.
+        """
+        if self._h5 is None:
+            return self._mat['channels'][chidx, :]
+
+        _dataset = self._h5['channels']
+        _length, _width = _dataset.shape
+        _step = max(1, blocksize // (_width * _dataset.dtype.itemsize))
+        if _dataset.chunks is not None:
+            _step = max(1, _step // _dataset.chunks[0]) * _dataset.chunks[0]
+
+        _values = np.empty((len(chidx), _length), dtype=_dataset.dtype)
+        for start in range(0, _length, _step):
+            _values[:, start:start+_step] = _dataset[start:start+_step, :][:, chidx].T
+        return _values
+
+    def close(self):
+        if self._h5 is not None:
+            self._h5.close()
+
 
 def _stepCreateSplitData(_input):
-    exportmat, sourcemat, chidx= _input
+    """split one compact file into all its target channel files."""
+    sourcemat, exports = _input
 
-    rawmat = loadmat(sourcemat)
-    savemat(exportmat, {
-            "values": rawmat['channels'][chidx, :],
-            "times":  (rawmat["times"][0,0], rawmat["times"][0,-1]),
-            "markers": rawmat["markers"],
-            "fs": 1 / (rawmat["times"][0,1] - rawmat["times"][0,0])
-        })
+    source = _CompactSource(sourcemat)
+    try:
+        _values = source.channels([chidx for chidx, _ in exports])
+        for idx, (_, exportmat) in enumerate(exports):
+            savemat(exportmat, {
+                    "values": _values[idx],
+                    "times":  source.times,
+                    "markers": source.markers,
+                    "fs": source.fs
+                })
+    finally:
+        source.close()
+    return sourcemat
 
 def createSplitData(datadir, patientname, chrange=range(123), pn=3, overwrite=False, target=None):
-    """Split compact data, with multiprocessing module."""
+    """Split compact data, with multiprocessing module.
+
+    every compact file is loaded once and fanned out to all its channel
+    files, one compact file per process, so the peak memory is one compact
+    file per process.
+    """
     _datadir = os.path.join(datadir, patientname, "EEG", "Compact")
     _exportdir = os.path.join(datadir, patientname, "EEG", "SgCh")
 
@@ -38,20 +107,22 @@ def createSplitData(datadir, patientname, chrange=range(123), pn=3, overwrite=Fa
     else:
         files = target
 
-    map_args = []
+    map_args = dict([(each_source, []) for each_source in files])
     for chidx in chrange:
         exportfiledir = os.path.join(_exportdir, "ch%03d"%(chidx))
         if not os.path.isdir(exportfiledir):
             os.mkdir(exportfiledir)
         for each_source in files:
             exportmat = os.path.join(exportfiledir, each_source+"_ch%03d.mat"%chidx)
-            sourcemat = os.path.join(_datadir, each_source+'.mat')
             if os.path.isfile(exportmat) and not overwrite:
                 continue
             else:
-                map_args.append((exportmat, sourcemat, chidx))
+                map_args[each_source].append((chidx, exportmat))
+
+    map_args = [(os.path.join(_datadir, each_source+'.mat'), exports)
+                for each_source, exports in map_args.items() if len(exports) > 0]
 
     with Pool(processes=pn) as p:
         with tqdm(total=len(map_args)) as pbar:
-            for i, _ in tqdm(enumerate(p.imap_unordered(_stepCreateSplitData, map_args))):
+            for _ in p.imap_unordered(_stepCreateSplitData, map_args):
                 pbar.update()
@@ -0,0 +1,362 @@
+"""
+online processing
+
+process sample blocks as they arrive, e.g. from a growing edf file or a
+local socket, for closed-loop experiments.
+
+the online results agree with the offline functions: triggers follow
+`detect_cross_pnt(..., way='up')`, and the band power and phase are the
+`dwt` morlet coefficients, delivered with a latency of half the wavelet
+(`fs` samples for `morlet`). filters are causal (`lfilter`), unlike the
+zero-phase `filtfilt` of `decomposition.filter`.
+"""
+
+import os
+import time
+import socket
+from collections import deque
+
+import numpy as np
+import scipy.signal as signal
+
+from .decomposition.dwt import morlet
+from .io.edfdata import EDFData
+
+
+class RingBuffer(object):
+    '''
+    fixed size buffer of the latest samples of every channel.
+
+    samples are written twice, at `i` and `i + capacity`, so the latest `n`
+    samples are always a contiguous view.
+
+    arguments:
+    - nchannel: number of channels
+    - capacity: number of samples kept per channel
+    '''
+
+    def __init__(self, nchannel, capacity, dtype='float64'):
+        self.capacity = int(capacity)
+        self._data = np.zeros((nchannel, 2 * self.capacity), dtype=dtype)
+        self._head = 0
+        self.total = 0  # samples received since the start
+
+    def extend(self, block):
+        block = np.asarray(block)
+        _n = np.size(block, 1)
+        if _n >= self.capacity:
+            block = block[:, -self.capacity:]
+            self._head = 0
+            self._data[:, :self.capacity] = block
+            self._data[:, self.capacity:] = block
+        else:
+            _end = self._head + _n
+            if _end <= self.capacity:
+                self._data[:, self._head:_end] = block
+                self._data[:, self._head + self.capacity:_end + self.capacity] = block
+            else:
+                _split = self.capacity - self._head
+                self._data[:, self._head:self.capacity] = block[:, :_split]
+                self._data[:, self._head + self.capacity:] = block[:, :_split]
+                self._data[:, :_end - self.capacity] = block[:, _split:]
+                self._data[:, self.capacity:_end] = block[:, _split:]
+            self._head = _end % self.capacity
+        self.total += _n
+
+    def latest(self, n):
+        '''
+        the latest `n` samples, (nchannel, n) view in time order; samples
+        before the start of the stream are zeros.
+        '''
+
+        if n > self.capacity:
+            raise ValueError("`n` larger than the buffer capacity.")
+        _end = self._head + self.capacity
+        return self._data[:, _end - n:_end]
+
+
+class OnlineFilter(object):
+    '''
+    causal iir filter keeping its state between blocks.
+
+    arguments:
+    - b, a: filter coefficients, e.g. from `scipy.signal.butter`
+    - nchannel: number of channels
+    '''
+
+    def __init__(self, b, a, nchannel):
+        self.b, self.a = b, a
+        self._zi = np.zeros((nchannel, max(len(a), len(b)) - 1))
+
+    @classmethod
+    def bandpass(cls, bandrange, fs, nchannel, order=4):
+        b, a = signal.butter(order, [bandrange[0]/fs*2, bandrange[1]/fs*2], 'bandpass')
+        return cls(b, a, nchannel)
+
+    @classmethod
+    def highpass(cls, cutoff, fs, nchannel, order=5):
+        b, a = signal.butter(order, cutoff/fs*2, btype='high')
+        return cls(b, a, nchannel)
+
+    def __call__(self, block):
+        _result, self._zi = signal.lfilter(self.b, self.a, block, axis=-1, zi=self._zi)
+        return _result
+
+
+class OnlineTrigger(object):
+    '''
+    incremental `detect_cross_pnt(arr, thr, way='up', gap=gap)` of one channel.
+
+    arguments:
+    - channel: index of the trigger channel in the blocks
+    - thresh: threshold, in the units of the blocks
+    - gap: the least samples between two valid markers
+    '''
+
+    def __init__(self, channel, thresh, gap=1):
+        self.channel = channel
+        self.thresh = thresh
+        self.gap = gap
+        self._last = None
+        self._previous = -9999
+        self._offset = 0
+
+    def __call__(self, block):
+        '''
+        return the sample indices (since the start) of the rising edges in the block.
+        '''
+
+        _trace = np.asarray(block[self.channel], dtype='float64')
+        if self._last is None:
+            _x, _base = _trace, self._offset
+        else:
+            _x, _base = np.hstack((self._last, _trace)), self._offset - 1
+
+        _idx, = np.where((_x[1:] > self.thresh) & (_x[:-1] < self.thresh))
+        _idx = _idx + 1 + _base
+
+        _result = []
+        for idx in _idx:
+            if idx - self._previous > self.gap:
+                _result.append(idx)
+                self._previous = idx
+
+        self._offset += len(_trace)
+        if len(_trace) > 0:
+            self._last = _trace[-1:]
+        return np.array(_result, dtype='int')
+
+
+class OnlineEngine(object):
+    '''
+    online processing of sample blocks.
+
+    every block is scaled to physical units, passed to the trigger detectors
+    (unfiltered) and the filter, and appended to a ring buffer; the morlet
+    coefficients of the `frange` frequencies are then computed for every
+    new sample, `fs` samples behind the latest one.
+
+    arguments:
+    - fs: sampling rate (int)
+    - nchannel: number of channels of the blocks
+
+    keyword arguments:
+    - frange: target frequencies, None for no band power [default: None]
+    - channels: channels for the band power [default: None, all channels]
+    - unit: physical unit of each channel [default: 1]
+    - filter: an `OnlineFilter`, or None [default: None]
+    - triggers: dict{name: `OnlineTrigger`} [default: None]
+    - wavelet: wavelet function [default: morlet]
+    '''
+
+    def __init__(self, fs, nchannel, frange=None, channels=None, unit=1, filter=None,
+                 triggers=None, wavelet=morlet):
+        self.fs = int(fs)
+        self.nchannel = nchannel
+        self.unit = np.reshape(np.ones(nchannel) * unit, (-1, 1))
+        self.filter = filter
+        self.triggers = {} if triggers is None else triggers
+        self.channels = list(range(nchannel)) if channels is None else list(channels)
+        self.frange = frange
+
+        if frange is not None:
+            self._wavelets = np.array([wavelet(F, self.fs) for F in frange])
+            self._wlen = np.size(self._wavelets, 1)
+            self.delay = self._wlen // 2  # latency of the coefficients, in samples
+        else:
+            self._wlen = 1
+            self.delay = 0
+
+        self.buffer = None
+        self.latency = deque(maxlen=10000)
+
+    def process(self, block, received=None):
+        '''
+        process one (nchannel, n) block.
+
+        keyword arguments:
+        - received: time.perf_counter() when the block arrived [default: now]
+
+        return:
+        - dict with
+            "triggers": dict{name: sample indices of the new markers}
+            "time": sample indices of the new coefficients
+            "power", "phase": (freq x channel x time) band power and phase
+            "latency": processing time of the block, in seconds
+        '''
+
+        received = time.perf_counter() if received is None else received
+        block = np.asarray(block) * self.unit
+        _n = np.size(block, 1)
+
+        _result = {'triggers': dict([(name, trigger(block)) for name, trigger in self.triggers.items()])}
+
+        _data = block[self.channels]
+        if self.filter is not None:
+            _data = self.filter(_data)
+
+        if self.frange is not None:
+            if self.buffer is None:
+                self.buffer = RingBuffer(len(self.channels), max(self._wlen - 1 + _n, 4 * self._wlen))
+            elif self.buffer.capacity < self._wlen - 1 + _n:
+                _history = self.buffer.latest(self._wlen - 1).copy()
+                _total = self.buffer.total
+                self.buffer = RingBuffer(len(self.channels), 2 * (self._wlen - 1 + _n))
+                self.buffer.extend(_history)
+                self.buffer.total = _total
+            self.buffer.extend(_data)
+
+            # valid convolution of the new samples, i.e. dwt coefficients `delay` samples ago
+            _segment = self.buffer.latest(self._wlen - 1 + _n)
+            _coef = signal.fftconvolve(_segment[np.newaxis, :, :], self._wavelets[:, np.newaxis, :],
+                                       mode='valid', axes=-1)
+            _end = self.buffer.total - self._wlen + self.delay
+            _result['time'] = np.arange(_end - _n, _end)
+            _result['power'] = np.abs(_coef) ** 2
+            _result['phase'] = np.angle(_coef)
+
+        _result['latency'] = time.perf_counter() - received
+        self.latency.append(_result['latency'])
+        return _result
+
+    def run(self, source, callback=None):
+        '''
+        process all the blocks of a source, e.g. `EDFTail` or `SocketSource`.
+
+        keyword arguments:
+        - callback: called with the result of every block
+
+        return:
+        - latency summary, see `OnlineEngine.latency_summary`
+        '''
+
+        for block in source:
+            _result = self.process(block)
+            if callback is not None:
+                callback(_result)
+        return self.latency_summary()
+
+    def latency_summary(self):
+        '''
+        mean, median, 99th percentile and max processing latency per block, in seconds.
+        '''
+
+        _latency = np.array(self.latency)
+        if len(_latency) == 0:
+            return {}
+        return {'blocks': len(_latency), 'mean': float(np.mean(_latency)),
+                'median': float(np.median(_latency)), 'p99': float(np.percentile(_latency, 99)),
+                'max': float(np.max(_latency))}
+
+
+class EDFTail(object):
+    '''
+    blocks of a growing edf file, i.e. follow the file as records are appended.
+
+    only the channels with the same number of samples per record as the
+    first channel are yielded, as (nchannel, n) int16 blocks.
+
+    arguments:
+    - filename: path of the edf file
+
+    keyword arguments:
+    - poll: polling interval, in seconds [default: 0.1]
+    - timeout: stop after this many seconds without new records [default: 5]
+    '''
+
+    def __init__(self, filename, poll=0.1, timeout=5):
+        self.filename = filename
+        self.poll = poll
+        self.timeout = timeout
+
+        _edf = EDFData(filename, 'online', preload=False)
+        self.fs = _edf.fs
+        self.header_length = _edf.header_length
+        self.samples = np.array(_edf.samples)
+        self.channels = [idx for idx in range(_edf.nchannel) if self.samples[idx] == self.samples[0]]
+        self.channelLabels = [_edf.channelLabels[idx] for idx in self.channels]
+        self.physical_unit = _edf.physical_unit[self.channels]
+        self._columns = (np.hstack((0, np.cumsum(self.samples)[:-1]))[self.channels].reshape((-1, 1))
+                         + np.arange(self.samples[0]))
+        self._record_bytes = int(np.sum(self.samples)) * 2
+
+    def __iter__(self):
+        _position = self.header_length
+        _idle = time.perf_counter()
+        with open(self.filename, 'rb') as _f:
+            while True:
+                _n = (os.path.getsize(self.filename) - _position) // self._record_bytes
+                if _n == 0:
+                    if time.perf_counter() - _idle > self.timeout:
+                        return
+                    time.sleep(self.poll)
+                    continue
+
+                _f.seek(_position)
+                _records = np.frombuffer(_f.read(_n * self._record_bytes), dtype='<i2').reshape((_n, -1))
+                _position += _n * self._record_bytes
+                _idle = time.perf_counter()
+                yield _records[:, self._columns].transpose((1, 0, 2)).reshape((len(self.channels), -1))
+
+
+class SocketSource(object):
+    '''
+    blocks from a local socket, as a stand-in for an acquisition stream.
+
+    the stream is little-endian int16, interleaved by sample, i.e.
+    `nchannel` values per sample.
+
+    arguments:
+    - address: path of a unix socket, or (host, port) of a tcp socket
+    - nchannel: number of channels
+
+    keyword arguments:
+    - block: samples per block [default: 100]
+    '''
+
+    def __init__(self, address, nchannel, block=100):
+        self.address = address
+        self.nchannel = nchannel
+        self.block = block
+
+    def __iter__(self):
+        _family = socket.AF_UNIX if isinstance(self.address, str) else socket.AF_INET
+        _frame = self.nchannel * 2 * self.block
+        with socket.socket(_family, socket.SOCK_STREAM) as _sock:
+            _sock.connect(self.address)
+            _pending = b''
+            while True:
+                _chunk = _sock.recv(_frame)
+                if not _chunk:
+                    break
+                _pending += _chunk
+                _n = len(_pending) // (self.nchannel * 2)
+                if _n < self.block:
+                    continue
+                _data = np.frombuffer(_pending[:_n * self.nchannel * 2], dtype='<i2')
+                _pending = _pending[_n * self.nchannel * 2:]
+                yield _data.reshape((_n, self.nchannel)).T
+
+            _n = len(_pending) // (self.nchannel * 2)
+            if _n > 0:
+                yield np.frombuffer(_pending[:_n * self.nchannel * 2], dtype='<i2').reshape((_n, self.nchannel)).T
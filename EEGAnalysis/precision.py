@@ -0,0 +1,89 @@
+"""
+numerical precision of the decomposition
+
+'double' (float64/complex128) is the default. 'single' (float32/complex64)
+halves the memory and bandwidth of epoching, dwt, power and ITPC; set it
+globally by `set_precision('single')`, or per call by `precision='single'`.
+
+error bounds of 'single' versus 'double' (morlet dwt of int16 data, 50
+trials of 6000 samples and single 10^6 sample recordings, white and 1/f
+noise):
+- dwt coefficients: absolute error < 1e-5 of the largest coefficient of
+  the same frequency.
+- dwt_power, raw power: absolute error < 2e-6 of the largest power of the
+  same frequency; z-score: absolute error < 1e-3.
+- dB baseline normalization: absolute error < 0.01 dB where the power is
+  within 20 dB of the baseline, growing to ~0.06 dB at -40 dB and unbounded
+  close to the zeros of the power, where the relative error of float32 grows.
+- dwt_itpc: absolute error < 5e-5.
+the fft error grows as eps * log2(n), with eps = 1.2e-7 for float32.
+"""
+
+import numpy as np
+
+
+_PRECISION = {'default': 'double'}
+
+_DTYPES = {
+    'single': (np.float32, np.complex64),
+    'double': (np.float64, np.complex128),
+}
+
+
+def set_precision(precision):
+    '''
+    set the global precision, either 'single' or 'double'.
+    '''
+
+    if precision not in _DTYPES:
+        raise ValueError("unknown `precision` value.")
+    _PRECISION['default'] = precision
+
+
+def get_precision(precision=None):
+    '''
+    the precision of a call: `precision` if given, the global one otherwise.
+    '''
+
+    if precision is None:
+        return _PRECISION['default']
+    if precision not in _DTYPES:
+        raise ValueError("unknown `precision` value.")
+    return precision
+
+
+def float_dtype(precision=None):
+    return _DTYPES[get_precision(precision)][0]
+
+
+def complex_dtype(precision=None):
+    return _DTYPES[get_precision(precision)][1]
+
+
+def _cast(precision):
+    # explicit precision always casts; the global 'double' keeps the input
+    # dtype, so that single precision results are not upcast downstream.
+    return precision is not None or _PRECISION['default'] == 'single'
+
+
+def as_complex(data, precision=None):
+    '''
+    complex input of a computation, in the precision of the call.
+    '''
+
+    data = np.asarray(data)
+    if _cast(precision):
+        return data.astype(complex_dtype(precision), copy=False)
+    return data
+
+
+def as_float_dtype(dtype, precision=None):
+    '''
+    dtype of a result copied from data of `dtype`. integer data, e.g. isplit
+    int16, keeps its dtype, i.e. the physical unit is applied later.
+    '''
+
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.floating) and _cast(precision):
+        return np.dtype(float_dtype(precision))
+    return dtype
@@ -0,0 +1,235 @@
+"""
+stage level instrumentation
+
+opt-in timing of the library stages. disabled by default, in which case an
+instrumented call costs a single flag check.
+
+>>> from EEGAnalysis import profiling
+>>> profiling.enable()
+>>> patient.create_isplit()
+>>> print(profiling.summary())
+>>> profiling.export_trace('create_isplit.json')  # open in chrome://tracing
+
+the events of worker processes (process pools started after `enable`) are
+appended to one file per pid in a spool directory, and merged with the
+events of the main process by `events`, `summary` and `export_trace`.
+"""
+
+import os
+import json
+import time
+import tempfile
+import threading
+from functools import wraps
+
+
+# spool directory of a profiled parent, inherited by its worker processes
+_SPOOL_ENV = 'EEGANALYSIS_PROFILE_SPOOL'
+
+
+class _State(object):
+    enabled = False
+    spool = None  # directory of the per-process event files
+    owner = None  # pid of the process that enabled the profiling
+
+
+_state = _State()
+_local = threading.local()
+_events = []
+_lock = threading.Lock()
+
+if os.environ.get(_SPOOL_ENV):  # a worker process started by a profiled parent
+    _state.enabled = True
+    _state.spool = os.environ[_SPOOL_ENV]
+
+
+def enable(spool=None):
+    '''
+    start recording stages.
+
+    keyword arguments:
+    - spool: directory of the event files of the worker processes
+             [default: None, a new temporary directory]
+    '''
+    if spool is None:
+        spool = _state.spool if _state.owner == os.getpid() else tempfile.mkdtemp(prefix='eeganalysis-profile-')
+    os.makedirs(spool, exist_ok=True)
+    _state.enabled, _state.spool, _state.owner = True, spool, os.getpid()
+    os.environ[_SPOOL_ENV] = spool
+
+
+def disable():
+    '''stop recording stages, the recorded events are kept.'''
+    _state.enabled = False
+    os.environ.pop(_SPOOL_ENV, None)
+
+
+def is_enabled():
+    return _state.enabled
+
+
+def _spool_files():
+    if _state.spool is None or not os.path.isdir(_state.spool):
+        return []
+    return [os.path.join(_state.spool, item) for item in sorted(os.listdir(_state.spool))
+            if item.endswith('.jsonl') and item != '%d.jsonl'%os.getpid()]
+
+
+def reset():
+    '''drop all the recorded events, of the worker processes too.'''
+    with _lock:
+        del _events[:]
+        for item in _spool_files():
+            os.remove(item)
+
+
+def _nbytes(obj):
+    '''total size of the arrays in the (nested) result of a stage.'''
+    if hasattr(obj, 'nbytes') and hasattr(obj, 'dtype'):
+        return int(obj.nbytes)
+    if isinstance(obj, (tuple, list)):
+        return sum([_nbytes(item) for item in obj])
+    if isinstance(obj, dict):
+        return sum([_nbytes(item) for item in obj.values()])
+    if hasattr(obj, '__dict__'):  # e.g. EDFData, count its array attributes
+        return sum([int(item.nbytes) for item in vars(obj).values()
+                    if hasattr(item, 'nbytes') and hasattr(item, 'dtype')])
+    return 0
+
+
+class stage(object):
+    '''
+    context manager recording the wall time of a stage.
+
+    the bytes read and written inside the stage are added by `record`,
+    the size of the arrays it allocates by `stage.allocated`.
+
+    arguments:
+    - name: the stage name
+    '''
+
+    __slots__ = ('name', 'start', 'read', 'written', 'alloc', 'active')
+
+    def __init__(self, name):
+        self.name = name
+        self.active = False
+
+    def __enter__(self):
+        if not _state.enabled:
+            return self
+        self.active = True
+        self.read = self.written = self.alloc = 0
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def allocated(self, obj):
+        if self.active:
+            self.alloc += _nbytes(obj)
+        return obj
+
+    def __exit__(self, *exc):
+        if not self.active:
+            return False
+        _end = time.perf_counter()
+        _local.stack.pop()
+        self.active = False
+        _event = {'name': self.name, 'start': self.start, 'duration': _end - self.start,
+                  'pid': os.getpid(), 'tid': threading.get_ident(),
+                  'read': self.read, 'written': self.written, 'alloc': self.alloc}
+        with _lock:
+            if os.getpid() == _state.owner or _state.spool is None:
+                _events.append(_event)
+            else:  # a worker process, it may exit without cleanup
+                with open(os.path.join(_state.spool, '%d.jsonl'%os.getpid()), 'a') as _f:
+                    _f.write(json.dumps(_event) + '\n')
+        return False
+
+
+def record(read=0, written=0):
+    '''
+    add bytes read or written to the innermost running stage.
+    '''
+
+    if not _state.enabled or not getattr(_local, 'stack', None):
+        return
+    _stage = _local.stack[-1]
+    _stage.read += read
+    _stage.written += written
+
+
+def instrument(name):
+    '''
+    decorator recording every call of a function as a stage, with the size
+    of the returned arrays as allocation.
+
+    arguments:
+    - name: the stage name
+    '''
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state.enabled:
+                return func(*args, **kwargs)
+            with stage(name) as _stage:
+                return _stage.allocated(func(*args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def events():
+    '''
+    recorded events of this process and its worker processes, as a list
+    of dicts ordered by start time. `time.perf_counter` is a system-wide
+    monotonic clock, so the start times of the processes are comparable.
+    '''
+    with _lock:
+        _result = list(_events)
+        for item in _spool_files():
+            with open(item, 'r') as _f:
+                for line in _f:
+                    try:
+                        _result.append(json.loads(line))
+                    except ValueError:
+                        pass  # partially written by a running worker
+    return sorted(_result, key=lambda item: item['start'])
+
+
+def summary():
+    '''
+    summary table of the recorded stages.
+
+    return:
+    - pandas.DataFrame indexed by stage, with the call counts, wall time
+      (total, mean, max, in seconds), bytes read/written and bytes allocated.
+    '''
+
+    import pandas as pd
+
+    _table = pd.DataFrame(events(), columns=['name', 'start', 'duration', 'pid', 'tid', 'read', 'written', 'alloc'])
+    _summary = _table.groupby('name').agg(calls=('duration', 'size'), total_s=('duration', 'sum'),
+                                         mean_s=('duration', 'mean'), max_s=('duration', 'max'),
+                                         read_bytes=('read', 'sum'), written_bytes=('written', 'sum'),
+                                         alloc_bytes=('alloc', 'sum'))
+    return _summary.sort_values('total_s', ascending=False)
+
+
+def export_trace(filename):
+    '''
+    export the recorded events as a chrome trace (json), to be viewed in
+    chrome://tracing or perfetto.
+    '''
+
+    _events = events()
+    _origin = min([item['start'] for item in _events]) if len(_events) > 0 else 0
+    _trace = [{'name': item['name'], 'cat': 'EEGAnalysis', 'ph': 'X',
+               'ts': (item['start'] - _origin) * 1e6, 'dur': item['duration'] * 1e6,
+               'pid': item['pid'], 'tid': item['tid'],
+               'args': {'read': item['read'], 'written': item['written'], 'alloc': item['alloc']}}
+              for item in _events]
+
+    with open(filename, 'w') as _f:
+        json.dump({'traceEvents': _trace, 'displayTimeUnit': 'ms'}, _f)
@@ -0,0 +1,282 @@
+"""
+permutation statistics of time-frequency maps
+
+tests operate on (trials x freq x time) tensors, e.g. the single trial
+power `np.abs(dwt(...)) ** 2` transposed to trials first, or the complex
+dwt coefficients for phase. permutations are drawn in batches and applied
+as matrix products: sign flips for one-sample tests, label shuffles for
+two-sample tests, so a batch costs one (batch x trials) @ (trials x pixels)
+product.
+
+>>> from EEGAnalysis import stats
+>>> T, p = stats.permutation_test(pxx, correction='max')
+>>> T, clusters, cluster_p, null = stats.cluster_test(pxx_a, pxx_b)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.ndimage as ndimage
+import scipy.stats as sp_stats
+
+
+class _Permuter(object):
+    '''
+    null distribution of a statistic, for batches of permutations.
+
+    arguments:
+    - data: (trials x ...) real or complex array
+    - labels: None for one-sample tests (sign flip), or (trials,) bool array
+              of the first condition for two-sample tests (label shuffle)
+    - tail: 0 two-sided, 1 greater, -1 less
+    - threshold: cluster forming threshold, None for no clusters
+    '''
+
+    def __init__(self, data, labels, tail, threshold):
+        self.shape = np.shape(data)[1:]
+        self.ntrial = np.size(data, 0)
+        self.labels = None if labels is None else np.asarray(labels, dtype='bool')
+        self.phase = np.iscomplexobj(data)
+        self.tail = tail
+        self.threshold = threshold
+
+        _data = np.reshape(data, (self.ntrial, -1))
+        if self.phase:
+            self.X = _data / np.abs(_data)  # unit phase vectors
+            if self.labels is None:
+                raise ValueError("phase tests need two conditions (`labels`).")
+        else:
+            self.X = np.asarray(_data, dtype='float64')
+            self.X2 = self.X ** 2
+            self.sum2 = np.sum(self.X2, 0)
+        self.sum = np.sum(self.X, 0)
+
+    def statistic(self, perm):
+        '''
+        statistics of a batch of permutations, (batch x pixels).
+
+        perm is (batch x trials): +1/-1 for sign flips, 1/0 for the labels.
+        '''
+
+        perm = np.atleast_2d(perm)
+        if self.labels is None:
+            _n = self.ntrial
+            _mean = perm.dot(self.X) / _n
+            _var = (self.sum2 - _n * _mean ** 2) / (_n - 1)
+            return _mean / np.sqrt(_var / _n)
+
+        _n1 = np.sum(perm[0])
+        _n2 = self.ntrial - _n1
+        _s1 = perm.dot(self.X)
+        _s2 = self.sum - _s1
+        if self.phase:  # ITPC difference
+            return np.abs(_s1) / _n1 - np.abs(_s2) / _n2
+
+        _q1 = perm.dot(self.X2)
+        _q2 = self.sum2 - _q1
+        _m1, _m2 = _s1 / _n1, _s2 / _n2
+        _v1 = (_q1 - _n1 * _m1 ** 2) / (_n1 - 1)
+        _v2 = (_q2 - _n2 * _m2 ** 2) / (_n2 - 1)
+        return (_m1 - _m2) / np.sqrt(_v1 / _n1 + _v2 / _n2)  # welch t
+
+    def observed(self):
+        if self.labels is None:
+            return self.statistic(np.ones(self.ntrial))[0]
+        return self.statistic(self.labels.astype('float64'))[0]
+
+    def permutations(self, rng, n):
+        if self.labels is None:
+            return rng.choice([-1.0, 1.0], size=(n, self.ntrial))
+        _order = np.argsort(rng.random((n, self.ntrial)), axis=1)
+        _perm = np.zeros((n, self.ntrial))
+        np.put_along_axis(_perm, _order[:, :np.sum(self.labels)], 1.0, axis=1)
+        return _perm
+
+    def tailed(self, stat):
+        if self.tail == 0:
+            return np.abs(stat)
+        return stat * self.tail
+
+    def run(self, seed, n, observed, batch):
+        '''
+        n permutations drawn from `seed`, in batches.
+
+        return:
+        - count: (pixels,) number of permutations at least as extreme as `observed`
+        - maxstat: (n,) maximum statistic of every permutation
+        - maxmass: (n,) maximum cluster mass of every permutation, or None
+        '''
+
+        rng = np.random.default_rng(seed)
+        _observed = self.tailed(observed)
+        _count = np.zeros(np.size(observed), dtype='int')
+        _maxstat, _maxmass = [], []
+        for start in range(0, n, batch):
+            _stat = self.statistic(self.permutations(rng, min(batch, n - start)))
+            _tailed = self.tailed(_stat)
+            _count += np.sum(_tailed >= _observed, 0)
+            _maxstat.append(np.max(_tailed, 1))
+            if self.threshold is not None:
+                _maxmass.append([np.max(np.abs(find_clusters(item.reshape(self.shape), self.threshold, self.tail)[1]),
+                                        initial=0) for item in _stat])
+
+        return _count, np.hstack(_maxstat), (np.hstack(_maxmass) if self.threshold is not None else None)
+
+
+_worker = {}
+
+
+def _init_worker(data, labels, tail, threshold):
+    _worker['permuter'] = _Permuter(data, labels, tail, threshold)
+
+
+def _run_worker(args):
+    return _worker['permuter'].run(*args)
+
+
+def find_clusters(stat, threshold, tail=0):
+    """connected clusters of a statistic map above threshold
+
+    Syntax: labels, masses = find_clusters(stat, threshold, tail)
+
+    Keyword arguments:
+    stat      -- (numpy.ndarray) statistic map, e.g. (freq x time)
+    threshold -- (float) cluster forming threshold, positive
+    tail      -- (int) 0 for positive and negative clusters, 1 for positive,
+                 -1 for negative clusters [default: 0]
+
+    Return:
+    labels    -- (numpy.ndarray) cluster label of every pixel, 0 outside clusters
+    masses    -- (numpy.ndarray) signed sum of the statistic of every cluster,
+                 cluster `i` has label `i+1`
+    """
+
+    labels = np.zeros(np.shape(stat), dtype='int')
+    masses = []
+    for sign in ([1, -1] if tail == 0 else [tail]):
+        _labels, _n = ndimage.label(stat * sign > threshold)
+        if _n == 0:
+            continue
+        masses.append(ndimage.sum(stat, _labels, np.arange(1, _n + 1)))
+        labels[_labels > 0] = _labels[_labels > 0] + np.max(labels)
+    masses = np.hstack(masses) if len(masses) > 0 else np.zeros(0)
+    return labels, masses
+
+
+def _null(data, labels, n_perm, tail, threshold, batch, seed, processes):
+    _permuter = _Permuter(data, labels, tail, threshold)
+    _observed = _permuter.observed()
+
+    # one seed per chunk, so the result does not depend on `processes`
+    _chunk = batch * 4
+    _sizes = [min(_chunk, n_perm - start) for start in range(0, n_perm, _chunk)]
+    _seeds = np.random.SeedSequence(seed).spawn(len(_sizes))
+    _jobs = [(item, size, _observed, batch) for item, size in zip(_seeds, _sizes)]
+
+    if processes is None or processes == 1:
+        _results = [_permuter.run(*job) for job in _jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                 initargs=(data, labels, tail, threshold)) as _pool:
+            _results = list(_pool.map(_run_worker, _jobs))
+
+    _count = np.sum([item[0] for item in _results], 0)
+    _maxstat = np.hstack([item[1] for item in _results])
+    _maxmass = np.hstack([item[2] for item in _results]) if threshold is not None else None
+    return _permuter, _observed, _count, _maxstat, _maxmass
+
+
+def _split(data, other):
+    '''stack two conditions, return (data, labels of the first condition).'''
+    if other is None:
+        return data, None
+    _labels = np.hstack((np.ones(len(data), dtype='bool'), np.zeros(len(other), dtype='bool')))
+    return np.concatenate((data, other), axis=0), _labels
+
+
+def permutation_test(data, other=None, n_perm=1000, tail=0, correction='max',
+                     batch=100, seed=None, processes=None):
+    """pixel-wise permutation test of time-frequency maps
+
+    one-sample t-test against 0 by sign flips, if `other` is None, else
+    two-sample welch t-test by label shuffles. complex (phase) data is
+    tested by the ITPC difference between the two conditions.
+
+    Syntax: T, p = permutation_test(data, other, n_perm, tail, correction, batch, seed, processes)
+
+    Keyword arguments:
+    data       -- (numpy.ndarray) (trials x freq x time) of the first condition
+    other      -- (numpy.ndarray) (trials x freq x time) of the second condition
+                  [default: None, one-sample test]
+    n_perm     -- (int) number of permutations [default: 1000]
+    tail       -- (int) 0 two-sided, 1 greater, -1 less [default: 0]
+    correction -- (str) 'max' for family-wise correction by the maximum
+                  statistic, 'none' for uncorrected p-values [default: 'max']
+    batch      -- (int) permutations per matrix product, bounds the memory to
+                  batch x pixels x 8 bytes [default: 100]
+    seed       -- (int) random seed [default: None]
+    processes  -- (int) worker processes [default: None, in process]
+
+    Return:
+    T          -- (numpy.ndarray) (freq x time) observed statistic
+    p          -- (numpy.ndarray) (freq x time) p-values
+    """
+
+    data, labels = _split(data, other)
+    _permuter, _observed, _count, _maxstat, _ = _null(data, labels, n_perm, tail, None, batch, seed, processes)
+
+    if correction == 'max':
+        _tailed = _permuter.tailed(_observed)
+        _count = np.searchsorted(np.sort(_maxstat), _tailed, side='left')
+        _count = n_perm - _count
+    elif correction != 'none':
+        raise ValueError("unknown `correction` value.")
+
+    _p = (_count + 1) / (n_perm + 1)
+    return _observed.reshape(_permuter.shape), _p.reshape(_permuter.shape)
+
+
+def cluster_test(data, other=None, threshold=None, n_perm=1000, tail=0,
+                 batch=100, seed=None, processes=None):
+    """cluster-mass permutation test of time-frequency maps
+
+    clusters are the connected pixels (face connectivity) whose statistic is
+    beyond `threshold`, their mass is the sum of the statistic. the p-value
+    of a cluster is the fraction of permutations whose largest cluster mass
+    is at least as extreme.
+
+    Syntax: T, clusters, cluster_p, null = cluster_test(data, other, threshold, n_perm, tail, batch, seed, processes)
+
+    Keyword arguments:
+    data      -- (numpy.ndarray) (trials x freq x time) of the first condition
+    other     -- (numpy.ndarray) (trials x freq x time) of the second condition
+                 [default: None, one-sample test]
+    threshold -- (float) cluster forming threshold [default: None, the t value
+                 of p < 0.05; required for phase data]
+    n_perm    -- (int) number of permutations [default: 1000]
+    tail      -- (int) 0 two-sided, 1 greater, -1 less [default: 0]
+    batch     -- (int) permutations per matrix product [default: 100]
+    seed      -- (int) random seed [default: None]
+    processes -- (int) worker processes [default: None, in process]
+
+    Return:
+    T         -- (numpy.ndarray) (freq x time) observed statistic
+    clusters  -- (numpy.ndarray) (freq x time) cluster labels, 0 outside clusters
+    cluster_p -- (numpy.ndarray) p-value of every cluster, cluster `i` has label `i+1`
+    null      -- (numpy.ndarray) (n_perm,) largest cluster mass of every permutation
+    """
+
+    data, labels = _split(data, other)
+    if threshold is None:
+        if np.iscomplexobj(data):
+            raise ValueError("`threshold` is required for phase data.")
+        _df = len(data) - 1 if labels is None else len(data) - 2
+        threshold = sp_stats.t.ppf(1 - 0.05 / (2 if tail == 0 else 1), _df)
+
+    _permuter, _observed, _, _, _maxmass = _null(data, labels, n_perm, tail, threshold, batch, seed, processes)
+
+    _T = _observed.reshape(_permuter.shape)
+    _clusters, _masses = find_clusters(_T, threshold, tail)
+    _null_sorted = np.sort(_maxmass)
+    _count = n_perm - np.searchsorted(_null_sorted, np.abs(_masses), side='left')
+    return _T, _clusters, (_count + 1) / (n_perm + 1), _maxmass
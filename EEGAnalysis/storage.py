@@ -0,0 +1,544 @@
+"""
+isplit storage backends
+
+a store holds one 1d recording per (channel, file name), with its physical
+unit and sampling rate, behind a common read-window/write-chunk API:
+
+- `HDF5Store`: the `ChannelNNN.h5` layout, one hdf5 file per channel with
+  one group per file name (datasets "value", "unit" and "freq").
+- `DirectoryStore`: a chunked directory layout, `ChannelNNN/<name>/` with a
+  `meta.json` and one `.npy` file per chunk. every chunk is written to a
+  temporary file and renamed, so processes can write concurrently, without
+  hdf5 file locking, as long as they write different chunks.
+
+the backend of a patient is the "backend" entry of `isplit.json`
+("hdf5" if missing).
+
+next to every recording, a store can hold a summary pyramid, i.e. the
+min/max/RMS of every bin of `factor` samples for a few decimation factors,
+see `summarize`, for browsing long recordings without reading them.
+
+a recording resampled to another rate is stored as a derived recording of
+the same channel, named "<name>@<freq>Hz", see `resampled_name`. derived
+recordings are not listed by `names()` of the readers.
+"""
+
+import os, re, json
+from hashlib import sha256
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import h5py
+from tqdm import tqdm
+
+from . import profiling
+from .ingest import atomic_write
+
+
+def channel_name(chidx):
+    return 'Channel%03d'%(chidx + 1)
+
+
+def resampled_name(name, freq=None):
+    '''
+    name of the derived recording of `name` resampled to `freq` Hz, or
+    `name` itself if `freq` is None.
+    '''
+    return name if freq is None else '%s@%gHz'%(name, freq)
+
+
+def is_derived(name):
+    return '@' in name
+
+
+def derived_from(item, name):
+    '''whether `item` is a recording derived from `name`, e.g. resampled.'''
+    return item.startswith(name + '@')
+
+
+class Store(object):
+    '''
+    common interface of the isplit backends.
+
+    arguments:
+    - root: the isplit directory of the patient
+    '''
+
+    # whether processes can write different recordings of a channel at once
+    concurrent = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def reader(self, chidx):
+        '''
+        reader of one channel, to be used as a context manager, with methods
+        `names()`, `info(name)`, `read(name, start, stop)`, and
+        `factors(name)` and `read_pyramid(name, factor, start, stop)` of
+        the summary pyramid.
+        '''
+        raise NotImplementedError
+
+    def channels(self):
+        '''channel indices in the store.'''
+        raise NotImplementedError
+
+    def create(self, chidx, name, length, dtype, unit, freq, compression_level=4):
+        '''
+        create (or replace) an empty recording of `length` samples. the
+        recordings derived from a replaced recording are deleted, they are
+        stale.
+        '''
+        raise NotImplementedError
+
+    def write_chunk(self, chidx, name, start, data):
+        '''
+        write `data` at sample `start` of a created recording.
+
+        return:
+        - number of bytes written to disk
+        '''
+        raise NotImplementedError
+
+    def delete(self, chidx, name):
+        raise NotImplementedError
+
+    def write(self, chidx, name, value, unit, freq, compression_level=4):
+        '''
+        write a whole recording.
+
+        return:
+        - number of bytes written to disk
+        '''
+
+        value = np.asarray(value)
+        self.create(chidx, name, len(value), value.dtype, unit, freq, compression_level=compression_level)
+        return self.write_chunk(chidx, name, 0, value)
+
+    def write_pyramid(self, chidx, name, pyramid):
+        '''
+        write the summary pyramid of a recording, see `summarize`.
+
+        return:
+        - number of bytes written to disk
+        '''
+        raise NotImplementedError
+
+    def names(self, chidx):
+        with self.reader(chidx) as _reader:
+            return _reader.names()
+
+    def read_window(self, chidx, name, start=0, stop=None):
+        '''samples [start, stop) of a recording.'''
+        with self.reader(chidx) as _reader:
+            return _reader.read(name, start, stop)
+
+    def nbytes(self, chidx):
+        '''size in memory of all the recordings of a channel, in bytes.'''
+        with self.reader(chidx) as _reader:
+            return sum([_reader.info(name)['length'] * np.dtype(_reader.info(name)['dtype']).itemsize
+                        for name in _reader.names()])
+
+
+class _HDF5Reader(object):
+
+    def __init__(self, path):
+        self._file = h5py.File(path, 'r') if os.path.isfile(path) else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def names(self):
+        return [] if self._file is None else [item for item in self._file.keys() if not is_derived(item)]
+
+    def info(self, name):
+        if self._file is None or name not in self._file:
+            raise ValueError("name not found: \"%s\""%name)
+        _group = self._file[name]
+        return {'unit': float(np.array(_group['unit'])), 'freq': float(np.array(_group['freq'])),
+                'length': _group['value'].shape[0], 'dtype': _group['value'].dtype.str}
+
+    def read(self, name, start=0, stop=None):
+        if self._file is None or name not in self._file:
+            raise ValueError("name not found: \"%s\""%name)
+        _value = self._file[name]['value']
+        _result = _value[start:stop]
+        profiling.record(read=_result.nbytes)
+        return _result
+
+    def factors(self, name):
+        if self._file is None or name not in self._file or 'pyramid' not in self._file[name]:
+            return []
+        return sorted([int(item) for item in self._file[name]['pyramid'].keys()])
+
+    def read_pyramid(self, name, factor, start=0, stop=None):
+        if factor not in self.factors(name):
+            raise ValueError("no summary of factor %d: \"%s\""%(factor, name))
+        _result = self._file[name]['pyramid']['%d'%factor][start:stop]
+        profiling.record(read=_result.nbytes)
+        return _result
+
+
+class HDF5Store(Store):
+    '''
+    one `ChannelNNN.h5` file per channel.
+    '''
+
+    def _path(self, chidx):
+        return os.path.join(self.root, '%s.h5'%channel_name(chidx))
+
+    def reader(self, chidx):
+        return _HDF5Reader(self._path(chidx))
+
+    def channels(self):
+        return sorted([int(item[7:10]) - 1 for item in os.listdir(self.root)
+                       if re.match(r'Channel\d{3}\.h5$', item)])
+
+    def create(self, chidx, name, length, dtype, unit, freq, compression_level=4):
+        with h5py.File(self._path(chidx), 'a') as _f:
+            for item in list(_f.keys()):
+                if item == name or derived_from(item, name):
+                    del _f[item]
+            _f.create_group(name)
+            _f.create_dataset(name='%s/unit'%name, data=unit)
+            _f.create_dataset(name='%s/value'%name, shape=(length,), dtype=dtype,
+                              compression="gzip", compression_opts=compression_level)
+            _f.create_dataset(name="%s/freq"%name, data=freq)
+
+    def write_chunk(self, chidx, name, start, data):
+        with h5py.File(self._path(chidx), 'a') as _f:
+            _value = _f[name]['value']
+            _before = _value.id.get_storage_size()
+            _value[start:start + len(data)] = data
+            _f.flush()
+            return _value.id.get_storage_size() - _before
+
+    def write_pyramid(self, chidx, name, pyramid):
+        with h5py.File(self._path(chidx), 'a') as _f:
+            if 'pyramid' in _f[name]:
+                del _f[name]['pyramid']
+            _group = _f[name].create_group('pyramid')
+            _written = 0
+            for factor, summary in pyramid.items():
+                _dataset = _group.create_dataset('%d'%factor, data=summary)
+                _written += _dataset.id.get_storage_size()
+            return _written
+
+    def delete(self, chidx, name):
+        if not os.path.isfile(self._path(chidx)):
+            return
+        with h5py.File(self._path(chidx), 'a') as _f:
+            if name in _f:
+                del _f[name]
+
+
+class _DirectoryReader(object):
+
+    def __init__(self, path):
+        self._path = path
+        self._info = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def close(self):
+        pass
+
+    def names(self):
+        if not os.path.isdir(self._path):
+            return []
+        return sorted([item for item in os.listdir(self._path)
+                       if not is_derived(item) and os.path.isfile(os.path.join(self._path, item, 'meta.json'))])
+
+    def info(self, name):
+        if name not in self._info:
+            _meta_path = os.path.join(self._path, name, 'meta.json')
+            if not os.path.isfile(_meta_path):
+                raise ValueError("name not found: \"%s\""%name)
+            with open(_meta_path, 'r') as _f:
+                self._info[name] = json.loads(_f.read())
+        return self._info[name]
+
+    def read(self, name, start=0, stop=None):
+        _info = self.info(name)
+        _chunk = _info['chunk']
+        stop = _info['length'] if stop is None else min(stop, _info['length'])
+        start = min(start, stop)
+
+        _result = np.zeros(stop - start, dtype=_info['dtype'])
+        if stop == start:
+            return _result
+        for idx in range(start // _chunk, (stop - 1) // _chunk + 1):
+            _path = os.path.join(self._path, name, '%d.npy'%idx)
+            if not os.path.isfile(_path):
+                continue  # never written, i.e. zeros
+            _data = np.load(_path, mmap_mode='r')
+            _lo, _hi = max(start, idx * _chunk), min(stop, (idx + 1) * _chunk)
+            _result[_lo - start:_hi - start] = _data[_lo - idx * _chunk:_hi - idx * _chunk]
+        profiling.record(read=_result.nbytes)
+        return _result
+
+    def factors(self, name):
+        _dir = os.path.join(self._path, name)
+        if not os.path.isdir(_dir):
+            return []
+        return sorted([int(item[8:-4]) for item in os.listdir(_dir) if re.match(r'pyramid_\d+\.npy$', item)])
+
+    def read_pyramid(self, name, factor, start=0, stop=None):
+        _path = os.path.join(self._path, name, 'pyramid_%d.npy'%factor)
+        if not os.path.isfile(_path):
+            raise ValueError("no summary of factor %d: \"%s\""%(factor, name))
+        _result = np.array(np.load(_path, mmap_mode='r')[start:stop])
+        profiling.record(read=_result.nbytes)
+        return _result
+
+
+class DirectoryStore(Store):
+    '''
+    chunked directory store, `ChannelNNN/<name>/{meta.json, 0.npy, 1.npy, ...}`.
+
+    keyword arguments:
+    - chunk: samples per chunk file [default: 2**20]
+    '''
+
+    concurrent = True
+
+    def __init__(self, root, chunk=2 ** 20):
+        super().__init__(root)
+        self.chunk = chunk
+
+    def _path(self, chidx):
+        return os.path.join(self.root, channel_name(chidx))
+
+    def reader(self, chidx):
+        return _DirectoryReader(self._path(chidx))
+
+    def channels(self):
+        return sorted([int(item[7:]) - 1 for item in os.listdir(self.root)
+                       if re.match(r'Channel\d{3}$', item) and os.path.isdir(os.path.join(self.root, item))])
+
+    def create(self, chidx, name, length, dtype, unit, freq, compression_level=4):
+        self.delete(chidx, name)
+        if os.path.isdir(self._path(chidx)):
+            for item in os.listdir(self._path(chidx)):
+                if derived_from(item, name):
+                    self.delete(chidx, item)
+        _dir = os.path.join(self._path(chidx), name)
+        os.makedirs(_dir, exist_ok=True)
+        atomic_write(os.path.join(_dir, 'meta.json'), json.dumps({
+            'unit': float(unit), 'freq': float(freq), 'length': int(length),
+            'dtype': np.dtype(dtype).str, 'chunk': self.chunk}))
+
+    def write_chunk(self, chidx, name, start, data):
+        _dir = os.path.join(self._path(chidx), name)
+        _info = self.reader(chidx).info(name)
+        _chunk = _info['chunk']
+        data = np.asarray(data, dtype=_info['dtype'])
+        _stop = start + len(data)
+
+        _written = 0
+        for idx in range(start // _chunk, (_stop - 1) // _chunk + 1):
+            _lo, _hi = max(start, idx * _chunk), min(_stop, (idx + 1) * _chunk, _info['length'])
+            _path = os.path.join(_dir, '%d.npy'%idx)
+            _size = min(_chunk, _info['length'] - idx * _chunk)
+            if _hi - _lo == _size:
+                _block = data[_lo - start:_hi - start]
+            else:  # partial chunk, read-modify-write
+                _block = np.load(_path) if os.path.isfile(_path) else np.zeros(_size, dtype=_info['dtype'])
+                _block[_lo - idx * _chunk:_hi - idx * _chunk] = data[_lo - start:_hi - start]
+
+            _temp = '%s.%d.tmp'%(_path, os.getpid())
+            with open(_temp, 'wb') as _f:
+                np.save(_f, _block)
+            os.replace(_temp, _path)
+            _written += _block.nbytes
+        return _written
+
+    def write_pyramid(self, chidx, name, pyramid):
+        _dir = os.path.join(self._path(chidx), name)
+        for item in os.listdir(_dir):
+            if re.match(r'pyramid_\d+\.npy$', item):
+                os.remove(os.path.join(_dir, item))
+
+        _written = 0
+        for factor, summary in pyramid.items():
+            _path = os.path.join(_dir, 'pyramid_%d.npy'%factor)
+            _temp = '%s.%d.tmp'%(_path, os.getpid())
+            with open(_temp, 'wb') as _f:
+                np.save(_f, np.asarray(summary))
+            os.replace(_temp, _path)
+            _written += np.asarray(summary).nbytes
+        return _written
+
+    def delete(self, chidx, name):
+        _dir = os.path.join(self._path(chidx), name)
+        if not os.path.isdir(_dir):
+            return
+        for item in os.listdir(_dir):
+            os.remove(os.path.join(_dir, item))
+        os.rmdir(_dir)
+
+
+PYRAMID_FACTORS = (10, 100, 1000)
+
+
+def _reduce_bins(minimum, maximum, square, count, factor):
+    _index = np.arange(0, len(minimum), factor)
+    return (np.minimum.reduceat(minimum, _index), np.maximum.reduceat(maximum, _index),
+            np.add.reduceat(square, _index), np.add.reduceat(count, _index))
+
+
+def summarize(read, length, factors=PYRAMID_FACTORS, block=2 ** 22):
+    '''
+    min/max/RMS summary pyramid of a recording, in one streaming pass. every
+    level is reduced from the previous one, so each factor must divide the
+    next one.
+
+    arguments:
+    - read: function(start, stop), samples [start, stop) of the recording
+    - length: number of samples
+
+    keyword arguments:
+    - factors: decimation factors of the levels [default: (10, 100, 1000)]
+    - block: samples read at once, rounded to the largest factor [default: 2**22]
+
+    return:
+    - dict{factor: (ceil(length / factor) x 3) float32 array}, the columns
+      are the min, max and RMS of the bins, in stored (not physical) units
+    '''
+
+    factors = sorted(factors)
+    for lower, upper in zip(factors[:-1], factors[1:]):
+        if upper % lower != 0:
+            raise ValueError("every factor must divide the next one.")
+
+    # blocks aligned to the largest factor, so no bin spans two blocks
+    _block = max(block // factors[-1], 1) * factors[-1]
+    _levels = dict([(factor, []) for factor in factors])
+    for start in range(0, length, _block):
+        _chunk = np.asarray(read(start, min(start + _block, length)), dtype='float64')
+        _stats = (_chunk, _chunk, _chunk ** 2, np.ones(len(_chunk)))
+        _previous = 1
+        for factor in factors:
+            _stats = _reduce_bins(*_stats, factor // _previous)
+            _previous = factor
+            _levels[factor].append(np.vstack((_stats[0], _stats[1], np.sqrt(_stats[2] / _stats[3]))).T)
+
+    return dict([(factor, np.concatenate(_levels[factor]).astype('float32') if _levels[factor]
+                  else np.zeros((0, 3), dtype='float32')) for factor in factors])
+
+
+BACKENDS = {'hdf5': HDF5Store, 'directory': DirectoryStore}
+
+
+def open_store(root, backend='hdf5'):
+    '''
+    the store of an isplit directory.
+
+    arguments:
+    - root: the isplit directory
+    - backend: 'hdf5' or 'directory' [default: 'hdf5']
+    '''
+
+    if backend not in BACKENDS:
+        raise ValueError("unknown `backend` value.")
+    return BACKENDS[backend](root)
+
+
+def _legacy_files(legacy_dir):
+    '''
+    the recordings of a legacy .mat SgCh directory.
+
+    layouts:
+    - chNNN/<name>_chNNN.mat, from `io.splitdata` and `EDFData.splitinto`
+    - sgch_channel_NNN.mat, read by `container.iSplitContainer`
+
+    return:
+    - dict{chidx: list of paths}
+    '''
+
+    _files = {}
+    for item in sorted(os.listdir(legacy_dir)):
+        _path = os.path.join(legacy_dir, item)
+        _match = re.match(r'ch(\d{3})$', item)
+        if _match and os.path.isdir(_path):
+            for each in sorted(os.listdir(_path)):
+                if re.match(r'.*_ch\d{3}\.mat$', each):
+                    _files.setdefault(int(_match.group(1)), []).append(os.path.join(_path, each))
+            continue
+        _match = re.match(r'sgch_channel_(\d{3})\.mat$', item)
+        if _match:
+            _files.setdefault(int(_match.group(1)), []).append(_path)
+    return _files
+
+
+def _read_legacy(path):
+    '''
+    recordings of a legacy .mat file.
+
+    return:
+    - list of (name, value, unit, freq)
+    '''
+
+    from scipy.io import loadmat
+
+    _mat = loadmat(path)
+    _basename = os.path.basename(path)
+    if 'edfnames' in _mat:  # sgch_channel_NNN.mat, one entry per edf file
+        _names = [str(item).strip() for item in _mat['edfnames']]
+        return [(name, np.ravel(_mat['values'][0][idx]), float(np.ravel(_mat['physicalunit'][0][idx])[0]),
+                 float(np.ravel(_mat['samplingfrequency'][0][idx])[0])) for idx, name in enumerate(_names)]
+
+    _name = re.sub(r'_ch\d{3}\.mat$', '', _basename)
+    _unit = float(np.ravel(_mat['physical_unit'])[0]) if 'physical_unit' in _mat else 1.0
+    return [(_name, np.ravel(_mat['values']), _unit, float(np.ravel(_mat['fs'])[0]))]
+
+
+def _convert_channel(store, chidx, paths, overwrite, compression_level):
+    _names = store.names(chidx)
+    _result = []
+    for path in paths:
+        for name, value, unit, freq in _read_legacy(path):
+            if name in _names and not overwrite:
+                continue
+            store.write(chidx, name, value, unit, freq, compression_level=compression_level)
+            _result.append((name, sha256(value).hexdigest()))
+    return chidx, _result
+
+
+def convert_legacy(legacy_dir, store, processes=None, overwrite=False, compression_level=4):
+    '''
+    migrate a legacy .mat SgCh directory into a store, one channel per
+    process, i.e. every channel file or directory has a single writer.
+
+    arguments:
+    - legacy_dir: the legacy SgCh directory
+    - store: the target `Store`
+
+    keyword arguments:
+    - processes: number of worker processes [default: os.cpu_count()]
+    - overwrite: replace recordings already in the store [default: False]
+    - compression_level: gzip level of `HDF5Store` [default: 4]
+
+    yields:
+    - (chidx, list of (name, sha256 of the values)) of every converted channel
+    '''
+
+    _files = _legacy_files(legacy_dir)
+    with ProcessPoolExecutor(max_workers=processes) as _pool:
+        _futures = [_pool.submit(_convert_channel, store, chidx, paths, overwrite, compression_level)
+                    for chidx, paths in _files.items()]
+        for _future in tqdm(as_completed(_futures), total=len(_futures)):
+            yield _future.result()
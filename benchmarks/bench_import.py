@@ -0,0 +1,92 @@
+"""
+cold-start benchmark of the package
+
+measures, each in fresh interpreters:
+- `import EEGAnalysis`
+- `import EEGAnalysis.datamanager`, i.e. what a batch worker imports
+- spawning a process-pool worker and running a first job in it
+
+and lists the heavy optional modules (matplotlib, IPython, scipy.signal)
+loaded by `import EEGAnalysis`, which should be none.
+
+usage:
+    python benchmarks/bench_import.py --repeat 10 --out import.json
+"""
+
+import os, sys, json, time, argparse, platform, subprocess
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+
+HEAVY = ['matplotlib', 'IPython', 'scipy.signal', 'pandas', 'h5py']
+
+
+def _time_import(statement, repeat):
+    '''seconds of `statement` in fresh interpreters, including interpreter startup.'''
+    _env = dict(os.environ, PYTHONPATH=_ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    _seconds = []
+    for _ in range(repeat):
+        _t0 = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], check=True, env=_env)
+        _seconds.append(time.perf_counter() - _t0)
+    return _seconds
+
+
+def _loaded_modules(statement):
+    _env = dict(os.environ, PYTHONPATH=_ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    _code = '%s\nimport sys, json\nprint(json.dumps([m for m in %r if m in sys.modules]))'%(statement, HEAVY)
+    _out = subprocess.run([sys.executable, '-c', _code], check=True, env=_env, capture_output=True, text=True)
+    return json.loads(_out.stdout.strip().splitlines()[-1])
+
+
+def _worker_job():
+    import EEGAnalysis.datamanager  # the import of a batch worker, see `batch._get_worker_patient`
+    return os.getpid()
+
+
+def _time_worker(repeat):
+    '''seconds from creating a spawned pool to the result of its first job.'''
+    _context = mp.get_context('spawn')
+    _seconds = []
+    for _ in range(repeat):
+        _t0 = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=1, mp_context=_context) as _pool:
+            _pool.submit(_worker_job).result()
+            _seconds.append(time.perf_counter() - _t0)
+    return _seconds
+
+
+def _summary(seconds):
+    _sorted = sorted(seconds)
+    return {'min': _sorted[0], 'median': _sorted[len(_sorted) // 2], 'max': _sorted[-1]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='cold-start benchmark of EEGAnalysis.')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per measurement')
+    parser.add_argument('--out', default=None, help='json result file')
+    args = parser.parse_args(argv)
+
+    _baseline = _time_import('pass', args.repeat)
+    result = {'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                       'time': time.strftime('%Y-%m-%d %H:%M:%S')},
+              'interpreter': _summary(_baseline),
+              'import EEGAnalysis': _summary(_time_import('import EEGAnalysis', args.repeat)),
+              'import EEGAnalysis.datamanager': _summary(_time_import('import EEGAnalysis.datamanager', args.repeat)),
+              'spawn worker': _summary(_time_worker(args.repeat)),
+              'loaded by import EEGAnalysis': _loaded_modules('import EEGAnalysis')}
+
+    for name in ['interpreter', 'import EEGAnalysis', 'import EEGAnalysis.datamanager', 'spawn worker']:
+        print('%-34s %8.3f s (median) %8.3f s (min)'%(name, result[name]['median'], result[name]['min']))
+    print('%-34s %s'%('loaded by import EEGAnalysis', ', '.join(result['loaded by import EEGAnalysis']) or '-'))
+
+    if args.out is not None:
+        with open(args.out, 'w') as _f:
+            json.dump(result, _f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+"""
+benchmarks of the ingestion and decomposition hot paths
+
+every stage runs in a fresh process, so that its peak RSS is its own.
+results are written as json, and can be compared with a previous run.
+
+usage:
+    python benchmarks/bench_pipeline.py --out bench.json
+    python benchmarks/bench_pipeline.py --channels 32 --hours 1 --out new.json \
+        --compare bench.json --threshold 0.2
+"""
+
+import os, sys, json, time, shutil, argparse, platform, resource, tempfile
+import multiprocessing as mp
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+STAGES = ['edf_load', 'create_isplit', 'load_isplit', 'create_epoch_bymarker',
+          'dwt', 'dwt_power', 'dwt_itpc', 'stfft']
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on linux, in bytes on macos
+    _rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return _rss / 1024 ** 2 if sys.platform == 'darwin' else _rss / 1024
+
+
+def _epochs(param):
+    _rng = np.random.default_rng(0)
+    _gap = int(3 * param['fs'])
+    return (_rng.standard_normal((param['trials'], _gap)) * 300).astype('int16')
+
+
+def _stage(name, param):
+    '''
+    run one stage, return (seconds, amount of work). only the stage itself is timed.
+    '''
+
+    import EEGAnalysis as ea
+    from EEGAnalysis.decomposition import stfft, dwt_power, dwt_itpc
+    from EEGAnalysis.decomposition.dwt import dwt
+
+    _work_dir = param['work_dir']
+    _patient_id = 'bench'
+    _frange = np.logspace(np.log10(1), np.log10(150), param['nfreq'])
+
+    if name == 'edf_load':
+        _file = os.path.join(_work_dir, '_raw_' + _patient_id, 'rec00.edf')
+        _t0 = time.perf_counter()
+        ea.io.loadedf(_file, 'bench')
+        return time.perf_counter() - _t0, os.path.getsize(_file) / 1024 ** 2
+
+    if name == 'create_isplit':
+        _patient = ea.DataManager(_work_dir).get_patient(_patient_id)
+        for item in os.listdir(_patient._sgch_dir):
+            os.remove(os.path.join(_patient._sgch_dir, item))
+        with open(os.path.join(_patient._sgch_dir, 'isplit.json'), 'w') as _f:
+            _f.write('{}')
+        _patient = ea.DataManager(_work_dir).get_patient(_patient_id)
+        _t0 = time.perf_counter()
+        _patient.create_isplit()
+        _seconds = time.perf_counter() - _t0
+        return _seconds, param['channels'] * param['samples'] * 2 / 1024 ** 2
+
+    if name == 'load_isplit':
+        _patient = ea.DataManager(_work_dir).get_patient(_patient_id)
+        _t0 = time.perf_counter()
+        for chidx in range(param['channels']):
+            _patient.load_isplit(chidx)
+        return time.perf_counter() - _t0, param['channels'] * param['samples'] * 2 / 1024 ** 2
+
+    if name == 'create_epoch_bymarker':
+        _patient = ea.DataManager(_work_dir).get_patient(_patient_id)
+        _value = np.array([_patient.load_isplit(chidx, 'rec00')['rec00']['value']
+                           for chidx in range(param['channels'])])
+        _markers = np.array(param['markers'])
+        _t0 = time.perf_counter()
+        ea.create_epoch_bymarker(_value, _markers, (-1, 2), param['fs'])
+        for chidx in range(param['channels']):
+            ea.create_1d_epoch_bymarker(_value[chidx], _markers, (-1, 2), param['fs'])
+        return time.perf_counter() - _t0, 2 * param['channels'] * len(_markers)
+
+    _epoch = _epochs(param)
+    _channel_seconds = param['trials'] * 3.0
+
+    if name == 'dwt':
+        _t0 = time.perf_counter()
+        dwt(_epoch, param['fs'], _frange, reflection=True)
+        return time.perf_counter() - _t0, _channel_seconds
+
+    if name == 'stfft':
+        _t0 = time.perf_counter()
+        stfft(_epoch, param['fs'] // 4, param['fs'] // 8, param['fs'])
+        return time.perf_counter() - _t0, _channel_seconds
+
+    _result = dwt(_epoch, param['fs'], _frange, reflection=True)
+    if name == 'dwt_power':
+        _t0 = time.perf_counter()
+        dwt_power(_result, param['fs'], zscore=True)
+        return time.perf_counter() - _t0, param['trials']
+
+    if name == 'dwt_itpc':
+        _t0 = time.perf_counter()
+        dwt_itpc(_result, itpcz=True)
+        return time.perf_counter() - _t0, param['trials']
+
+    raise ValueError('unknown stage: %s'%name)
+
+
+UNITS = {'edf_load': 'MB/s', 'create_isplit': 'MB/s', 'load_isplit': 'MB/s',
+         'create_epoch_bymarker': 'epochs/s', 'dwt': 'channel-seconds/s',
+         'dwt_power': 'epochs/s', 'dwt_itpc': 'epochs/s', 'stfft': 'channel-seconds/s'}
+
+
+def _run_stage(args):
+    name, param = args
+    os.environ['TQDM_DISABLE'] = '1'
+    _seconds = []
+    for _ in range(param['repeat']):
+        _time, _amount = _stage(name, param)
+        _seconds.append(_time)
+    _best = min(_seconds)
+    return {'seconds': _best,
+            'throughput': _amount / _best if _best > 0 else float('inf'),
+            'unit': UNITS[name],
+            'peak_rss_mb': _peak_rss_mb()}
+
+
+def run(param, stages=STAGES):
+    '''
+    generate the synthetic patient and run the stages, each in a fresh process.
+
+    return:
+    - dict{stage: dict{seconds, throughput, unit, peak_rss_mb}}
+    '''
+
+    from synthetic import create_synthetic_patient
+
+    os.environ['TQDM_DISABLE'] = '1'
+    _manager, _markers = create_synthetic_patient(param['work_dir'], 'bench', nchannel=param['channels'],
+                                                  hours=param['hours'], fs=param['fs'])
+    _manager.get_patient('bench').create_isplit()
+    param['markers'] = _markers.tolist()
+    param['samples'] = int(param['hours'] * 3600) * param['fs']
+
+    _context = mp.get_context('spawn')
+    _result = {}
+    for name in stages:
+        with _context.Pool(1) as _pool:
+            _result[name] = _pool.apply(_run_stage, ((name, param),))
+        print('%-24s %10.4f s %12.2f %s  %8.1f MB'%(name, _result[name]['seconds'], _result[name]['throughput'],
+                                                     _result[name]['unit'], _result[name]['peak_rss_mb']))
+    return _result
+
+
+def compare(result, baseline, threshold=0.2):
+    '''
+    compare two runs, return the list of stages slower than the baseline
+    by more than `threshold` (relative).
+    '''
+
+    _regression = []
+    for name, item in result['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        _ratio = item['seconds'] / baseline['stages'][name]['seconds']
+        _flag = _ratio > 1 + threshold
+        print('%-24s %8.2fx %s'%(name, _ratio, 'REGRESSION' if _flag else ''))
+        if _flag:
+            _regression.append(name)
+    return _regression
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark EEGAnalysis hot paths.')
+    parser.add_argument('--channels', type=int, default=8, help='number of channels')
+    parser.add_argument('--hours', type=float, default=0.1, help='length of the recording, in hours')
+    parser.add_argument('--fs', type=int, default=2000, help='sampling rate')
+    parser.add_argument('--trials', type=int, default=50, help='number of epochs for the decomposition stages')
+    parser.add_argument('--nfreq', type=int, default=20, help='number of frequencies for dwt')
+    parser.add_argument('--repeat', type=int, default=3, help='repeats of each stage, the best is kept')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--work-dir', default=None, help='directory of the synthetic data [default: temporary]')
+    parser.add_argument('--out', default=None, help='json result file')
+    parser.add_argument('--compare', default=None, help='json result file of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown counted as regression')
+    args = parser.parse_args(argv)
+
+    _work_dir = args.work_dir or tempfile.mkdtemp(prefix='eeg_bench_')
+    param = {'channels': args.channels, 'hours': args.hours, 'fs': args.fs, 'trials': args.trials,
+             'nfreq': args.nfreq, 'repeat': args.repeat, 'work_dir': _work_dir}
+
+    try:
+        _stages = run(param, stages=args.stages)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(_work_dir, ignore_errors=True)
+
+    result = {'meta': {'channels': args.channels, 'hours': args.hours, 'fs': args.fs,
+                       'trials': args.trials, 'nfreq': args.nfreq,
+                       'python': platform.python_version(), 'numpy': np.__version__,
+                       'platform': platform.platform(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')},
+              'stages': _stages}
+
+    if args.out is not None:
+        with open(args.out, 'w') as _f:
+            json.dump(result, _f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as _f:
+            baseline = json.load(_f)
+        if compare(result, baseline, threshold=args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
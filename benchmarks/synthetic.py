@@ -0,0 +1,99 @@
+"""
+synthetic data for the benchmarks
+
+edf files of configurable size, written record by record, so that the
+generation itself runs in constant memory.
+"""
+
+import os
+import numpy as np
+
+
+def _field(value, width):
+    return str(value)[:width].ljust(width).encode('ascii')
+
+
+def write_synthetic_edf(filename, nchannel=8, hours=0.1, fs=2000, marker_interval=4.0,
+                        dc_label='POL DC10', seed=0):
+    '''
+    write an edf file of random int16 signals and one DC trigger channel.
+
+    arguments:
+    - filename: path of the edf file
+
+    keyword arguments:
+    - nchannel: number of signal channels [default: 8]
+    - hours: length of the recording, in hours [default: 0.1]
+    - fs: sampling rate, must be an integer [default: 2000]
+    - marker_interval: interval of the trigger pulses, in seconds [default: 4.0]
+    - dc_label: label of the trigger channel, None for no trigger [default: POL DC10]
+    - seed: random seed
+
+    return:
+    - markers: ndarray of the trigger onsets, in seconds
+    '''
+
+    _rng = np.random.default_rng(seed)
+    _recordnum = int(hours * 3600)
+    _labels = ['POL A%d'%(idx + 1) for idx in range(nchannel)]
+    if dc_label is not None:
+        _labels.append(dc_label)
+    _n = len(_labels)
+
+    _phys = [(-1e7, 1e7) if item == dc_label else (-3200.0, 3200.0) for item in _labels]
+    _header = _field(0, 8) + _field('X X X X', 80) + _field('Startdate X X X X', 80)
+    _header += _field('01.01.19', 8) + _field('00.00.00', 8) + _field(256 * (_n + 1), 8)
+    _header += _field('', 44) + _field(_recordnum, 8) + _field(1, 8) + _field(_n, 4)
+    _header += b''.join([_field(item, 16) for item in _labels])
+    _header += b''.join([_field('', 80) for item in _labels])
+    _header += b''.join([_field('uV', 8) for item in _labels])
+    _header += b''.join([_field(item[0], 8) for item in _phys])
+    _header += b''.join([_field(item[1], 8) for item in _phys])
+    _header += b''.join([_field(-32768, 8) for item in _labels])
+    _header += b''.join([_field(32767, 8) for item in _labels])
+    _header += b''.join([_field('', 80) for item in _labels])
+    _header += b''.join([_field(fs, 8) for item in _labels])
+    _header += b''.join([_field('', 32) for item in _labels])
+
+    _markers = np.arange(marker_interval, _recordnum - marker_interval, marker_interval)
+    _pulse = np.zeros(_recordnum * fs, dtype='bool')
+    for item in _markers:
+        _pulse[int(item * fs):int(item * fs) + fs // 10] = True
+
+    with open(filename, 'wb') as _f:
+        _f.write(_header)
+        _state = np.zeros(nchannel)
+        for ri in range(_recordnum):
+            _noise = _rng.standard_normal((nchannel, fs))
+            _signal = np.cumsum(_noise, 1) * 0.05 + _state.reshape((-1, 1)) * 0.99 + _noise * 200
+            _state = _signal[:, -1]
+            _record = np.clip(_signal, -32768, 32767).astype('<i2')
+            if dc_label is not None:
+                _trigger = (_pulse[ri * fs:(ri + 1) * fs] * 30000).astype('<i2')
+                _record = np.vstack((_record, _trigger))
+            _f.write(_record.tobytes())
+
+    return _markers
+
+
+def create_synthetic_patient(data_dir, patient_id, nchannel=8, hours=0.1, fs=2000, nfile=1):
+    '''
+    create a patient with synthetic raw files, without isplit files.
+
+    return:
+    - (`DataManager` instance, markers of the first file)
+    '''
+
+    from EEGAnalysis import DataManager
+
+    _raw_dir = os.path.join(data_dir, '_raw_' + patient_id)
+    if not os.path.isdir(_raw_dir):
+        os.makedirs(_raw_dir)
+
+    for idx in range(nfile):
+        _markers = write_synthetic_edf(os.path.join(_raw_dir, 'rec%02d.edf'%idx),
+                                       nchannel=nchannel, hours=hours, fs=fs, seed=idx)
+
+    _manager = DataManager(data_dir)
+    _manager.update_raw_to_patient(patient_id, _raw_dir, link='auto')
+    return _manager, _markers